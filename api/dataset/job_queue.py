@@ -1,22 +1,181 @@
+import asyncio
+import hashlib
+import importlib.metadata
+import json
+import os
+import time
 import uuid
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, List, Set
 from fastapi import Response, status
-from redis import Redis
-from rq import Queue
-from rq.exceptions import NoSuchJobError
-from rq.job import Job
+from redis import BlockingConnectionPool, Redis
+from redis import asyncio as aioredis
+from rq import Queue, Retry
+from rq.command import send_stop_job_command
+from rq.exceptions import InvalidJobOperation, NoSuchJobError
+from rq.job import Dependency, Job, JobStatus
+from rq.results import Result
 from api.dataset.models import SliceJob
 from api.settings import default_settings
+from api.tracing import PRODUCER, current_traceparent, span
+
+# jobs are routed by size class, so a long batch subset never holds up interactive requests:
+# previews and small subsets are served by their own worker pool (see docker-compose.yml),
+# large and sharded subsets by a batch pool that also takes small subsets when it's idle.
+PREVIEW_QUEUE = "preview"
+SUBSET_QUEUE = "subset"
+LARGE_SUBSET_QUEUE = "subset-large"
+JOB_QUEUES = [PREVIEW_QUEUE, SUBSET_QUEUE, LARGE_SUBSET_QUEUE]
+
+# jobs per user queued or running in a queue are tracked in one sorted set per user and queue,
+# scored by enqueue time. slots of jobs whose worker died without releasing them are dropped
+# after USER_JOB_SLOT_TTL seconds.
+USER_JOBS_PREFIX = "climate-data:user-jobs"
+USER_JOB_SLOT_TTL = 24 * 60 * 60
+
+# retries per shard of a sharded job before the merge gives up
+SHARD_RETRIES = 2
+
+# job state changes are published on one channel per job (see api.dataset.worker)
+JOB_EVENTS_PREFIX = "climate-data:job-events"
+TERMINAL_STATUSES = ["finished", "failed", "stopped", "canceled"]
+
+# seconds between keepalive comments on an idle event stream
+JOB_EVENTS_KEEPALIVE = 15
+
+# cached results are keyed on the processing version - the package version alone doesn't
+# change with fixes, so the sources of api.processing (filters, regridding, providers) are
+# hashed into it and any change to them invalidates results computed by older code
+PROCESSING_SOURCES = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "processing"
+)
+
+
+def source_hash(root: str) -> str:
+    """
+    sha1 of the paths and contents of the python files under `root`.
+    """
+    digest = hashlib.sha1()
+    for directory, subdirectories, files in sorted(os.walk(root)):
+        subdirectories.sort()
+        for name in sorted(f for f in files if f.endswith(".py")):
+            path = os.path.join(directory, name)
+            digest.update(os.path.relpath(path, root).encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+try:
+    PACKAGE_VERSION = importlib.metadata.version("climate-data")
+except importlib.metadata.PackageNotFoundError:
+    PACKAGE_VERSION = "unknown"
+CODE_VERSION = "+".join(
+    [PACKAGE_VERSION, source_hash(PROCESSING_SOURCES)[:12]]
+    + (
+        [default_settings.job_cache_version]
+        if default_settings.job_cache_version
+        else []
+    )
+)
+
+
+# one connection pool per process for the sync (rq) and async (status handlers) clients.
+# blocking pools wait for a free connection instead of opening more than redis_max_connections.
+_redis_pool: BlockingConnectionPool | None = None
+_async_redis_pool: aioredis.BlockingConnectionPool | None = None
+
+
+class UserJobLimitError(Exception):
+    pass
+
+
+class JobNotCancellableError(Exception):
+    pass
+
+
+def queue_timeout(queue: str) -> int:
+    """
+    job timeout in seconds for a queue, -1 for none.
+    """
+    return {
+        PREVIEW_QUEUE: default_settings.preview_job_timeout,
+        SUBSET_QUEUE: default_settings.subset_job_timeout,
+        LARGE_SUBSET_QUEUE: default_settings.subset_large_job_timeout,
+    }.get(queue, -1)
+
+
+def queue_user_limit(queue: str) -> int:
+    """
+    jobs one user may have queued or running in a queue, 0 for no limit.
+    """
+    return {
+        PREVIEW_QUEUE: default_settings.preview_user_max_jobs,
+        SUBSET_QUEUE: default_settings.subset_user_max_jobs,
+        LARGE_SUBSET_QUEUE: default_settings.subset_large_user_max_jobs,
+    }.get(queue, 0)
+
+
+def user_jobs_key(queue: str, user: str) -> str:
+    return f"{USER_JOBS_PREFIX}:{queue}:{user}"
+
+
+def reserve_user_slot(queue: str, user: str, job_id: str, redis):
+    """
+    counts `job_id` against the user's jobs in the queue, raising UserJobLimitError if the
+    user already has as many as queue_user_limit allows.
+    """
+    limit = queue_user_limit(queue)
+    if limit <= 0:
+        return
+    key = user_jobs_key(queue, user)
+    now = time.time()
+    with redis.pipeline() as pipeline:
+        pipeline.zremrangebyscore(key, "-inf", now - USER_JOB_SLOT_TTL)
+        pipeline.zadd(key, {job_id: now})
+        pipeline.zcard(key)
+        pipeline.expire(key, USER_JOB_SLOT_TTL)
+        count = pipeline.execute()[2]
+    if count > limit:
+        redis.zrem(key, job_id)
+        raise UserJobLimitError(
+            f"user {user} already has {limit} jobs queued or running in the {queue} queue - "
+            "wait for one to finish or cancel one"
+        )
+
+
+def release_user_slot(job: Job, connection):
+    """
+    frees the slot a job holds against its user's limit, if it holds one.
+    """
+    user = job.meta.get("user", None)
+    if user is not None:
+        connection.zrem(user_jobs_key(job.origin, user), job.id)
 
 
 def get_redis():
-    return Redis(default_settings.redis_host, default_settings.redis_port)
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = BlockingConnectionPool(
+            host=default_settings.redis_host,
+            port=default_settings.redis_port,
+            max_connections=default_settings.redis_max_connections,
+        )
+    return Redis(connection_pool=_redis_pool)
 
 
-# from knowledge-middleware/api/utils.py:37
-def create_job(*, func, args, redis, queue="default"):
-    q = Queue(name=queue, connection=redis, default_timeout=-1)
-    job_id = str(uuid.uuid4())
-    job = q.enqueue(func, args=args, kwargs={"job_id": job_id}, job_id=job_id)
+def get_async_redis():
+    global _async_redis_pool
+    if _async_redis_pool is None:
+        _async_redis_pool = aioredis.BlockingConnectionPool(
+            host=default_settings.redis_host,
+            port=default_settings.redis_port,
+            max_connections=default_settings.redis_max_connections,
+        )
+    return aioredis.Redis(connection_pool=_async_redis_pool)
+
+
+def describe_enqueued_job(job: Job) -> SliceJob:
     status = job.get_status()
     if status in ("finished", "failed"):
         job_result = job.return_value()
@@ -32,7 +191,419 @@ def create_job(*, func, args, redis, queue="default"):
         "job_error": job_error,
         "job_result": job_result,
     }
-    return SliceJob(id=job_id, status=status, result=result)
+    return SliceJob(id=job.id, status=status, result=result)
+
+
+def request_cache_key(kind: str, *parts: Any) -> str:
+    """
+    canonical key for a job request. parts must be json serializable; dict keys are sorted
+    and the code version is included so results don't outlive changes to the processing.
+    """
+    canonical = json.dumps([kind, CODE_VERSION, *parts], sort_keys=True, default=str)
+    return f"climate-data:{kind}:{hashlib.sha1(canonical.encode()).hexdigest()}"
+
+
+def find_cached_job(cache_key: str, redis) -> SliceJob | None:
+    """
+    returns a finished result for the request, or the job already running it, if either exists.
+    """
+    cached = redis.get(f"{cache_key}:result")
+    if cached is not None:
+        return SliceJob.model_validate_json(cached)
+    job_id = redis.get(f"{cache_key}:job")
+    if job_id is None:
+        return None
+    try:
+        job = Job.fetch(job_id.decode(), connection=redis)
+    except NoSuchJobError:
+        return None
+    if job.get_status() in ("queued", "started", "deferred", "scheduled"):
+        print(f"attaching to running job {job.id}", flush=True)
+        return fetch_job_status(job.id, redis)
+    return None
+
+
+def find_coalesced_job(coalesce_key: str, redis) -> SliceJob | None:
+    """
+    returns a queued, running or recently finished job for an identical request, if one exists.
+    """
+    job_id = redis.get(coalesce_key)
+    if job_id is None:
+        return None
+    try:
+        job = Job.fetch(job_id.decode(), connection=redis)
+    except NoSuchJobError:
+        return None
+    if job.get_status() in ("failed", "stopped", "canceled"):
+        return None
+    print(f"coalescing with job {job.id}", flush=True)
+    return fetch_job_status(job.id, redis)
+
+
+def reserve_cached_job(cache_key: str, job_id: str, redis) -> SliceJob | None:
+    """
+    marks `job_id` as the job running a request, unless a result or a running job for it already
+    exists - in which case that is returned instead and nothing should be enqueued.
+    """
+    existing = find_cached_job(cache_key, redis)
+    if existing is not None:
+        return existing
+    ttl = default_settings.job_cache_inflight_ttl
+    if not redis.set(f"{cache_key}:job", job_id, nx=True, ex=ttl):
+        # lost a race with an identical request, or the key points at a dead job
+        existing = find_cached_job(cache_key, redis)
+        if existing is not None:
+            return existing
+        redis.set(f"{cache_key}:job", job_id, ex=ttl)
+    return None
+
+
+def reserve_coalesced_job(
+    coalesce_key: str, job_id: str, coalesce_ttl: int, redis
+) -> SliceJob | None:
+    """
+    marks `job_id` as the job shared by identical requests for `coalesce_ttl` seconds, unless
+    one already exists - in which case that is returned instead and nothing should be enqueued.
+    """
+    existing = find_coalesced_job(coalesce_key, redis)
+    if existing is not None:
+        return existing
+    if not redis.set(coalesce_key, job_id, nx=True, ex=coalesce_ttl):
+        # lost a race with an identical request, or the key points at a failed job
+        existing = find_coalesced_job(coalesce_key, redis)
+        if existing is not None:
+            return existing
+        redis.set(coalesce_key, job_id, ex=coalesce_ttl)
+    return None
+
+
+def store_cached_result(job: Job, connection, result, *args, **kwargs):
+    """
+    rq success callback - keeps successful results of cached requests past the rq result ttl.
+    """
+    cache_key = job.meta.get("cache_key", None)
+    if cache_key is None:
+        return
+    connection.delete(f"{cache_key}:job")
+    if not isinstance(result, dict) or result.get("status", "ok") != "ok":
+        return
+    cached = SliceJob(
+        id=job.id,
+        status="finished",
+        result={
+            "created_at": job.created_at,
+            "enqueued_at": job.enqueued_at,
+            "started_at": job.started_at,
+            "job_error": None,
+            "job_result": result,
+        },
+    )
+    connection.set(
+        f"{cache_key}:result",
+        cached.model_dump_json(),
+        ex=default_settings.job_cache_result_ttl or None,
+    )
+
+
+def release_cache_key(job: Job, connection, *args, **kwargs):
+    """
+    rq failure callback - lets the next identical request start a new job.
+    """
+    cache_key = job.meta.get("cache_key", None)
+    if cache_key is not None:
+        connection.delete(f"{cache_key}:job")
+
+
+def cached_job_options(cache_key: str | None) -> dict:
+    if cache_key is None:
+        return {}
+    return {
+        "meta": {"cache_key": cache_key},
+        "on_success": store_cached_result,
+        "on_failure": release_cache_key,
+    }
+
+
+def reserve_job_for_user(
+    queue: str,
+    user: str,
+    job_id: str,
+    cache_key: str | None,
+    redis,
+    coalesce_key: str | None = None,
+):
+    try:
+        reserve_user_slot(queue, user, job_id, redis)
+    except UserJobLimitError:
+        # the request was reserved for this job - let the next identical one start its own
+        if cache_key is not None:
+            redis.delete(f"{cache_key}:job")
+        if coalesce_key is not None and redis.get(coalesce_key) == job_id.encode():
+            redis.delete(coalesce_key)
+        raise
+
+
+# from knowledge-middleware/api/utils.py:37
+def create_job(
+    *,
+    func,
+    args,
+    redis,
+    queue="default",
+    cache_key: str | None = None,
+    coalesce_key: str | None = None,
+    coalesce_ttl: int = 0,
+    profile: bool = False,
+    user: str | None = None,
+):
+    """
+    enqueues a job. identical requests can share one job in two ways:
+      `cache_key`: get the stored finished result or attach to the job in progress.
+      `coalesce_key`: get the same job while it is queued, running, or finished within `coalesce_ttl` seconds.
+        a `coalesce_ttl` of 0 turns coalescing off.
+    with `profile`, the worker profiles the job (see api.dataset.profiling) - profiled requests
+    always run a new job. new jobs count against `user`'s limit for the queue, raising
+    UserJobLimitError past it - shared jobs don't.
+    """
+    q = Queue(name=queue, connection=redis, default_timeout=queue_timeout(queue))
+    job_id = str(uuid.uuid4())
+    if cache_key is not None:
+        existing = reserve_cached_job(cache_key, job_id, redis)
+        if existing is not None:
+            return existing
+    options = cached_job_options(cache_key)
+    if profile:
+        options["meta"] = options.get("meta", {}) | {"profile": True}
+    if coalesce_ttl <= 0:
+        coalesce_key = None
+    if coalesce_key is not None:
+        existing = reserve_coalesced_job(coalesce_key, job_id, coalesce_ttl, redis)
+        if existing is not None:
+            return existing
+        # keep the finished job as long as it can be handed out
+        options["result_ttl"] = coalesce_ttl
+        options["meta"] = options.get("meta", {}) | {"coalesce_key": coalesce_key}
+    if user is not None:
+        reserve_job_for_user(queue, user, job_id, cache_key, redis, coalesce_key)
+        options["meta"] = options.get("meta", {}) | {"user": user}
+    with span("rq.enqueue", kind=PRODUCER, **{"job.id": job_id, "job.queue": queue}):
+        job = q.enqueue(
+            func,
+            args=args,
+            kwargs={"job_id": job_id, "trace_context": current_traceparent()},
+            job_id=job_id,
+            **options,
+        )
+    return describe_enqueued_job(job)
+
+
+def create_sharded_job(
+    *,
+    shard_func,
+    shard_args: List[list],
+    merge_func,
+    merge_args,
+    redis,
+    queue="default",
+    cache_key: str | None = None,
+    profile: bool = False,
+    user: str | None = None,
+):
+    """
+    fans a job out into independent shard jobs and a merge job that runs once every shard is done.
+    the merge job id is returned as the id of the whole job, and its status rolls up shard progress.
+    shards are retried independently - the merge job runs even if shards fail, and reports them.
+    the whole job takes one slot of `user`'s limit for the queue, held by the merge job.
+    """
+    q = Queue(name=queue, connection=redis, default_timeout=queue_timeout(queue))
+    job_id = str(uuid.uuid4())
+    if cache_key is not None:
+        existing = reserve_cached_job(cache_key, job_id, redis)
+        if existing is not None:
+            return existing
+    if user is not None:
+        reserve_job_for_user(queue, user, job_id, cache_key, redis)
+    shards = []
+    with span("rq.enqueue", kind=PRODUCER, **{"job.id": job_id, "job.queue": queue}):
+        trace_context = current_traceparent()
+        for i, args in enumerate(shard_args):
+            shard_id = f"{job_id}-shard-{i}"
+            shards.append(
+                q.enqueue(
+                    shard_func,
+                    args=args,
+                    kwargs={
+                        "job_id": shard_id,
+                        "parent_job_id": job_id,
+                        "shard_index": i,
+                        "trace_context": trace_context,
+                    },
+                    job_id=shard_id,
+                    retry=Retry(max=SHARD_RETRIES),
+                    meta={"parent_job_id": job_id, "profile": profile},
+                )
+            )
+        shard_ids = [shard.id for shard in shards]
+        options = cached_job_options(cache_key)
+        options["meta"] = options.get("meta", {}) | {
+            "shards": shard_ids,
+            "profile": profile,
+        }
+        if user is not None:
+            options["meta"]["user"] = user
+        job = q.enqueue(
+            merge_func,
+            args=merge_args,
+            kwargs={
+                "job_id": job_id,
+                "shard_job_ids": shard_ids,
+                "trace_context": trace_context,
+            },
+            job_id=job_id,
+            depends_on=Dependency(jobs=shards, allow_failure=True),
+            **options,
+        )
+    return describe_enqueued_job(job)
+
+
+def stop_or_cancel(job: Job, redis):
+    """
+    stops a running job - its worker kills the job and moves on - or takes a waiting one off
+    its queue. finished jobs are left alone.
+    """
+    state = JobStatus(job.get_status())
+    if state == JobStatus.STARTED:
+        try:
+            send_stop_job_command(redis, job.id)
+        except InvalidJobOperation:
+            # between being dequeued and started - it can't be stopped, so it runs
+            print(f"failed to stop job {job.id}: not running on a worker", flush=True)
+    elif state in (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED):
+        job.cancel()
+        release_cache_key(job, redis)
+        release_user_slot(job, redis)
+        publish_job_event(redis, job.id, JobStatus.CANCELED.value)
+
+
+def check_cancellable(job: Job, user: str | None):
+    """
+    raises JobNotCancellableError unless `user` may cancel the job: the user it was enqueued
+    for may, and anyone may cancel a job enqueued without a user that no other request shares.
+    """
+    owner = job.meta.get("user", None)
+    if owner is not None:
+        if user != owner:
+            raise JobNotCancellableError(
+                f"job {job.id} can only be canceled by the user it was enqueued for"
+            )
+        return
+    if "cache_key" in job.meta or "coalesce_key" in job.meta:
+        raise JobNotCancellableError(
+            f"job {job.id} is shared by identical requests and was enqueued without a "
+            "user - it can't be canceled"
+        )
+
+
+def cancel_job(job_id: str, redis, user: str | None = None):
+    """
+    cancels a job and, for sharded jobs, its shards. running jobs are stopped by their
+    workers, which record them as stopped and free their slots once they are. jobs other
+    requests may be attached to are only canceled for their owner (see check_cancellable).
+    """
+    try:
+        job = Job.fetch(job_id, connection=redis)
+    except NoSuchJobError:
+        return status.HTTP_404_NOT_FOUND
+    check_cancellable(job, user)
+    # the merge job first, so failing shards don't start it
+    stop_or_cancel(job, redis)
+    for shard in Job.fetch_many(job.meta.get("shards", []), connection=redis):
+        if shard is not None:
+            stop_or_cancel(shard, redis)
+    return fetch_job_status(job_id, redis)
+
+
+def summarize_shards(shards: List[Job | None]) -> dict:
+    """
+    counts of shard job statuses, and the retries used so far.
+    """
+    shards = [s for s in shards if s is not None]
+    statuses = Counter(JobStatus(s.get_status(refresh=False)).value for s in shards)
+    retried = sum(
+        SHARD_RETRIES
+        - (s.retries_left if s.retries_left is not None else SHARD_RETRIES)
+        for s in shards
+    )
+    return {"retries": retried} | dict(statuses)
+
+
+def shard_progress(job: Job, redis) -> dict | None:
+    """
+    shard progress of a sharded job, None for regular jobs.
+    """
+    shard_ids = job.meta.get("shards", None)
+    if shard_ids is None:
+        return None
+    shards = Job.fetch_many(shard_ids, connection=redis)
+    return {"shards": len(shard_ids)} | summarize_shards(shards)
+
+
+def queue_status_reads(pipeline, job_id: str):
+    """
+    the reads behind a job status: the job hash and its latest result. these are the reads of
+    Job.fetch and Job.latest_result in the pinned rq version - tests/test_job_queue.py checks
+    the restored job against them.
+    """
+    pipeline.hgetall(Job.key_for(job_id))
+    pipeline.xrevrange(Result.get_key(job_id), "+", "-", count=1)
+
+
+def restore_job(job_id: str, raw_job: dict, redis) -> Job | None:
+    """
+    a Job from its pipelined hash read, None if it doesn't exist.
+    """
+    if not raw_job:
+        return None
+    job = Job(job_id, connection=redis)
+    job.restore(raw_job)
+    return job
+
+
+def restore_latest_result(job: Job, raw_results: list) -> Result | None:
+    """
+    the job's latest result from its pipelined results stream read - what job.latest_result()
+    returns, without another round-trip.
+    """
+    if not raw_results:
+        return None
+    result_id, payload = raw_results[0]
+    return Result.restore(
+        job.id, result_id.decode(), payload, connection=job.connection
+    )
+
+
+def describe_job_status(
+    job: Job, latest: Result | None, progress: dict | None
+) -> SliceJob:
+    result = {
+        "created_at": job.created_at,
+        "enqueued_at": job.enqueued_at,
+        "started_at": job.started_at,
+        "job_error": (
+            latest.exc_string
+            if latest is not None and latest.type == Result.Type.FAILED
+            else None
+        ),
+        "job_result": (
+            latest.return_value
+            if latest is not None and latest.type == Result.Type.SUCCESSFUL
+            else None
+        ),
+        "progress": progress,
+        "stage": job.meta.get("stage", None),
+        "stages": job.meta.get("stages", None),
+    }
+    return SliceJob(id=job.id, status=job.get_status(refresh=False), result=result)
 
 
 def fetch_job_status(job_id, redis):
@@ -46,15 +617,175 @@ def fetch_job_status(job_id, redis):
             status_code: 200 if successful, 404 if job does not exist.
             content: contains the job's results.
     """
-    try:
-        job = Job.fetch(job_id, connection=redis)
-        result = {
-            "created_at": job.created_at,
-            "enqueued_at": job.enqueued_at,
-            "started_at": job.started_at,
-            "job_error": job.exc_info,
-            "job_result": job.return_value(),
-        }
-        return SliceJob(id=job_id, status=job.get_status(), result=result)
-    except NoSuchJobError:
+    with redis.pipeline(transaction=False) as pipeline:
+        queue_status_reads(pipeline, job_id)
+        raw_job, raw_results = pipeline.execute()
+    job = restore_job(job_id, raw_job, redis)
+    if job is None:
         return status.HTTP_404_NOT_FOUND
+    latest = restore_latest_result(job, raw_results)
+    return describe_job_status(job, latest, shard_progress(job, redis))
+
+
+async def fetch_job_statuses_async(job_ids: List[str], redis) -> List[SliceJob | None]:
+    """
+    statuses of many jobs in one pipelined round-trip, plus one more for the shards of any
+    sharded jobs. missing jobs are None.
+    """
+    async with redis.pipeline(transaction=False) as pipeline:
+        for job_id in job_ids:
+            queue_status_reads(pipeline, job_id)
+        replies = await pipeline.execute()
+    jobs = [
+        restore_job(job_id, replies[2 * i], get_redis())
+        for i, job_id in enumerate(job_ids)
+    ]
+    results = [
+        restore_latest_result(job, replies[2 * i + 1]) if job is not None else None
+        for i, job in enumerate(jobs)
+    ]
+
+    shard_ids = [
+        job.meta["shards"] for job in jobs if job is not None and "shards" in job.meta
+    ]
+    shards: Dict[str, Job | None] = {}
+    if shard_ids:
+        flat = [shard_id for ids in shard_ids for shard_id in ids]
+        async with redis.pipeline(transaction=False) as pipeline:
+            for shard_id in flat:
+                pipeline.hgetall(Job.key_for(shard_id))
+            raw_shards = await pipeline.execute()
+        shards = {
+            shard_id: restore_job(shard_id, raw, get_redis())
+            for shard_id, raw in zip(flat, raw_shards)
+        }
+
+    statuses: List[SliceJob | None] = []
+    for job, latest in zip(jobs, results):
+        if job is None:
+            statuses.append(None)
+            continue
+        progress = None
+        if "shards" in job.meta:
+            progress = {"shards": len(job.meta["shards"])} | summarize_shards(
+                [shards[shard_id] for shard_id in job.meta["shards"]]
+            )
+        statuses.append(describe_job_status(job, latest, progress))
+    return statuses
+
+
+async def fetch_job_status_async(job_id: str, redis) -> SliceJob | int:
+    """
+    fetch_job_status over the async client - one round-trip, two for sharded jobs.
+    """
+    job = (await fetch_job_statuses_async([job_id], redis))[0]
+    return job if job is not None else status.HTTP_404_NOT_FOUND
+
+
+def publish_job_event(redis, job_id: str, status: str, progress: dict | None = None):
+    event = {"id": job_id, "status": status, "progress": progress}
+    redis.publish(f"{JOB_EVENTS_PREFIX}:{job_id}", json.dumps(event))
+
+
+class JobEventHub:
+    """
+    one pattern subscription to every job event channel per process, fanned out to the
+    in-process queues of the event streams watching each job - so event streams don't hold
+    redis connections of their own.
+    """
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self.listener: asyncio.Task | None = None
+        self.ready = asyncio.Event()
+
+    async def listen(self, redis):
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.psubscribe(f"{JOB_EVENTS_PREFIX}:*")
+            self.ready.set()
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                event = json.loads(message["data"])
+                for queue in self.subscribers.get(event["id"], set()):
+                    queue.put_nowait(event)
+        finally:
+            self.ready.clear()
+            await pubsub.reset()
+
+    async def subscribe(self, job_ids: List[str], redis) -> asyncio.Queue:
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen(redis))
+        # events published before the subscription is active would be lost
+        await self.ready.wait()
+        queue: asyncio.Queue = asyncio.Queue()
+        for job_id in job_ids:
+            self.subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_ids: List[str], queue: asyncio.Queue):
+        for job_id in job_ids:
+            queues = self.subscribers.get(job_id, set())
+            queues.discard(queue)
+            if not queues:
+                self.subscribers.pop(job_id, None)
+
+
+_job_event_hub: JobEventHub | None = None
+
+
+def get_job_event_hub() -> JobEventHub:
+    global _job_event_hub
+    if _job_event_hub is None:
+        _job_event_hub = JobEventHub()
+    return _job_event_hub
+
+
+def server_sent_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def job_event_stream(job_ids: List[str], redis) -> AsyncIterator[str]:
+    """
+    server-sent events for a set of jobs: a `status` event with the current status of each job,
+    `progress` events as they change state, and a final `status` event once each is done.
+    the stream ends when every job is done.
+    """
+    hub = get_job_event_hub()
+    queue = await hub.subscribe(job_ids, redis)
+    try:
+        pending = set()
+        for job_id, job in zip(job_ids, await fetch_job_statuses_async(job_ids, redis)):
+            if job is None:
+                yield server_sent_event(
+                    "status", json.dumps({"id": job_id, "status": "not_found"})
+                )
+                continue
+            yield server_sent_event("status", job.model_dump_json())
+            if job.status.value not in TERMINAL_STATUSES:
+                pending.add(job_id)
+
+        while pending:
+            try:
+                event = await asyncio.wait_for(queue.get(), JOB_EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                # catches anything missed while the subscription was down
+                watched = sorted(pending)
+                for job in await fetch_job_statuses_async(watched, redis):
+                    if job is not None and job.status.value in TERMINAL_STATUSES:
+                        yield server_sent_event("status", job.model_dump_json())
+                        pending.discard(job.id)
+                continue
+            if event["id"] not in pending:
+                continue
+            if event["status"] not in TERMINAL_STATUSES:
+                yield server_sent_event("progress", json.dumps(event))
+                continue
+            job = (await fetch_job_statuses_async([event["id"]], redis))[0]
+            if job is not None:
+                yield server_sent_event("status", job.model_dump_json())
+            pending.discard(event["id"])
+    finally:
+        hub.unsubscribe(job_ids, queue)
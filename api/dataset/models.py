@@ -20,14 +20,21 @@ class Status(Enum):
     queued = "queued"
     running = "running"
     failed = "failed"
+    deferred = "deferred"
+    scheduled = "scheduled"
+    stopped = "stopped"
+    canceled = "canceled"
 
 
 class Result(BaseModel):
     created_at: datetime
-    enqueued_at: datetime
+    enqueued_at: datetime | None
     started_at: datetime | None
     job_result: Dict | None
     job_error: str | None
+    progress: Dict | None = None
+    stage: str | None = None
+    stages: List[Dict] | None = None
 
 
 class SliceJob(BaseModel):
@@ -36,6 +43,21 @@ class SliceJob(BaseModel):
     result: Result | None
 
 
+class SubsetEstimate(BaseModel):
+    shape: Dict[str, int]
+    variables: List[str]
+    read_bytes: int  # pulled from upstream before any aggregation
+    uncompressed_bytes: int  # output size
+    compressed_bytes: int
+    files: int
+    total_files: int
+    upstream_requests: int
+    queue: str
+    shards: List[List[str]] = []  # timestamp ranges when split into time shards
+    rejected: bool = False
+    reason: str | None = None
+
+
 class TemporalSubsetOptions(BaseModel):
     timestamp_range: List[str]
     field: str = "time"
@@ -46,6 +68,11 @@ class GeospatialSubsetOptions(BaseModel):
     fields: List[str] = ["lon", "lat"]
 
 
+class PointSubsetOptions(BaseModel):
+    point: List[float]
+    fields: List[str] = ["lon", "lat"]
+
+
 class ThinningSubsetOptions(BaseModel):
     factor: int = 1
     fields: List[str] | None = None  # none implies all fields
@@ -53,6 +80,31 @@ class ThinningSubsetOptions(BaseModel):
     squared: bool = False
 
 
+class RegridSubsetOptions(BaseModel):
+    method: str = "bilinear"
+    resolution: List[float] | None = None  # [lon, lat] degrees
+    target_dataset_id: str | None = None
+    fields: List[str] = ["lon", "lat"]
+
+
+class ResampleSubsetOptions(BaseModel):
+    frequency: str
+    method: str = "mean"
+    field: str = "time"
+
+
+class CoarsenSubsetOptions(BaseModel):
+    factor: int
+    fields: List[str] = ["lon", "lat"]
+    weighted: bool = True
+
+
+class ReductionSubsetOptions(BaseModel):
+    method: str = "mean"  # mean, min, max, sum, median or a percentile like p90
+    fields: List[str] = ["lon", "lat"]
+    weighted: bool = True
+
+
 class CustomSubsetOptions(BaseModel):
     payload: Dict[str, str] = Field({})
 
@@ -60,14 +112,30 @@ class CustomSubsetOptions(BaseModel):
 class DatasetSubsetOptions(BaseModel):
     geospatial: GeospatialSubsetOptions | None = None
     temporal: TemporalSubsetOptions | None = None
+    point: PointSubsetOptions | None = None
     thinning: ThinningSubsetOptions | None = None
+    regrid: RegridSubsetOptions | None = None
+    resample: ResampleSubsetOptions | None = None
+    coarsen: CoarsenSubsetOptions | None = None
+    reduction: ReductionSubsetOptions | None = None
     custom: CustomSubsetOptions | None = None
 
 
 class DatasetQueryParameters(Enum):
     envelope = "envelope"
+    point = "point"
     timestamps = "timestamps"
     thin_factor = "thin_factor"
     thin_fields = "thin_fields"
     thin_square = "thin_squared"
+    regrid = "regrid"
+    regrid_method = "regrid_method"
+    regrid_target = "regrid_target"
+    resample = "resample"
+    resample_method = "resample_method"
+    coarsen = "coarsen"
+    coarsen_fields = "coarsen_fields"
+    reduce = "reduce"
+    reduce_fields = "reduce_fields"
+    area_weighted = "area_weighted"
     custom = "custom"
@@ -0,0 +1,86 @@
+import importlib
+import time
+import dask
+import numpy
+import xarray
+from api.settings import default_settings
+
+# loads what every job would otherwise load for itself, once per worker before it forks work
+# horses - which inherit it all, copy on write. a preview job that imports matplotlib and
+# cartopy, reads the Natural Earth coastlines and sets up a figure spends most of its wall
+# time on that, not on the dataset.
+
+# job modules, and through them xarray backends, dask, matplotlib, cartopy and scipy
+PRELOAD_MODULES = [
+    "api.processing.providers.esgf",
+    "api.processing.providers.era5",
+    "api.processing.regrid",
+    "api.preview.render",
+    "api.dataset.terarium_hmi",
+    "netCDF4",
+    "cftime",
+]
+
+# coastline scales cartopy picks for preview extents
+COASTLINE_SCALES = ["110m", "50m"]
+
+_preloaded = False
+
+
+def import_modules():
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+
+
+def load_natural_earth():
+    """
+    reads the coastline shapes into cartopy's geometry cache, downloading them if needed.
+    """
+    import cartopy.feature
+
+    for scale in COASTLINE_SCALES:
+        feature = cartopy.feature.NaturalEarthFeature("physical", "coastline", scale)
+        for _ in feature.geometries():
+            pass
+
+
+def warm_renderer():
+    """
+    draws one small frame, so the figure, font and colormap setup of the first preview is done.
+    """
+    from api.preview.render import FrameRenderer
+
+    frame = {
+        "values": numpy.zeros((2, 2)),
+        "x": numpy.array([0.0, 180.0]),
+        "y": numpy.array([-45.0, 45.0]),
+        "title": "",
+    }
+    renderer = FrameRenderer(frame, {"vmin": 0, "vmax": 1, "label": ""})
+    renderer.render(frame)
+    renderer.close()
+
+
+def warm_dask():
+    # graph handling and xarray's backend entrypoints. not the threaded scheduler - its thread
+    # pool would be inherited by work horses without its threads
+    dask.compute(dask.delayed(int)(0), scheduler="sync")
+    xarray.backends.list_engines()
+
+
+def preload():
+    """
+    imports job modules and loads shared resources into this process. once per process, and
+    only with worker_preload set. failures are logged - jobs load what they need anyway.
+    """
+    global _preloaded
+    if _preloaded or not default_settings.worker_preload:
+        return
+    _preloaded = True
+    start = time.perf_counter()
+    for step in [import_modules, warm_dask, load_natural_earth, warm_renderer]:
+        try:
+            step()
+        except Exception as e:
+            print(f"failed to preload ({step.__name__}): {e}", flush=True)
+    print(f"preloaded in {time.perf_counter() - start:.1f}s", flush=True)
@@ -0,0 +1,203 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List
+from dask.callbacks import Callback
+from dask.utils import key_split
+from api.settings import default_settings
+
+# opt-in profiles of single jobs (`profile=true` on /subset/* and /preview/esgf). the worker
+# samples the stacks of every thread of the job process - dask runs loads and renders in pool
+# threads - and records the dask tasks the job computed. the profile is kept in redis for
+# profile_ttl seconds and served by /status/{job_id}/profile as folded stacks:
+#
+#   MainThread;perform_job (rq/worker.py:1403);render (api/preview/render.py:362) 12
+#
+# the folded format is read by flamegraph.pl, speedscope and most flame graph tools.
+
+JOB_PROFILE_PREFIX = "climate-data:job-profile"
+
+# at most this many tasks are kept in the task stream - the summary covers every task
+TASK_STREAM_MAX_TASKS = 10000
+
+# leaf frames of threads waiting for work, left out of the samples
+IDLE_FRAMES = {("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker")}
+
+# set while a profiled job runs - work the job would hand to other processes, which the
+# sampler can't see, runs in the job process instead (see api.preview.render)
+_profiling: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "profiling", default=False
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def profile_key(job_id: str) -> str:
+    return f"{JOB_PROFILE_PREFIX}:{job_id}"
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    if path.startswith(ROOT):
+        path = os.path.relpath(path, ROOT)
+    else:
+        # site-packages/xarray/core/dataset.py -> xarray/core/dataset.py
+        parts = path.split(os.sep)
+        for marker in ("site-packages", "dist-packages", "lib"):
+            if marker in parts:
+                parts = parts[len(parts) - parts[::-1].index(marker) :]
+                break
+        path = "/".join(parts)
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def is_idle(frame) -> bool:
+    return (
+        os.path.basename(frame.f_code.co_filename),
+        frame.f_code.co_name,
+    ) in IDLE_FRAMES
+
+
+class SamplingProfiler:
+    """
+    samples the stacks of every other thread in the process each `interval` seconds.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def sample(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.thread.ident or is_idle(frame):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class TaskStream(Callback):
+    """
+    start and end of each dask task computed while active, from the scheduler's side.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.started: Dict[Any, float] = {}
+        self.tasks: List[Dict[str, Any]] = []
+        self.summary: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def _pretask(self, key, dsk, state):
+        self.started[key] = time.perf_counter()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        end = time.perf_counter()
+        start = self.started.pop(key, end)
+        prefix = key_split(key)
+        with self.lock:
+            summary = self.summary.setdefault(
+                prefix, {"tasks": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            summary["tasks"] += 1
+            summary["seconds"] += end - start
+            summary["max_seconds"] = max(summary["max_seconds"], end - start)
+            if len(self.tasks) < TASK_STREAM_MAX_TASKS:
+                self.tasks.append(
+                    {
+                        "prefix": prefix,
+                        "worker": worker_id,
+                        "start": round(start - self.origin, 6),
+                        "end": round(end - self.origin, 6),
+                    }
+                )
+
+    def describe(self) -> Dict[str, Any]:
+        summary = {
+            prefix: {k: round(v, 6) for k, v in s.items()}
+            for prefix, s in sorted(
+                self.summary.items(), key=lambda s: s[1]["seconds"], reverse=True
+            )
+        }
+        return {
+            "summary": summary,
+            "tasks": self.tasks,
+            "truncated": sum(s["tasks"] for s in self.summary.values())
+            > len(self.tasks),
+        }
+
+
+def profiling_active() -> bool:
+    return _profiling.get()
+
+
+def save_profile(redis, job_id: str, profile: Dict[str, Any]):
+    redis.set(
+        profile_key(job_id),
+        json.dumps(profile),
+        ex=default_settings.profile_ttl or None,
+    )
+
+
+@contextmanager
+def profiled(job, redis):
+    """
+    profiles the block when the job was enqueued with profile=true, otherwise does nothing.
+    """
+    if not job.meta.get("profile", False):
+        yield
+        return
+    profiler = SamplingProfiler(default_settings.profile_interval)
+    task_stream = TaskStream()
+    start = time.perf_counter()
+    profiler.start()
+    token = _profiling.set(True)
+    try:
+        with task_stream:
+            yield
+    finally:
+        _profiling.reset(token)
+        profiler.stop()
+        profile = {
+            "job_id": job.id,
+            "function": job.func_name,
+            "seconds": round(time.perf_counter() - start, 3),
+            "interval": profiler.interval,
+            "samples": profiler.samples,
+            "stacks": dict(profiler.stacks.most_common()),
+            "task_stream": task_stream.describe(),
+        }
+        try:
+            save_profile(redis, job.id, profile)
+        except Exception as e:
+            print(f"failed to save profile of {job.id}: {e}", flush=True)
+
+
+def folded_stacks(profile: Dict[str, Any]) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in profile["stacks"].items())
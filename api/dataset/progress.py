@@ -0,0 +1,89 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict
+from rq import get_current_job
+from api.dataset.job_queue import publish_job_event
+from api.metrics import observe_stage
+from api.tracing import span
+
+# stage level progress of the running rq job, kept in job.meta so /status can show which
+# stage a job is in and where its time and bytes went:
+#
+#   with stage("load"):
+#       ds.load()
+#       record(bytes_read=ds.nbytes)
+#
+# meta["stage"] is the current stage, meta["stages"] every stage so far with its start and
+# end times and counters. outside of an rq job (e.g. in the API) both are no-ops.
+
+# summed when recorded more than once in a stage - other counters are overwritten
+SUMMED_COUNTERS = ["bytes_read", "bytes_written", "bytes_uploaded", "files", "frames"]
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def save_progress(job, entry: Dict[str, Any]):
+    try:
+        job.save_meta()
+        publish_job_event(job.connection, job.id, "started", {"stage": entry})
+    except Exception as e:
+        # progress is best effort - it never fails the job
+        print(f"failed to save job progress: {e}", flush=True)
+
+
+@contextmanager
+def stage(name: str):
+    job = get_current_job()
+    if job is None:
+        yield
+        return
+    entry: Dict[str, Any] = {"stage": name, "started_at": now(), "ended_at": None}
+    job.meta["stage"] = name
+    job.meta.setdefault("stages", []).append(entry)
+    save_progress(job, entry)
+    start = time.perf_counter()
+    with span(name) as current:
+        try:
+            yield
+        except Exception as e:
+            entry["error"] = str(e)
+            raise
+        finally:
+            entry["ended_at"] = now()
+            entry["seconds"] = round(time.perf_counter() - start, 3)
+            save_progress(job, entry)
+            observe_stage(job.func_name, entry, stage_node(job, entry))
+            current.attributes |= {
+                k: v for k, v in entry.items() if k in SUMMED_COUNTERS + ["mirror"]
+            }
+
+
+def stage_node(job, entry: Dict[str, Any]) -> str:
+    """
+    the mirror (data node) a stage read from - stages after the open inherit the last mirror.
+    """
+    if "mirror" in entry:
+        return entry["mirror"]
+    for previous in reversed(job.meta.get("stages", [])):
+        if "mirror" in previous:
+            return previous["mirror"]
+    return ""
+
+
+def record(**counters: Any):
+    """
+    adds counters (bytes_read, bytes_written, files, mirror, ...) to the current stage.
+    they are saved when the stage ends.
+    """
+    job = get_current_job()
+    if job is None or len(job.meta.get("stages", [])) == 0:
+        return
+    entry = job.meta["stages"][-1]
+    for counter, value in counters.items():
+        if counter in SUMMED_COUNTERS:
+            entry[counter] = entry.get(counter, 0) + value
+        else:
+            entry[counter] = value
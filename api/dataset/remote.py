@@ -4,9 +4,13 @@ import xarray
 from typing import List, Tuple
 from api.search.provider import AccessURLs
 from api.settings import default_settings
+from api.dataset.progress import record
+from api.metrics import in_context
+from api.sessions import get_http_session
+from api.tracing import CLIENT, span
+from urllib.parse import urlparse
 import os
 import s3fs
-import requests
 
 # we have to operate on urls, paths / dataset_ids due to the fact that
 # rq jobs can't pass the context of a loaded xarray dataset in memory (json serialization)
@@ -40,6 +44,7 @@ def open_dataset(paths: AccessURLs, job_id=None) -> xarray.Dataset:
                 parallel=True,
                 use_cftime=True,
             )
+            record(mirror=mirror_name(opendap_urls[0]), files=len(opendap_urls))
             return ds
         except IOError as e:
             print(f"failed to open parallel: {e}")
@@ -50,6 +55,7 @@ def open_dataset(paths: AccessURLs, job_id=None) -> xarray.Dataset:
                 combine="nested",
                 use_cftime=True,
             )
+            record(mirror=mirror_name(opendap_urls[0]), files=len(opendap_urls))
             return ds
         except IOError as e:
             print(f"failed to open sequentially {e}")
@@ -58,6 +64,7 @@ def open_dataset(paths: AccessURLs, job_id=None) -> xarray.Dataset:
     try:
         # function handles stripping out url part, so any mirror will have the same result
         ds = open_remote_dataset_s3(paths[0]["opendap"])
+        record(mirror="s3://esgf-world", files=len(paths[0]["opendap"]))
         return ds
     except ValueError as e:
         print(f"file not found in s3 mirroring: {e}")
@@ -74,6 +81,7 @@ def open_dataset(paths: AccessURLs, job_id=None) -> xarray.Dataset:
             ds = open_remote_dataset_http(
                 http_urls, job_id, default_settings.esgf_openid
             )
+            record(mirror=mirror_name(http_urls[0]))
             return ds
         except IOError as e:
             print(f"failed to download via plain http: {e}")
@@ -83,6 +91,10 @@ def open_dataset(paths: AccessURLs, job_id=None) -> xarray.Dataset:
     )
 
 
+def mirror_name(url: str) -> str:
+    return urlparse(url).netloc
+
+
 def open_remote_dataset_s3(urls: List[str]) -> xarray.Dataset:
     fs = s3fs.S3FileSystem(anon=True)
     urls = ["s3://esgf-world" + url[url.find("/CMIP6") :] for url in urls]
@@ -100,14 +112,17 @@ def open_remote_dataset_s3(urls: List[str]) -> xarray.Dataset:
 
 def download_file_http(url: str, dir: str, auth: Tuple[str, str] | None = None):
     print(f"downloading file {url}", flush=True)
-    rs = requests.get(url, stream=True)
-    if rs.status_code == 401:
-        rs = requests.get(url, stream=True, auth=auth)
-    filename = url.split("/")[-1]
-    print("writing ", os.path.join(dir, filename))
-    with open(os.path.join(dir, filename), mode="wb") as file:
-        for chunk in rs.iter_content(chunk_size=10 * 1024):
-            file.write(chunk)
+    with span("http.download", kind=CLIENT, node=mirror_name(url)) as current:
+        session = get_http_session()
+        rs = session.get(url, stream=True)
+        if rs.status_code == 401:
+            rs = session.get(url, stream=True, auth=auth)
+        filename = url.split("/")[-1]
+        print("writing ", os.path.join(dir, filename))
+        with open(os.path.join(dir, filename), mode="wb") as file:
+            for chunk in rs.iter_content(chunk_size=10 * 1024):
+                file.write(chunk)
+        current.set_attribute("bytes", os.path.getsize(os.path.join(dir, filename)))
 
 
 def open_remote_dataset_http(
@@ -117,9 +132,12 @@ def open_remote_dataset_http(
     if not os.path.exists(temp_directory):
         os.makedirs(temp_directory)
     with ThreadPoolExecutor() as executor:
-        executor.map(lambda url: download_file_http(url, temp_directory, auth), urls)
+        executor.map(
+            in_context(lambda url: download_file_http(url, temp_directory, auth)), urls
+        )
     files = [os.path.join(temp_directory, f) for f in os.listdir(temp_directory)]
     print(f"files: {files}", flush=True)
+    record(bytes_read=sum(os.path.getsize(f) for f in files), files=len(files))
     ds = xarray.open_mfdataset(
         files,
         parallel=True,
@@ -143,7 +161,8 @@ def cleanup_potential_artifacts(job_id):
 def open_remote_dataset_hmi(dataset_id: str, job_id: str) -> xarray.Dataset:
     base_url = f"{default_settings.terarium_url}/datasets/{dataset_id}"
     auth = (default_settings.terarium_user, default_settings.terarium_pass)
-    response = requests.get(base_url, auth=auth)
+    with span("terarium.dataset", kind=CLIENT):
+        response = get_http_session().get(base_url, auth=auth)
     if response.status_code != 200:
         errors = {
             204: "does not exist (204)",
@@ -158,4 +177,6 @@ def open_remote_dataset_hmi(dataset_id: str, job_id: str) -> xarray.Dataset:
         raise IOError("Dataset has no associated files")
     filenames = [f"{base_url}/download-file?filename={f}" for f in filenames]
 
-    return open_remote_dataset_http(filenames, job_id, auth)
+    ds = open_remote_dataset_http(filenames, job_id, auth)
+    record(mirror="terarium")
+    return ds
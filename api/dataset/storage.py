@@ -10,6 +10,7 @@ def initialize_client() -> Any:
         aws_secret_access_key=default_settings.minio_pass,
         endpoint_url=default_settings.minio_url,
     )
-    if len(client.list_buckets()) == 0:
+    buckets = [b["Name"] for b in client.list_buckets().get("Buckets", [])]
+    if default_settings.bucket_name not in buckets:
         client.create_bucket(Bucket=default_settings.bucket_name)
     return client
@@ -2,8 +2,10 @@ import xarray
 from api.dataset.models import DatasetSubsetOptions
 from api.dataset.metadata import extract_metadata, extract_esgf_specific_fields
 from api.search.providers.era5 import ERA5SearchData
+from api.sessions import get_http_session
 from api.settings import default_settings
-import requests
+from api.tracing import CLIENT, span
+import os
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 import numpy
 from api.preview.render import render
@@ -27,10 +29,36 @@ def generate_description(
         string += f"""    Geographic Envelope:
       Bounds: {opts.geospatial.envelope}\n"""
 
+    if opts.point is not None:
+        string += f"""    Nearest Point:
+      Location: {opts.point.point}\n"""
+
     if opts.thinning is not None:
         string += f"""    Thinning:
       Factor: {opts.thinning.factor}
-      Fields: {opts.thinning.fields} (blank is all fields)"""
+      Fields: {opts.thinning.fields} (blank is all fields)\n"""
+
+    if opts.regrid is not None:
+        string += f"""    Regridded:
+      Method: {opts.regrid.method}
+      Target: {opts.regrid.resolution or opts.regrid.target_dataset_id}\n"""
+
+    if opts.resample is not None:
+        string += f"""    Resampled:
+      Frequency: {opts.resample.frequency}
+      Method: {opts.resample.method}\n"""
+
+    if opts.coarsen is not None:
+        string += f"""    Coarsened:
+      Factor: {opts.coarsen.factor}
+      Fields: {opts.coarsen.fields}
+      Area Weighted: {opts.coarsen.weighted}\n"""
+
+    if opts.reduction is not None:
+        string += f"""    Reduced:
+      Method: {opts.reduction.method}
+      Fields: {opts.reduction.fields}
+      Area Weighted: {opts.reduction.weighted}\n"""
 
     return string
 
@@ -137,11 +165,12 @@ def construct_hmi_dataset_era5(
 def post_hmi_dataset(hmi_dataset: HMIDataset, filepath: str) -> str:
     terarium_auth = (default_settings.terarium_user, default_settings.terarium_pass)
 
-    req = requests.post(
-        f"{default_settings.terarium_url}/datasets",
-        json=hmi_dataset,
-        auth=terarium_auth,
-    )
+    with span("terarium.create", kind=CLIENT):
+        req = get_http_session().post(
+            f"{default_settings.terarium_url}/datasets",
+            json=hmi_dataset,
+            auth=terarium_auth,
+        )
 
     if req.status_code != 201:
         raise Exception(
@@ -155,13 +184,14 @@ def post_hmi_dataset(hmi_dataset: HMIDataset, filepath: str) -> str:
 
     ds_url = f"{default_settings.terarium_url}/datasets/{hmi_id}/upload-file"
     encoder = MultipartEncoder(fields={"file": ("filename", open(filepath, "rb"))})
-    req = requests.put(
-        ds_url,
-        data=encoder,
-        params={"filename": filepath},
-        headers={"Content-Type": encoder.content_type},
-        auth=terarium_auth,
-    )
+    with span("terarium.upload", kind=CLIENT, bytes=os.path.getsize(filepath)):
+        req = get_http_session().put(
+            ds_url,
+            data=encoder,
+            params={"filename": filepath},
+            headers={"Content-Type": encoder.content_type},
+            auth=terarium_auth,
+        )
     if req.status_code != 200:
         raise Exception(f"failed to upload file: {ds_url}: {req.status_code}")
 
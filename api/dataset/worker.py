@@ -0,0 +1,129 @@
+import contextvars
+import gc
+import os
+import resource
+import signal
+from rq import SimpleWorker, Worker
+from rq.job import Job, JobStatus
+from rq.queue import Queue
+from api.dataset.job_queue import (
+    TERMINAL_STATUSES,
+    publish_job_event,
+    release_user_slot,
+    shard_progress,
+)
+from api.dataset.preload import preload
+from api.dataset.profiling import profiled
+from api.metrics import JOBS, job_function, job_provider
+from api.settings import default_settings
+from api.tracing import job_span
+
+# rq worker class that publishes job state changes for job event streams. run workers with
+# `rq worker-pool -w api.dataset.worker.JobEventWorker ...`
+#
+# workers preload job modules and shared resources before forking work horses, and quit after
+# worker_max_jobs jobs - `rq worker-pool` starts a fresh one in their place.
+# `-w api.dataset.worker.PersistentWorker` runs jobs in the worker process instead of a forked
+# horse, so the HTTP session pool, grid indexes, regridding weights and the preview renderer
+# stay warm from one job to the next. each job runs in a fresh context, and the worker is
+# replaced once its resident memory passes worker_max_memory_bytes, so leaks don't build up.
+#
+# canceled jobs (api.dataset.job_queue.cancel_job) are stopped with rq's stop-job command:
+# a forking worker kills the work horse, a persistent worker interrupts the job with
+# JOB_CANCEL_SIGNAL. either way the worker records the job as stopped and takes the next one.
+
+JOB_CANCEL_SIGNAL = signal.SIGUSR1
+
+
+class JobCancelled(BaseException):
+    # not an Exception - jobs catching their own errors don't swallow it
+    pass
+
+
+def resident_memory_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak rather than current, where /proc isn't available (kilobytes on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class JobEventWorker(Worker):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._performing_job_id: str | None = None
+        preload()
+
+    def work(self, *args, **kwargs) -> bool:
+        if kwargs.get("max_jobs") is None and default_settings.worker_max_jobs > 0:
+            kwargs["max_jobs"] = default_settings.worker_max_jobs
+        return super().work(*args, **kwargs)
+
+    def perform_job(self, job: Job, queue: Queue) -> bool:
+        publish_job_event(self.connection, job.id, "started")
+        self._performing_job_id = job.id
+        try:
+            with job_span(job), profiled(job, self.connection):
+                return super().perform_job(job, queue)
+        finally:
+            self._performing_job_id = None
+            self.job_ended(job)
+
+    def handle_job_failure(self, job: Job, queue: Queue, *args, **kwargs):
+        super().handle_job_failure(job, queue, *args, **kwargs)
+        if self._performing_job_id != job.id:
+            # the work horse was killed (stopped, out of memory) before it could report
+            self.job_ended(job)
+
+    def job_ended(self, job: Job):
+        # published after rq has stored the outcome, so it can be read right away
+        status = JobStatus(job.get_status(refresh=True)).value
+        publish_job_event(self.connection, job.id, status)
+        JOBS.labels(
+            job_provider(job.func_name), job_function(job.func_name), status
+        ).inc()
+        if status in TERMINAL_STATUSES:
+            release_user_slot(job, self.connection)
+        parent_id = job.meta.get("parent_job_id", None)
+        if parent_id is not None:
+            try:
+                parent = Job.fetch(parent_id, connection=self.connection)
+                publish_job_event(
+                    self.connection,
+                    parent_id,
+                    JobStatus(parent.get_status()).value,
+                    shard_progress(parent, self.connection),
+                )
+            except Exception as e:
+                print(f"failed to publish progress of {parent_id}: {e}", flush=True)
+
+
+class PersistentWorker(JobEventWorker):
+    get_heartbeat_ttl = SimpleWorker.get_heartbeat_ttl
+
+    def execute_job(self, job: Job, queue: Queue):
+        previous = signal.signal(JOB_CANCEL_SIGNAL, self.cancel_running_job)
+        try:
+            # a fresh context per job - context variables (progress, spans) don't leak across jobs
+            contextvars.Context().run(SimpleWorker.execute_job, self, job, queue)
+        finally:
+            signal.signal(JOB_CANCEL_SIGNAL, previous)
+        gc.collect()
+        limit = default_settings.worker_max_memory_bytes
+        if limit > 0 and resident_memory_bytes() > limit:
+            self.log.info(
+                "Worker %s: resident memory over %d bytes, quitting", self.name, limit
+            )
+            self._stop_requested = True
+
+    def cancel_running_job(self, signum, frame):
+        # rq records a job failing with the stopped job's id as stopped
+        if self._stopped_job_id is not None and self._performing_job_id is not None:
+            raise JobCancelled(f"job {self._performing_job_id} canceled")
+
+    def kill_horse(self, sig: signal.Signals = signal.SIGKILL):
+        # there is no horse - interrupt the job running in this process instead. called from
+        # the command listener thread, handled in the main thread
+        if self._performing_job_id is not None:
+            os.kill(os.getpid(), JOB_CANCEL_SIGNAL)
@@ -0,0 +1,294 @@
+import contextvars
+import functools
+import glob
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.mmap_dict import MmapedDict
+from prometheus_client.core import GaugeMetricFamily
+from api.settings import default_settings
+
+# prometheus metrics for the search, subset and preview hot paths. the API serves them on
+# /metrics; rq workers fork a process per job, so they record metrics in prometheus
+# multiprocess mode (PROMETHEUS_MULTIPROC_DIR) and `python -m api.metrics` exports them.
+# every job process leaves a file per metric type behind - the exporter merges the files of
+# exited processes into one archive file per type, so scrapes and disk use don't grow with
+# every job.
+#
+# labels: provider (esgf / era5), stage (job stage, see api.dataset.progress) and node
+# (ESGF search node or data node / mirror).
+
+# seconds - from a cached search to a multi hour subset
+LATENCY_BUCKETS = (
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+    1800,
+    3600,
+)
+
+SEARCH_SECONDS = Histogram(
+    "climate_data_search_seconds",
+    "end to end search latency",
+    ["provider"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENAI_SECONDS = Histogram(
+    "climate_data_openai_request_seconds",
+    "latency of OpenAI chat and embedding requests",
+    ["provider", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+SEARCH_EMBEDDING_CALLS = Histogram(
+    "climate_data_search_embedding_calls",
+    "embedding requests made by one search",
+    ["provider"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100),
+)
+UPSTREAM_SEARCH_SECONDS = Histogram(
+    "climate_data_upstream_search_seconds",
+    "latency of ESGF Solr search requests",
+    ["provider", "node", "query"],
+    buckets=LATENCY_BUCKETS,
+)
+EMBEDDING_CALLS = Counter(
+    "climate_data_embedding_calls",
+    "OpenAI embedding requests",
+    ["provider"],
+)
+JOB_STAGE_SECONDS = Histogram(
+    "climate_data_job_stage_seconds",
+    "duration of job stages",
+    ["provider", "stage", "node"],
+    buckets=LATENCY_BUCKETS,
+)
+JOB_STAGE_BYTES = Counter(
+    "climate_data_job_stage_bytes",
+    "bytes read, written and uploaded by job stages",
+    ["provider", "stage", "node", "direction"],
+)
+JOBS = Counter(
+    "climate_data_jobs",
+    "jobs run by workers, by final status",
+    ["provider", "function", "status"],
+)
+PREVIEW_FRAME_SECONDS = Histogram(
+    "climate_data_preview_frame_render_seconds",
+    "render time per preview frame, loading included",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+# counters recorded by job stages, by direction
+STAGE_BYTE_COUNTERS = {
+    "bytes_read": "read",
+    "bytes_written": "written",
+    "bytes_uploaded": "uploaded",
+}
+
+# embedding requests of the search running in this context - see count_embedding_calls
+_search_embedding_calls: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "search_embedding_calls", default=None
+)
+
+
+@contextmanager
+def count_embedding_calls(provider: str):
+    """
+    observes the number of embedding requests made within the block as one search.
+    """
+    calls = [0]
+    token = _search_embedding_calls.set(calls)
+    try:
+        yield
+    finally:
+        _search_embedding_calls.reset(token)
+        SEARCH_EMBEDDING_CALLS.labels(provider).observe(calls[0])
+
+
+def embedding_called(provider: str):
+    EMBEDDING_CALLS.labels(provider).inc()
+    calls = _search_embedding_calls.get()
+    if calls is not None:
+        calls[0] += 1
+
+
+def in_context(func):
+    """
+    runs func in (a copy of) the context it was wrapped in, so work fanned out over threads
+    still counts towards its search and stays in its trace.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def job_provider(func_name: str | None) -> str:
+    return "era5" if func_name is not None and "era5" in func_name else "esgf"
+
+
+def job_function(func_name: str | None) -> str:
+    return (func_name or "").split(".")[-1]
+
+
+def observe_stage(func_name: str | None, entry: dict, node: str):
+    """
+    metrics of a finished job stage (an entry of job.meta["stages"]).
+    """
+    labels = {
+        "provider": job_provider(func_name),
+        "stage": entry["stage"],
+        "node": node,
+    }
+    JOB_STAGE_SECONDS.labels(**labels).observe(entry.get("seconds", 0))
+    for counter, direction in STAGE_BYTE_COUNTERS.items():
+        if counter in entry:
+            JOB_STAGE_BYTES.labels(**labels, direction=direction).inc(entry[counter])
+
+
+class QueueCollector:
+    """
+    queue depth and in-flight jobs per rq queue, read from redis at scrape time.
+    """
+
+    def collect(self):
+        from rq import Queue
+        from api.dataset.job_queue import JOB_QUEUES, get_redis
+
+        jobs = GaugeMetricFamily(
+            "climate_data_queue_jobs",
+            "jobs per queue and state",
+            labels=["queue", "state"],
+        )
+        redis = get_redis()
+        for name in JOB_QUEUES:
+            queue = Queue(name, connection=redis)
+            jobs.add_metric([name, "queued"], queue.count)
+            jobs.add_metric([name, "started"], queue.started_job_registry.count)
+            jobs.add_metric([name, "deferred"], queue.deferred_job_registry.count)
+            jobs.add_metric([name, "scheduled"], queue.scheduled_job_registry.count)
+            jobs.add_metric([name, "failed"], queue.failed_job_registry.count)
+        yield jobs
+
+
+# seconds between merges of exited processes' metric files
+METRICS_COMPACT_INTERVAL = 60
+
+# multiprocess metric types merged by summing - counters and histogram buckets
+COMPACTED_METRIC_TYPES = ["counter", "histogram"]
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def compact_metrics(path: str):
+    """
+    merges the metric files of exited processes into `<type>_archive.db` and removes them.
+    scrapes must not read the directory meanwhile, or the merged values are counted twice.
+    """
+    for typ in COMPACTED_METRIC_TYPES:
+        dead = []
+        for f in glob.glob(os.path.join(path, f"{typ}_*.db")):
+            pid = os.path.basename(f)[len(typ) + 1 : -len(".db")]
+            if pid.isdigit() and not process_alive(int(pid)):
+                dead.append(f)
+        if not dead:
+            continue
+        archive = os.path.join(path, f"{typ}_archive.db")
+        # merged into a copy, so an interrupted merge leaves the archive as it was
+        temp = f"{archive}.tmp"
+        if os.path.exists(archive):
+            shutil.copyfile(archive, temp)
+        elif os.path.exists(temp):
+            os.remove(temp)
+        merged = MmapedDict(temp)
+        for f in dead:
+            for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(f):
+                current, _ = merged.read_value(key)
+                merged.write_value(key, current + value, timestamp)
+        merged.close()
+        os.replace(temp, archive)
+        for f in dead:
+            os.remove(f)
+
+
+class LockedCollector:
+    """
+    a collector that doesn't run while `lock` is held - scrapes wait for compaction.
+    """
+
+    def __init__(self, collector, lock: threading.Lock):
+        self.collector = collector
+        self.lock = lock
+
+    def collect(self):
+        with self.lock:
+            return list(self.collector.collect())
+
+
+def multiprocess_registry() -> CollectorRegistry:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_response() -> tuple[bytes, str]:
+    """
+    exposition of this process' metrics (every process' in multiprocess mode) and the queues.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = multiprocess_registry()
+    else:
+        registry = REGISTRY
+    queues = CollectorRegistry()
+    queues.register(QueueCollector())
+    return (generate_latest(registry) + generate_latest(queues), CONTENT_TYPE_LATEST)
+
+
+if __name__ == "__main__":
+    # worker exporter - run next to the rq workers, with the same PROMETHEUS_MULTIPROC_DIR
+    port = default_settings.worker_metrics_port
+    lock = threading.Lock()
+    registry = CollectorRegistry()
+    registry.register(LockedCollector(multiprocess.MultiProcessCollector(None), lock))
+    start_http_server(port, registry=registry)
+    print(f"exporting worker metrics on :{port}", flush=True)
+    while True:
+        time.sleep(METRICS_COMPACT_INTERVAL)
+        with lock:
+            try:
+                compact_metrics(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+            except Exception as e:
+                print(f"failed to compact worker metrics: {e}", flush=True)
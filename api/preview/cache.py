@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, Iterator
+from api.settings import default_settings
+
+# rendered preview frames keyed by dataset identity, variable, frame time and render settings.
+# frames live in a size-capped LRU directory on local disk and, when enabled, in the object
+# store bucket so they are shared between workers. the local directory is the fallback
+# when the object store is disabled or unreachable.
+
+PREVIEW_PREFIX = "previews"
+
+# frames are served by the name of their key, without the prefix
+FRAME_NAME = re.compile(r"^[0-9a-f]{40}\.png$")
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def frame_key(
+    dataset_id: str,
+    variable: str,
+    frame: Any,
+    settings: Dict[str, Any],
+    extension: str = "png",
+) -> str:
+    """
+    dataset_id should be versioned (ESGF ID with version, or a Terarium HMI UUID) - frames of
+    different dataset versions must not collide.
+    """
+    canonical = json.dumps(
+        [dataset_id.split("|")[0], variable, str(frame), settings],
+        sort_keys=True,
+        default=str,
+    )
+    return (
+        f"{PREVIEW_PREFIX}/{hashlib.sha1(canonical.encode()).hexdigest()}.{extension}"
+    )
+
+
+class LocalPreviewStore:
+    """
+    least recently used files in a directory, evicted once the total size is over `max_bytes`.
+    recency is tracked through file modification times so it survives restarts.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(
+            os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory)
+        )
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key.replace("/", "_"))
+
+    def get(self, key: str) -> bytes | None:
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+            return content
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key: str) -> bool:
+        path = self.path(key)
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stream(self, key: str) -> Iterator[bytes] | None:
+        path = self.path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        os.utime(path)
+
+        def chunks():
+            with f:
+                while chunk := f.read(STREAM_CHUNK_BYTES):
+                    yield chunk
+
+        return chunks()
+
+    def put(self, key: str, content: bytes):
+        path = self.path(key)
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(content)
+        os.replace(temp, path)
+        with self.lock:
+            self.size += len(content)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory)]
+        files.sort(key=lambda f: os.path.getmtime(f) if os.path.exists(f) else 0)
+        self.size = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+        # evict down to 90% so the next few writes don't trigger another scan
+        while files and self.size > self.max_bytes * 0.9:
+            f = files.pop(0)
+            try:
+                size = os.path.getsize(f)
+                os.remove(f)
+                self.size -= size
+            except FileNotFoundError:
+                continue
+
+
+class ObjectPreviewStore:
+    def __init__(self):
+        from api.dataset.storage import initialize_client
+
+        self.client = initialize_client()
+        self.bucket = default_settings.bucket_name
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def stream(self, key: str) -> Iterator[bytes] | None:
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return body.iter_chunks(STREAM_CHUNK_BYTES)
+
+    def put(self, key: str, content: bytes):
+        self.client.put_object(
+            Bucket=self.bucket, Key=key, Body=content, ContentType="image/png"
+        )
+
+
+class PreviewCache:
+    def __init__(self):
+        self.local = LocalPreviewStore(
+            default_settings.preview_cache_dir,
+            default_settings.preview_cache_max_bytes,
+        )
+        self.remote: ObjectPreviewStore | None = None
+        if default_settings.preview_cache_object_store:
+            try:
+                self.remote = ObjectPreviewStore()
+            except Exception as e:
+                print(f"object store unavailable, caching previews locally: {e}")
+
+    def get(self, key: str) -> bytes | None:
+        content = self.local.get(key)
+        if content is not None or self.remote is None:
+            return content
+        try:
+            content = self.remote.get(key)
+        except Exception as e:
+            print(f"failed to read cached preview {key}: {e}", flush=True)
+            return None
+        if content is not None:
+            self.local.put(key, content)
+        return content
+
+    def exists(self, key: str) -> bool:
+        if self.local.exists(key):
+            return True
+        if self.remote is None:
+            return False
+        try:
+            return self.remote.exists(key)
+        except Exception as e:
+            print(f"failed to check cached preview {key}: {e}", flush=True)
+            return False
+
+    def stream(self, key: str) -> Iterator[bytes] | None:
+        """
+        content of a cached frame in chunks, without loading it whole - local copies first.
+        """
+        chunks = self.local.stream(key)
+        if chunks is not None or self.remote is None:
+            return chunks
+        try:
+            return self.remote.stream(key)
+        except Exception as e:
+            print(f"failed to read cached preview {key}: {e}", flush=True)
+            return None
+
+    def put(self, key: str, content: bytes):
+        self.local.put(key, content)
+        if self.remote is not None:
+            try:
+                self.remote.put(key, content)
+            except Exception as e:
+                print(f"failed to store preview {key}: {e}", flush=True)
+
+
+_preview_cache: PreviewCache | None = None
+
+
+def get_preview_cache() -> PreviewCache:
+    global _preview_cache
+    if _preview_cache is None:
+        _preview_cache = PreviewCache()
+    return _preview_cache
+
+
+def frame_name(key: str) -> str:
+    return key.split("/")[-1]
+
+
+def frame_key_from_name(name: str) -> str | None:
+    return f"{PREVIEW_PREFIX}/{name}" if FRAME_NAME.match(name) else None
@@ -1,11 +1,22 @@
-import datetime
 import io
 import base64
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from typing import Any
+import json
+import uuid
+import time
+import dask
+import numpy
 from api.search.provider import AccessURLs
 import cartopy.crs as ccrs
 import xarray
 from api.dataset.metadata import extract_esgf_specific_fields, extract_metadata
+from api.preview.cache import frame_key, frame_name, get_preview_cache
+from api.dataset.profiling import profiling_active
+from api.dataset.progress import record, stage
+from api.metrics import PREVIEW_FRAME_SECONDS
+from api.settings import default_settings
 from matplotlib import pyplot as plt
 from api.dataset.remote import (
     cleanup_potential_artifacts,
@@ -13,6 +24,20 @@ from api.dataset.remote import (
     open_remote_dataset_hmi,
 )
 
+# part of every cached frame's key - change when rendering changes to invalidate cached frames
+RENDER_SETTINGS = {
+    "projection": "PlateCarree",
+    "coastlines": True,
+    "figsize": [6.4, 4.8],
+    "dpi": 100,
+    "version": 3,
+}
+
+FRAME_PERIODS = ["year", "season", "month"]
+
+# frames sampled to pick the shared color scale of a preview
+COLOR_LIMIT_SAMPLES = 8
+
 
 def buffer_to_b64_png(buffer: io.BytesIO) -> str:
     buffer.seek(0)
@@ -21,6 +46,250 @@ def buffer_to_b64_png(buffer: io.BytesIO) -> str:
     return f"data:image/png;base64,{payload}"
 
 
+def frame_label(data: xarray.DataArray) -> str:
+    name = data.attrs.get("long_name", data.attrs.get("standard_name", data.name))
+    units = data.attrs.get("units", "")
+    return f"{name} [{units}]" if units != "" else str(name)
+
+
+def frame_title(data: xarray.DataArray) -> str:
+    return ", ".join(
+        f"{c} = {data[c].values.item()}" for c in data.coords if data[c].ndim == 0
+    )
+
+
+def extract_frame(data: xarray.DataArray, x: str, y: str) -> dict[str, Any]:
+    """
+    a loaded frame as plain numpy arrays - cheap to pickle over to the render processes.
+    """
+    data = data.transpose(y, x)
+    return {
+        "values": data.values,
+        "x": data[x].values,
+        "y": data[y].values,
+        "title": frame_title(data),
+    }
+
+
+class FrameRenderer:
+    """
+    draws frames of one dataset variable into a single figure. the axes, colorbar and a
+    rasterized coastline overlay are drawn once; each frame only redraws the mesh and title
+    over the saved background and composites the coastlines on top.
+    """
+
+    def __init__(self, frame: dict[str, Any], style: dict[str, Any]):
+        self.fig, self.ax = plt.subplots(
+            figsize=RENDER_SETTINGS["figsize"],
+            dpi=RENDER_SETTINGS["dpi"],
+            subplot_kw={"projection": ccrs.PlateCarree()},
+        )
+        before = list(self.ax.collections)
+        self.mesh = self.ax.pcolormesh(
+            frame["x"],
+            frame["y"],
+            frame["values"],
+            transform=ccrs.PlateCarree(),
+            vmin=style["vmin"],
+            vmax=style["vmax"],
+            shading="auto",
+        )
+        # cells across the antimeridian are drawn by a separate collection, which follows the
+        # mesh's data but has to be redrawn with it on every frame
+        self.meshes = [c for c in self.ax.collections if c not in before]
+        self.fig.colorbar(self.mesh, ax=self.ax, label=style["label"])
+        self.title = self.ax.set_title(frame["title"])
+        coastlines = self.ax.coastlines()
+        canvas = self.fig.canvas
+        canvas.draw()
+        # pin the title where it was laid out, it is re-laid out on draws with hidden artists
+        self.title = self.ax.set_title(frame["title"], y=self.title.get_position()[1])
+
+        # coastlines alone on a transparent figure
+        visible = {a: a.get_visible() for a in self.fig.findobj()}
+        for artist in visible:
+            artist.set_visible(False)
+        for artist in [self.fig, self.ax, coastlines]:
+            artist.set_visible(True)
+        self.fig.patch.set_visible(False)
+        self.ax.patch.set_visible(False)
+        self.ax.spines["geo"].set_visible(False)
+        canvas.draw()
+        self.coastlines = numpy.asarray(canvas.buffer_rgba()).astype(numpy.float32)
+        for artist, v in visible.items():
+            artist.set_visible(v)
+
+        # everything that doesn't change between frames
+        coastlines.set_visible(False)
+        for artist in self.meshes + [self.title]:
+            artist.set_visible(False)
+        canvas.draw()
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.meshes + [self.title]:
+            artist.set_visible(True)
+
+    def render(self, frame: dict[str, Any]) -> bytes:
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        self.mesh.set_array(frame["values"])
+        self.title.set_text(frame["title"])
+        for artist in self.meshes + [self.title]:
+            self.ax.draw_artist(artist)
+        image = numpy.asarray(canvas.buffer_rgba()).astype(numpy.float32)
+        alpha = self.coastlines[..., 3:] / 255
+        image[..., :3] = image[..., :3] * (1 - alpha) + self.coastlines[..., :3] * alpha
+        buffer = io.BytesIO()
+        plt.imsave(buffer, image.astype(numpy.uint8), format="png")
+        return buffer.getvalue()
+
+    def close(self):
+        plt.close(self.fig)
+
+
+# one renderer per process, reused while frames share a grid and style
+_renderer: tuple[Any, FrameRenderer] | None = None
+
+
+def plot_frame(frame: dict[str, Any], style: dict[str, Any]) -> bytes:
+    global _renderer
+    signature = (
+        frame["x"].tobytes(),
+        frame["y"].tobytes(),
+        frame["values"].shape,
+        tuple(sorted(style.items())),
+    )
+    if _renderer is None or _renderer[0] != signature:
+        if _renderer is not None:
+            _renderer[1].close()
+        _renderer = (signature, FrameRenderer(frame, style))
+    return _renderer[1].render(frame)
+
+
+def color_limits(frames: list[xarray.DataArray]) -> tuple[float, float]:
+    """
+    robust color limits from up to COLOR_LIMIT_SAMPLES evenly spaced frames, so every frame
+    shares one color scale.
+    """
+    step = max(1, len(frames) // COLOR_LIMIT_SAMPLES)
+    sample = numpy.concatenate(
+        [numpy.ravel(f) for f in dask.compute(*frames[::step])]
+    ).astype(numpy.float64)
+    sample = sample[numpy.isfinite(sample)]
+    if len(sample) == 0:
+        return (0.0, 1.0)
+    vmin, vmax = numpy.percentile(sample, [2, 98])
+    if vmin == vmax:
+        vmin, vmax = vmin - 0.5, vmax + 0.5
+    return (float(vmin), float(vmax))
+
+
+def dataset_axes(ds: xarray.Dataset) -> dict[str, str]:
+    """
+    variables by their CF axis attribute (X, Y, Z, T).
+    """
+    axes = {}
+    for v in ds.variables.keys():
+        if "axis" in ds[v].attrs:
+            axes[ds[v].attrs["axis"]] = v
+    return axes
+
+
+def decimate(data: xarray.DataArray, x: str, y: str) -> xarray.DataArray:
+    """
+    strides the x and y dimensions down to about one cell per output pixel. the stride is
+    lazy, so for remote datasets only the strided cells are requested upstream.
+    """
+    width, height = (
+        int(inches * RENDER_SETTINGS["dpi"]) for inches in RENDER_SETTINGS["figsize"]
+    )
+    strides = {
+        dim: data.sizes[dim] // pixels
+        for dim, pixels in [(x, width), (y, height)]
+        if dim in data.dims and data.sizes[dim] // pixels > 1
+    }
+    if len(strides) == 0:
+        return data
+    print(f"decimating {dict(data.sizes)} by {strides}", flush=True)
+    return data.isel(
+        {dim: slice(None, None, stride) for dim, stride in strides.items()}
+    )
+
+
+def plan_frames(times: xarray.DataArray, period: str = "year") -> numpy.ndarray:
+    """
+    indices of the first timestamp of every year, season (DJF, MAM, JJA, SON) or month of a
+    sorted, duplicate free time coordinate.
+    """
+    if times.size == 0:
+        return numpy.array([], dtype=int)
+    years = times.dt.year.values
+    months = times.dt.month.values
+    if period == "year":
+        periods = years
+    elif period == "season":
+        # december belongs to the winter of the following year
+        periods = (years + (months == 12)) * 4 + (months % 12) // 3
+    elif period == "month":
+        periods = years * 12 + months
+    else:
+        raise KeyError(f"unknown frame period {period}")
+    return numpy.flatnonzero(numpy.diff(periods, prepend=periods[0] - 1) != 0)
+
+
+def frame_batches(frames: list[xarray.DataArray], memory_bytes: int):
+    """
+    groups consecutive frames so the loaded data of a batch stays under `memory_bytes`.
+    """
+    batch: list[xarray.DataArray] = []
+    size = 0
+    for frame in frames:
+        if batch and size + frame.nbytes > memory_bytes:
+            yield batch
+            batch, size = [], 0
+        batch.append(frame)
+        size += frame.nbytes
+    if batch:
+        yield batch
+
+
+def render_frames(
+    frames: list[xarray.DataArray], x: str, y: str, style: dict[str, Any]
+) -> list[bytes]:
+    """
+    renders frames to PNG, in order, over a process pool. frame data is loaded in batches
+    (one compute per batch) capped by preview_render_memory_bytes. profiled jobs render in
+    their own process, where the profiler samples them.
+    """
+    if len(frames) == 0:
+        return []
+    workers = min(default_settings.preview_render_workers, len(frames))
+    if profiling_active():
+        workers = 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    images: list[bytes] = []
+    try:
+        for batch in frame_batches(
+            frames, default_settings.preview_render_memory_bytes
+        ):
+            print(f"loading {len(batch)} frames", flush=True)
+            start = time.perf_counter()
+            loaded = dask.compute(*batch)
+            record(bytes_read=sum(frame.nbytes for frame in loaded))
+            extracted = [extract_frame(frame, x, y) for frame in loaded]
+            print(f"rendering {len(batch)} frames on {workers} processes", flush=True)
+            if executor is None:
+                images += [plot_frame(frame, style) for frame in extracted]
+            else:
+                images += list(executor.map(plot_frame, extracted, repeat(style)))
+            per_frame = (time.perf_counter() - start) / len(batch)
+            for _ in batch:
+                PREVIEW_FRAME_SECONDS.observe(per_frame)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return images
+
+
 # handles loading as to not share xarray over rq-worker boundaries
 def render_preview_for_dataset(
     dataset: AccessURLs | str,
@@ -28,17 +297,26 @@ def render_preview_for_dataset(
     time_index: str = "",
     timestamps: str = "",
     analyze: bool = False,
+    cache_id: str = "",
+    frame_period: str = "year",
     **kwargs,
 ):
+    """
+    `cache_id` is the versioned dataset ID used to cache rendered frames - terarium HMI
+    datasets are cached by their UUID.
+    """
     job_id = kwargs["job_id"]
     try:
         ds: xarray.Dataset | None = None
         extra_metadata_discovery: dict[str, Any] = {}
         # AccessURLs list or UUID str -- UUID str is terarium handle.
-        if isinstance(dataset, list):
-            ds = open_dataset(dataset, job_id)
-        elif isinstance(dataset, str):
-            ds = open_remote_dataset_hmi(dataset, job_id)
+        with stage("open"):
+            if isinstance(dataset, list):
+                ds = open_dataset(dataset, job_id)
+            elif isinstance(dataset, str):
+                cache_id = dataset
+                ds = open_remote_dataset_hmi(dataset, job_id)
+        if isinstance(dataset, str):
             if analyze:
                 print("attempting to extract more information", flush=True)
                 ds_metadata = extract_metadata(ds) | extract_esgf_specific_fields(ds)
@@ -49,8 +327,21 @@ def render_preview_for_dataset(
                 return {
                     "error": f"invalid timestamps '{timestamps}'. ensure it is two timestamps, comma separated"
                 }
+        if frame_period not in FRAME_PERIODS:
+            return {
+                "error": f"invalid frame_period '{frame_period}'. must be one of {', '.join(FRAME_PERIODS)}"
+            }
         try:
-            png = render(ds, variable_index, time_index, timestamps)
+            with stage("render"):
+                png = render(
+                    ds,
+                    variable_index,
+                    time_index,
+                    timestamps,
+                    cache_id,
+                    frame_period,
+                    inline=default_settings.preview_inline_images,
+                )
         except KeyError as e:
             return {"error": f"{e}"}
         cleanup_potential_artifacts(job_id)
@@ -64,13 +355,20 @@ def render(
     variable_index: str = "",
     time_index: str = "",
     timestamps: str = "",
+    cache_id: str = "",
+    frame_period: str = "year",
+    inline: bool = True,
     **kwargs,
 ) -> list[dict[str, str]]:
-    axes = {}
+    """
+    renders a preview frame per year (or month or season, see `frame_period`). with a
+    `cache_id`, frames already in the preview cache are reused and only missing frames are
+    loaded and rendered.
 
-    for v in ds.variables.keys():
-        if "axis" in ds[v].attrs:
-            axes[ds[v].attrs["axis"]] = v
+    `inline` frames are returned as base64 data URLs. otherwise frames are kept in the preview
+    cache and returned as keys and /preview/image URLs, which keeps job results small.
+    """
+    axes = dataset_axes(ds)
     if variable_index == "":
         variable_index = ds.attrs.get("variable_id", "")
     if time_index == "":
@@ -82,10 +380,13 @@ def render(
             else:
                 raise IOError("Dataset has no time axis, please provide time index")
 
-    # fix nonmonotonic time series without changing original data
-    print("cleaning up duplicates...", flush=True)
-    ds = ds.drop_duplicates(time_index, keep="first")
-    print("cleaned up duplicates.", flush=True)
+    # the time coordinate is loaded once - duplicates are dropped and nonmonotonic series are
+    # sorted by selecting the first index of every unique timestamp, without reading any data
+    times = ds[time_index].values
+    _, unique = numpy.unique(times, return_index=True)
+    if len(unique) != len(times) or numpy.any(numpy.diff(unique) < 0):
+        print(f"dropping {len(times) - len(unique)} duplicate timestamps", flush=True)
+        ds = ds.isel({time_index: unique})
 
     if timestamps == "":
         ds = ds.sel({time_index: ds[time_index][0]})
@@ -109,58 +410,65 @@ def render(
             )
 
     ds = ds[variable_index]  # type: ignore
+    ds = decimate(ds, axes["X"], axes["Y"])
 
-    preview_buffers: list[tuple[str, io.BytesIO]] = []
-
-    def make_plot(data: xarray.Dataset) -> io.BytesIO:
-        fig, ax = plt.subplots(subplot_kw={"projection": ccrs.PlateCarree()})
-        data.plot(
-            ax=ax,
-            transform=ccrs.PlateCarree(),
-            x=axes["X"],
-            y=axes["Y"],
-            add_colorbar=True,
-        )
-        ax.coastlines()
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format="png")
-        plt.close()
-        return buffer
-
-    if axes["T"] in ds.dims:
-        # get delta of first two elements to see if it's yearly / monthly / daily
-        delta = ds[axes["T"]][1].item() - ds[axes["T"]][0].item()
-        steps = 0
-        if delta > datetime.timedelta(days=32):
-            steps = 1
-        elif delta > datetime.timedelta(days=1):
-            steps = 12
-        else:
-            steps = 365
-
-        leap_offset = 0
-        last_year = 0
-        # skip by frequency such that index points to head of year
-        for time_i in range(0, len(ds[axes["T"]]), steps):
-            # handle leap years
-            index = time_i + leap_offset
-            if index >= len(ds[axes["T"]]):
-                break
-            year_check = ds.isel({axes["T"]: index})[axes["T"]].item().year
-            if year_check == last_year:
-                leap_offset += 1
-                index += 1
-
-            data = ds.isel({axes["T"]: index})
-            date = data[axes["T"]].item()
-            print(f"rendering: {date}", flush=True)
-            last_year = date.year
-            preview_buffers.append((date.year, make_plot(data)))
+    frames: list[tuple[Any, xarray.DataArray]] = []
+    if time_index in ds.dims:
+        times = ds[time_index].values
+        for i in plan_frames(ds[time_index], frame_period):
+            frames.append((times[i], ds.isel({time_index: i})))
     else:
         # single element rather than list
-        year = ds[axes["T"]].item().year
-        print(f"rendering: {year}:", flush=True)
-        preview_buffers.append((year, make_plot(ds)))
-    renders = [{"year": y, "image": buffer_to_b64_png(b)} for (y, b) in preview_buffers]
+        frames.append((ds[time_index].item(), ds))
+
+    if cache_id == "" and not inline:
+        # stored frames need keys, unique so nothing is reused
+        cache_id = f"uncached-{uuid.uuid4()}"
+    cache = get_preview_cache() if cache_id != "" else None
+    settings = RENDER_SETTINGS | {"time_index": time_index}
+
+    # the color scale is stored per dataset and variable, and is part of every frame's key - if
+    # the stored scale is evicted and picked again differently, no frame drawn with the old
+    # scale is reused next to frames drawn with the new one
+    limits_key = frame_key(cache_id, variable_index, "color-limits", settings, "json")
+    limits = cache.get(limits_key) if cache is not None else None
+    if limits is not None:
+        vmin, vmax = json.loads(limits)
+    else:
+        vmin, vmax = color_limits([frame for _, frame in frames])
+        if cache is not None:
+            cache.put(limits_key, json.dumps([vmin, vmax]).encode())
+    settings |= {"color_limits": [vmin, vmax]}
+
+    keys = [frame_key(cache_id, variable_index, date, settings) for date, _ in frames]
+    images: list[bytes | None] = [None] * len(frames)
+    if cache is not None and inline:
+        images = [cache.get(key) for key in keys]
+        missing = [i for i, image in enumerate(images) if image is None]
+    elif cache is not None:
+        missing = [i for i, key in enumerate(keys) if not cache.exists(key)]
+    else:
+        missing = list(range(len(frames)))
+    print(f"{len(frames) - len(missing)} cached frames", flush=True)
+    style = {"vmin": vmin, "vmax": vmax, "label": frame_label(ds)}
+
+    rendered = render_frames(
+        [frames[i][1] for i in missing], axes["X"], axes["Y"], style
+    )
+    record(frames=len(missing), cached_frames=len(frames) - len(missing))
+    for i, image in zip(missing, rendered):
+        images[i] = image
+        if cache is not None:
+            cache.put(keys[i], image)
+
+    renders = []
+    for (date, _), key, image in zip(frames, keys, images):
+        frame = {"year": date.year, "time": date.isoformat()}
+        if inline:
+            frame["image"] = buffer_to_b64_png(io.BytesIO(image))  # type: ignore
+        else:
+            frame["image"] = f"/preview/image/{frame_name(key)}"
+            frame["key"] = key
+        renders.append(frame)
     print(f"created {len(renders)} previews", flush=True)
     return renders
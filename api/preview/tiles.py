@@ -0,0 +1,282 @@
+import io
+import json
+import math
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Tuple
+import numpy
+import xarray
+from matplotlib import colormaps, colors
+from matplotlib import image as mpimage
+from api.preview.cache import frame_key, get_preview_cache
+from api.preview.render import color_limits, dataset_axes, decimate
+from api.processing.grid_index import LATITUDE_NAMES, LONGITUDE_NAMES
+from api.settings import default_settings
+
+# XYZ (web mercator) map tiles rendered on demand. datasets are opened once and kept warm in
+# the serving process; each tile reads only the strided grid window under it and is colored
+# with limits shared by every tile of the dataset variable, so neighbouring tiles match.
+# rendered tiles go through the preview cache.
+
+TILE_SIZE = 256
+
+# part of every cached tile's key - change when tile rendering changes
+TILE_SETTINGS = {"size": TILE_SIZE, "colormap": "viridis", "version": 1}
+
+
+class WarmDatasets:
+    """
+    least recently used opened datasets, at most `max_datasets` at a time.
+    """
+
+    def __init__(self, max_datasets: int):
+        self.max_datasets = max_datasets
+        self.datasets: OrderedDict[str, xarray.Dataset] = OrderedDict()
+        self.limits: dict[Tuple[str, str], Tuple[float, float]] = {}
+        # one per dataset variable, held while its limits are computed
+        self.limit_locks: dict[Tuple[str, str], threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str, open: Callable[[], xarray.Dataset]) -> xarray.Dataset:
+        with self.lock:
+            if key in self.datasets:
+                self.datasets.move_to_end(key)
+                return self.datasets[key]
+        print(f"opening {key} for tiles", flush=True)
+        ds = open()
+        with self.lock:
+            self.datasets[key] = ds
+            while len(self.datasets) > self.max_datasets:
+                evicted, _ = self.datasets.popitem(last=False)
+                self.limits = {k: v for k, v in self.limits.items() if k[0] != evicted}
+                self.limit_locks = {
+                    k: v for k, v in self.limit_locks.items() if k[0] != evicted
+                }
+        return ds
+
+
+_warm_datasets: WarmDatasets | None = None
+
+
+def get_warm_datasets() -> WarmDatasets:
+    global _warm_datasets
+    if _warm_datasets is None:
+        _warm_datasets = WarmDatasets(default_settings.tile_warm_datasets)
+    return _warm_datasets
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    west, south, east, north of a web mercator tile in degrees.
+    """
+    n = 2**z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return (west, south, east, north)
+
+
+def pixel_centers(z: int, x: int, y: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    longitudes of the pixel columns and latitudes of the pixel rows of a tile.
+    """
+    n = 2**z
+    offsets = (numpy.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lons = (x + offsets) / n * 360 - 180
+    lats = numpy.degrees(
+        numpy.arctan(numpy.sinh(numpy.pi * (1 - 2 * (y + offsets) / n)))
+    )
+    return (lons, lats)
+
+
+def nearest_indices(coords: numpy.ndarray, targets: numpy.ndarray) -> numpy.ndarray:
+    """
+    index of the closest coordinate to each target, -1 for targets more than half a cell
+    outside the coordinates.
+    """
+    order = numpy.argsort(coords)
+    ordered = coords[order]
+    right = numpy.clip(numpy.searchsorted(ordered, targets), 1, len(ordered) - 1)
+    left = right - 1
+    closest = numpy.where(
+        numpy.abs(targets - ordered[left]) <= numpy.abs(ordered[right] - targets),
+        left,
+        right,
+    )
+    half_cell = numpy.abs(numpy.diff(ordered)).max() / 2 if len(ordered) > 1 else 0.5
+    outside = (targets < ordered[0] - half_cell) | (targets > ordered[-1] + half_cell)
+    return numpy.where(outside, -1, order[closest])
+
+
+def strided_runs(indices: numpy.ndarray) -> List[slice]:
+    """
+    sorted indices strided down to about TILE_SIZE, as slices over their contiguous runs.
+    """
+    step = max(1, len(indices) // TILE_SIZE)
+    indices = indices[::step]
+    breaks = numpy.flatnonzero(numpy.diff(indices) != step) + 1
+    return [
+        slice(int(run[0]), int(run[-1]) + 1, step)
+        for run in numpy.split(indices, breaks)
+    ]
+
+
+def unwrap(coords: numpy.ndarray, center: float, period: float = 360) -> numpy.ndarray:
+    """
+    periodic coordinates moved into the period centered on `center`.
+    """
+    return (coords - center + period / 2) % period + center - period / 2
+
+
+def window_indices(
+    coords: numpy.ndarray, low: float, high: float, period: float | None = None
+) -> numpy.ndarray:
+    """
+    indices of the coordinates within [low, high] widened by one cell. with a `period`
+    (longitudes), coordinates are wrapped into the range first.
+    """
+    if period is not None:
+        coords = unwrap(coords, (low + high) / 2, period)
+    cell = numpy.abs(numpy.diff(numpy.sort(coords))).max() if len(coords) > 1 else 0
+    return numpy.flatnonzero((coords >= low - cell) & (coords <= high + cell))
+
+
+def find_horizontal_fields(ds: xarray.Dataset) -> Tuple[str, str]:
+    axes = dataset_axes(ds)
+    x = axes.get("X", next((n for n in LONGITUDE_NAMES if n in ds.dims), None))
+    y = axes.get("Y", next((n for n in LATITUDE_NAMES if n in ds.dims), None))
+    if x is None or y is None or ds[x].ndim != 1 or ds[y].ndim != 1:
+        raise ValueError("tiles need 1-D longitude and latitude coordinates")
+    return (x, y)
+
+
+def select_time(data: xarray.DataArray, time: str) -> xarray.DataArray:
+    """
+    the first time step matching a (partial) ISO-8601 timestamp.
+    """
+    time_field = dataset_axes(data.to_dataset()).get("T", "time")
+    if time_field not in data.dims:
+        return data
+    selected = data.sel({time_field: slice(time, time)})
+    if selected.sizes[time_field] == 0:
+        raise KeyError(f"no time step matches {time}")
+    return selected.isel({time_field: 0})
+
+
+def drop_other_dims(data: xarray.DataArray, x: str, y: str) -> xarray.DataArray:
+    # levels and other extra dimensions are shortened to their first element, as in previews
+    return data.isel({d: 0 for d in data.dims if d not in (x, y)})
+
+
+def shared_limits(
+    warm: WarmDatasets, key: str, variable: str, data: xarray.DataArray, x: str, y: str
+) -> Tuple[float, float]:
+    """
+    color limits for every tile of a dataset variable, computed once from a strided global
+    read of the first time step. concurrent tiles of the variable wait for the first to compute
+    them, tiles of other variables don't.
+    """
+    with warm.lock:
+        if (key, variable) in warm.limits:
+            return warm.limits[(key, variable)]
+        guard = warm.limit_locks.setdefault((key, variable), threading.Lock())
+    with guard:
+        with warm.lock:
+            if (key, variable) in warm.limits:
+                return warm.limits[(key, variable)]
+        cache = get_preview_cache()
+        limits_key = frame_key(key, variable, "color-limits", TILE_SETTINGS, "json")
+        cached = cache.get(limits_key)
+        if cached is not None:
+            limits = tuple(json.loads(cached))
+        else:
+            sample = drop_other_dims(decimate(data, x, y), x, y)
+            limits = color_limits([sample])
+            cache.put(limits_key, json.dumps(limits).encode())
+        with warm.lock:
+            warm.limits[(key, variable)] = limits  # type: ignore
+        return limits  # type: ignore
+
+
+def read_window(
+    data: xarray.DataArray, x: str, y: str, bounds: Tuple[float, float, float, float]
+) -> xarray.DataArray:
+    """
+    loads the strided window of the grid under a tile. longitudes are returned unwrapped into
+    the tile's range.
+    """
+    west, south, east, north = bounds
+    lons = data[x].values
+    x_indices = window_indices(lons, west, east, period=360)
+    y_indices = window_indices(data[y].values, south, north)
+    if len(x_indices) == 0 or len(y_indices) == 0:
+        return data.isel({x: slice(0, 0), y: slice(0, 0)})
+    pieces = [
+        xarray.concat(
+            [data.isel({x: xs, y: ys}) for ys in strided_runs(y_indices)], dim=y
+        )
+        for xs in strided_runs(x_indices)
+    ]
+    window = xarray.concat(pieces, dim=x) if len(pieces) > 1 else pieces[0]
+    window = window.load()
+    return window.assign_coords({x: unwrap(window[x].values, (west + east) / 2)})
+
+
+def encode_tile(
+    window: xarray.DataArray,
+    x: str,
+    y: str,
+    z: int,
+    tx: int,
+    ty: int,
+    limits: Tuple[float, float],
+) -> bytes:
+    lons, lats = pixel_centers(z, tx, ty)
+    rgba = numpy.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=numpy.float32)
+    if window.size > 0:
+        window = window.transpose(y, x)
+        columns = nearest_indices(window[x].values, lons)
+        rows = nearest_indices(window[y].values, lats)
+        values = window.values[rows[:, None], columns[None, :]].astype(numpy.float64)
+        values[(rows[:, None] < 0) | (columns[None, :] < 0)] = numpy.nan
+        norm = colors.Normalize(*limits)
+        rgba = colormaps[TILE_SETTINGS["colormap"]](norm(values))
+        rgba[~numpy.isfinite(values)] = 0
+    buffer = io.BytesIO()
+    mpimage.imsave(buffer, rgba, format="png")
+    return buffer.getvalue()
+
+
+def render_tile(
+    key: str,
+    variable: str,
+    time: str,
+    z: int,
+    x: int,
+    y: int,
+    open: Callable[[], xarray.Dataset],
+) -> bytes:
+    """
+    renders (or fetches from the tile cache) one tile of a dataset variable. `key` identifies the
+    dataset version, `open` opens it lazily when it is not already warm.
+    """
+    if z < 0 or not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise ValueError(f"tile {z}/{x}/{y} does not exist")
+    cache = get_preview_cache()
+    tile_key = frame_key(key, variable, f"{time}/{z}/{x}/{y}", TILE_SETTINGS)
+    cached = cache.get(tile_key)
+    if cached is not None:
+        return cached
+
+    warm = get_warm_datasets()
+    ds = warm.get(key, open)
+    if variable not in ds.data_vars:
+        raise KeyError(f"variable {variable} not in dataset")
+    fx, fy = find_horizontal_fields(ds)
+    data = drop_other_dims(select_time(ds[variable], time), fx, fy)
+    limits = shared_limits(warm, key, variable, ds[variable], fx, fy)
+    window = read_window(data, fx, fy, tile_bounds(z, x, y))
+    tile = encode_tile(window, fx, fy, z, x, y, limits)
+    cache.put(tile_key, tile)
+    return tile
@@ -0,0 +1,200 @@
+import math
+import re
+from typing import Any, Dict, List
+import xarray
+from api.dataset.job_queue import LARGE_SUBSET_QUEUE, SUBSET_QUEUE
+from api.dataset.models import (
+    DatasetSubsetOptions,
+    SubsetEstimate,
+    ThinningSubsetOptions,
+)
+from api.dataset.remote import open_dataset
+from api.processing import filters
+from api.search.provider import AccessURLs
+from api.settings import default_settings
+
+# dry run of a subset: the remote dataset is opened lazily (coordinates and attributes only),
+# the subset options are applied lazily and sizes are read off the resulting dask graph.
+# nothing from the data variables is transferred.
+
+# CMIP6 filenames end with the time range of the file, e.g. tas_Amon_..._gn_185001-201412.nc
+FILENAME_TIME_RANGE = re.compile(r"_(\d{4,14})-(\d{4,14})(-clim)?\.nc$")
+
+AGGREGATION_OPTIONS = ["regrid", "resample", "coarsen", "reduction"]
+
+
+def chunk_count(ds: xarray.Dataset) -> int:
+    """
+    number of chunk reads to materialize every data variable - each is at least one upstream request.
+    """
+    total = 0
+    for v in ds.data_vars:
+        chunks = ds[v].chunks
+        total += math.prod(len(c) for c in chunks) if chunks is not None else 1
+    return total
+
+
+def cftime_stamp(t: Any, length: int) -> str:
+    return f"{t.year:04}{t.month:02}{t.day:02}{t.hour:02}{t.minute:02}{t.second:02}"[
+        :length
+    ]
+
+
+def files_in_time_range(
+    files: List[Dict[str, Any]], ds: xarray.Dataset, field: str
+) -> List[Dict[str, Any]]:
+    """
+    files whose filename time range overlaps the time range of the (lazy) subset.
+    files without a parseable range are always counted.
+    """
+    if field not in ds.variables or ds[field].size == 0:
+        return files
+    times = ds[field].values.ravel()
+    start, end = min(times), max(times)
+    touched = []
+    for f in files:
+        match = FILENAME_TIME_RANGE.search(f["filename"])
+        if match is None:
+            touched.append(f)
+            continue
+        first, last = match.group(1), match.group(2)
+        if (
+            cftime_stamp(start, len(last)) <= last
+            and cftime_stamp(end, len(first)) >= first
+        ):
+            touched.append(f)
+    return touched
+
+
+def stamp_to_iso(stamp: str) -> str:
+    """
+    filename time stamps to partial ISO-8601, e.g. 185001 -> 1850-01. partial timestamps
+    select inclusively, so 1850-01 as an end selects all of january.
+    """
+    iso = stamp[:4]
+    for separator, start in [("-", 4), ("-", 6), ("T", 8), (":", 10), (":", 12)]:
+        if len(stamp) > start:
+            iso += separator + stamp[start : start + 2]
+    return iso
+
+
+def thins_field(thinning: ThinningSubsetOptions | None, field: str) -> bool:
+    if thinning is None:
+        return False
+    if thinning.fields is None:
+        return True
+    return (
+        (field not in thinning.fields)
+        if thinning.negated
+        else (field in thinning.fields)
+    )
+
+
+def is_time_shardable(options: DatasetSubsetOptions, field: str) -> bool:
+    """
+    a subset can be split along time if every operation is independent between time steps.
+    """
+    if options.resample is not None:
+        return False
+    if options.reduction is not None and field in options.reduction.fields:
+        return False
+    # coarsening windows trimmed at every shard boundary would drop time steps
+    if options.coarsen is not None and field in options.coarsen.fields:
+        return False
+    return not thins_field(options.thinning, field)
+
+
+def plan_time_shards(
+    touched: List[Dict[str, Any]], options: DatasetSubsetOptions, max_shards: int
+) -> List[List[str]]:
+    """
+    splits the touched files into up to `max_shards` runs of consecutive files and returns the
+    timestamp range of each. the outer bounds keep the requested range.
+    """
+    ranges = []
+    for f in touched:
+        match = FILENAME_TIME_RANGE.search(f["filename"])
+        if match is None:
+            return []
+        ranges.append((match.group(1), match.group(2)))
+    ranges.sort()
+    if len(ranges) < 2 or max_shards < 2:
+        return []
+
+    count = min(max_shards, len(ranges))
+    bounds = [round(i * len(ranges) / count) for i in range(count + 1)]
+    shards = [
+        [stamp_to_iso(ranges[a][0]), stamp_to_iso(ranges[b - 1][1])]
+        for a, b in zip(bounds[:-1], bounds[1:])
+    ]
+    requested = (
+        options.temporal.timestamp_range if options.temporal is not None else None
+    )
+    shards[0][0] = requested[0] if requested is not None else "start"
+    shards[-1][1] = requested[1] if requested is not None else "end"
+    return shards
+
+
+def estimate_subset(
+    ds: xarray.Dataset,
+    options: DatasetSubsetOptions,
+    files: List[Dict[str, Any]],
+    regrid_target: xarray.Dataset | None = None,
+) -> SubsetEstimate:
+    """
+    estimates the cost of a subset of an already (lazily) opened dataset.
+    compressed bytes assume the output compresses like the source files.
+    """
+    selection_options = options.model_copy(
+        update={option: None for option in AGGREGATION_OPTIONS}
+    )
+    selection = filters.subset_with_options(ds, selection_options)
+    output = filters.subset_with_options(ds, options, regrid_target)
+
+    time_field = options.temporal.field if options.temporal is not None else "time"
+    touched = files_in_time_range(files, selection, time_field)
+    source_bytes = sum(f["size"] for f in files)
+    ratio = (
+        min(source_bytes / ds.nbytes, 1.0) if source_bytes > 0 and ds.nbytes else 1.0
+    )
+
+    estimate = SubsetEstimate(
+        shape={str(k): int(v) for k, v in output.sizes.items()},
+        variables=[str(v) for v in output.data_vars],
+        read_bytes=int(selection.nbytes),
+        uncompressed_bytes=int(output.nbytes),
+        compressed_bytes=int(output.nbytes * ratio),
+        files=len(touched),
+        total_files=len(files),
+        upstream_requests=chunk_count(selection),
+        queue=SUBSET_QUEUE,
+    )
+    if estimate.read_bytes > default_settings.subset_max_bytes:
+        estimate.rejected = True
+        estimate.reason = (
+            f"subset reads {estimate.read_bytes} bytes, over the limit of {default_settings.subset_max_bytes}. "
+            "narrow the time range or envelope, or thin the dataset."
+        )
+    elif estimate.read_bytes > default_settings.subset_large_job_bytes:
+        estimate.queue = LARGE_SUBSET_QUEUE
+        if is_time_shardable(options, time_field):
+            # shards stay on the large job queue - spread over the batch workers, not queued
+            # ahead of small subsets
+            estimate.shards = plan_time_shards(
+                touched, options, default_settings.subset_max_shards
+            )
+    return estimate
+
+
+def estimate_esgf_subset(
+    urls: AccessURLs,
+    files: List[Dict[str, Any]],
+    params: Dict[str, Any],
+    regrid_target_urls: AccessURLs | None = None,
+) -> SubsetEstimate:
+    ds = open_dataset(urls)
+    regrid_target = (
+        open_dataset(regrid_target_urls) if regrid_target_urls is not None else None
+    )
+    options = filters.options_from_url_parameters(params)
+    return estimate_subset(ds, options, files, regrid_target)
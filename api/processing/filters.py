@@ -1,22 +1,44 @@
+import re
+import numpy
 import xarray
 from typing import List, Dict, Any
 from api.dataset.models import (
+    CoarsenSubsetOptions,
     DatasetQueryParameters,
     DatasetSubsetOptions,
     GeospatialSubsetOptions,
+    PointSubsetOptions,
+    ReductionSubsetOptions,
+    RegridSubsetOptions,
+    ResampleSubsetOptions,
     TemporalSubsetOptions,
     ThinningSubsetOptions,
 )
+from api.processing import grid_index, regrid
+
+AGGREGATION_METHODS = ["mean", "min", "max", "sum", "median"]
 
 
 def location_bbox(
     dataset: xarray.Dataset, bounding_box: List[float], fields=["lon", "lat"]
 ):
+    if not all(f in dataset.dims for f in fields):
+        curvilinear = grid_index.find_curvilinear_coordinates(dataset)
+        if curvilinear is not None:
+            return grid_index.curvilinear_bbox(dataset, bounding_box, curvilinear)
     return dataset.sel({fields[0]: slice(bounding_box[0], bounding_box[1])}).sel(
         {fields[1]: slice(bounding_box[2], bounding_box[3])}
     )
 
 
+def location_point(dataset: xarray.Dataset, point: List[float], fields=["lon", "lat"]):
+    if not all(f in dataset.dims for f in fields):
+        curvilinear = grid_index.find_curvilinear_coordinates(dataset)
+        if curvilinear is not None:
+            return grid_index.curvilinear_point(dataset, point, curvilinear)
+    return dataset.sel({fields[0]: [point[0]], fields[1]: [point[1]]}, method="nearest")
+
+
 def timestamps(dataset: xarray.Dataset, timestamps: List[str], field="time"):
     ts = timestamps[:]
     print(ts)
@@ -45,17 +67,147 @@ def thin(
     return dataset.thin(nths)
 
 
-def subset_with_options(dataset: xarray.Dataset, options: DatasetSubsetOptions):
+def parse_percentile(method: str) -> float | None:
+    """
+    percentiles are given as pNN, e.g. p90 or p99.5
+    """
+    match = re.fullmatch(r"p(\d+(\.\d+)?)", method)
+    if match is None:
+        return None
+    percentile = float(match.group(1))
+    if percentile > 100:
+        raise Exception(f"Invalid percentile {method}: must be between p0 and p100")
+    return percentile / 100
+
+
+def validate_aggregation_method(method: str):
+    if method not in AGGREGATION_METHODS and parse_percentile(method) is None:
+        raise Exception(
+            f"Invalid aggregation method {method}. Options: {AGGREGATION_METHODS} or a percentile like p90"
+        )
+
+
+def aggregate(obj, method: str, **kwargs):
+    """
+    applies an aggregation method by name to a dataset, resampler, coarsener or weighted object.
+    """
+    q = parse_percentile(method)
+    if q is not None:
+        return obj.quantile(q, **kwargs).drop_vars("quantile", errors="ignore")
+    return getattr(obj, method)(**kwargs)
+
+
+def spatial_dims(dataset: xarray.Dataset, fields: List[str]) -> List[str]:
+    """
+    maps lon/lat field names to the dimensions to operate over. on curvilinear grids lon/lat are not
+    dimensions, so the dimensions of the 2-D coordinates are used instead.
+    """
+    dims = [f for f in fields if f in dataset.dims]
+    if len(dims) == len(fields):
+        return dims
+    curvilinear = grid_index.find_curvilinear_coordinates(dataset)
+    if curvilinear is None:
+        raise Exception(f"Fields {fields} are not dimensions of the dataset")
+    for d in dataset[curvilinear[0]].dims:
+        if d not in dims:
+            dims.append(str(d))
+    return dims
+
+
+def area_weights(dataset: xarray.Dataset) -> xarray.DataArray | None:
+    """
+    cos(latitude) cell weights - None if no latitude can be found.
+    """
+    curvilinear = grid_index.find_curvilinear_coordinates(dataset)
+    if curvilinear is not None:
+        lat = curvilinear[1]
+    else:
+        lat = next(
+            (n for n in grid_index.LATITUDE_NAMES if n in dataset.dims),
+            None,
+        )
+    if lat is None:
+        return None
+    return (
+        numpy.cos(numpy.deg2rad(dataset[lat]))
+        .clip(min=0)
+        .fillna(0)
+        .reset_coords(drop=True)
+    )
+
+
+def resample(dataset: xarray.Dataset, frequency: str, method="mean", field="time"):
+    return aggregate(
+        grid_index.drop_bounds(dataset).resample({field: frequency}), method
+    )
+
+
+def coarsen(dataset: xarray.Dataset, factor: int, fields=["lon", "lat"], weighted=True):
+    """
+    block-averages the spatial dimensions by `factor`. when weighted, every block is the
+    area-weighted mean of its cells, ignoring missing (e.g. land) values.
+    """
+    dataset = grid_index.drop_bounds(dataset)
+    windows = {d: factor for d in spatial_dims(dataset, fields)}
+    coarse = dataset.coarsen(windows, boundary="trim").mean()
+    weights = area_weights(dataset) if weighted else None
+    if weights is None:
+        return coarse
+    for v in dataset.data_vars:
+        if not all(d in dataset[v].dims for d in windows):
+            continue
+        w = weights.where(dataset[v].notnull(), 0)
+        coarse[v] = (dataset[v] * w).coarsen(
+            windows, boundary="trim"
+        ).sum() / w.coarsen(windows, boundary="trim").sum()
+        coarse[v].attrs = dataset[v].attrs
+    return coarse
+
+
+def reduction(
+    dataset: xarray.Dataset, method="mean", fields=["lon", "lat"], weighted=True
+):
+    """
+    reduces over the given fields - e.g. the default of lon and lat with an envelope gives a
+    regional time series. means and percentiles over latitude are area weighted, sums stay plain
+    sums of the cell values.
+    """
+    dataset = grid_index.drop_bounds(dataset)
+    dims = spatial_dims(dataset, fields)
+    weights = area_weights(dataset) if weighted else None
+    if weights is not None and all(d in dims for d in weights.dims):
+        if method == "mean" or parse_percentile(method) is not None:
+            if parse_percentile(method) is not None and dataset.chunks:
+                # weighted quantiles need each reduced dimension in a single chunk
+                dataset = dataset.chunk({d: -1 for d in dims})
+            return aggregate(dataset.weighted(weights), method, dim=dims)
+    if parse_percentile(method) is not None and dataset.chunks:
+        dataset = dataset.chunk({d: -1 for d in dims})
+    return aggregate(dataset, method, dim=dims)
+
+
+def subset_with_options(
+    dataset: xarray.Dataset,
+    options: DatasetSubsetOptions,
+    regrid_target: xarray.Dataset | None = None,
+):
     """
     Performs a dataset subsetting and returns the subset dataset based on the options defined in
     `DatasetSubsetOptions` given they exist. All fields set to None in the given options will be treated
     as the identity funciton.
+
+    `regrid_target` is the opened dataset for `options.regrid.target_dataset_id`, if any.
+
+    aggregations (resample, coarsen, reduction) are applied after selection and stay lazy, so they are
+    computed chunk by chunk when the dataset is loaded rather than on the full remote dataset.
     """
     ds = dataset
     if options.temporal is not None:
         ds = timestamps(ds, options.temporal.timestamp_range, options.temporal.field)
     if options.geospatial is not None:
         ds = location_bbox(ds, options.geospatial.envelope, options.geospatial.fields)
+    if options.point is not None:
+        ds = location_point(ds, options.point.point, options.point.fields)
     if options.thinning is not None:
         ds = thin(
             ds,
@@ -64,6 +216,36 @@ def subset_with_options(dataset: xarray.Dataset, options: DatasetSubsetOptions):
             options.thinning.negated,
             options.thinning.squared,
         )
+    if options.regrid is not None:
+        ds = regrid.regrid(
+            ds,
+            options.regrid.method,
+            options.regrid.resolution,
+            regrid_target,
+            options.regrid.fields,
+            options.geospatial.envelope if options.geospatial is not None else None,
+        )
+    if options.resample is not None:
+        ds = resample(
+            ds,
+            options.resample.frequency,
+            options.resample.method,
+            options.resample.field,
+        )
+    if options.coarsen is not None:
+        ds = coarsen(
+            ds,
+            options.coarsen.factor,
+            options.coarsen.fields,
+            options.coarsen.weighted,
+        )
+    if options.reduction is not None:
+        ds = reduction(
+            ds,
+            options.reduction.method,
+            options.reduction.fields,
+            options.reduction.weighted,
+        )
     if options.custom is not None:
         print("unimplemented! custom filtering will be added later.")
     return ds
@@ -78,6 +260,24 @@ def parse_bbox_string(s: str) -> List[float]:
     return coords
 
 
+def parse_point_string(s: str) -> List[float]:
+    coords = [float(v.strip()) for v in s.split(",")]
+    if len(coords) != 2:
+        raise Exception("Invalid point for latitude and longitude. Proper format: x,y")
+    return coords
+
+
+def parse_resolution_string(s: str) -> List[float]:
+    resolution = [float(v.strip()) for v in s.split(",")]
+    if len(resolution) == 1:
+        resolution = resolution * 2
+    if len(resolution) != 2 or min(resolution) <= 0:
+        raise Exception(
+            "Invalid regrid resolution. Proper format: degrees or lon_degrees,lat_degrees"
+        )
+    return resolution
+
+
 def parse_timestamps_string(s: str) -> List[str]:
     timestamps = s.split(",")
     # todo: validate iso8601, start, and end
@@ -101,6 +301,10 @@ def options_from_url_parameters(parameters: Dict[str, Any]) -> DatasetSubsetOpti
             envelope=parse_bbox_string(envelope)
         )
 
+    point = parameters.get(DatasetQueryParameters.point.value, None)
+    if point is not None:
+        options.point = PointSubsetOptions(point=parse_point_string(point))
+
     thin_factor = int(parameters.get(DatasetQueryParameters.thin_factor.value, 1))
     if thin_factor != 1:
         fields = parameters.get(DatasetQueryParameters.thin_fields.value, None)
@@ -120,4 +324,46 @@ def options_from_url_parameters(parameters: Dict[str, Any]) -> DatasetSubsetOpti
             timestamp_range=parse_timestamps_string(s=timestamps)
         )
 
+    resolution = parameters.get(DatasetQueryParameters.regrid.value, None)
+    regrid_target = parameters.get(DatasetQueryParameters.regrid_target.value, None)
+    if resolution is not None or regrid_target is not None:
+        method = parameters.get(DatasetQueryParameters.regrid_method.value, "bilinear")
+        if method not in regrid.REGRID_METHODS:
+            raise Exception(
+                f"Invalid regrid method {method}. Options: {regrid.REGRID_METHODS}"
+            )
+        options.regrid = RegridSubsetOptions(
+            method=method,
+            resolution=(
+                parse_resolution_string(resolution) if resolution is not None else None
+            ),
+            target_dataset_id=regrid_target,
+        )
+
+    weighted = (
+        parameters.get(DatasetQueryParameters.area_weighted.value, "true").lower()
+        != "false"
+    )
+
+    frequency = parameters.get(DatasetQueryParameters.resample.value, None)
+    if frequency is not None:
+        method = parameters.get(DatasetQueryParameters.resample_method.value, "mean")
+        validate_aggregation_method(method)
+        options.resample = ResampleSubsetOptions(frequency=frequency, method=method)
+
+    coarsen_factor = int(parameters.get(DatasetQueryParameters.coarsen.value, 1))
+    if coarsen_factor != 1:
+        fields = parameters.get(DatasetQueryParameters.coarsen_fields.value, "lon,lat")
+        options.coarsen = CoarsenSubsetOptions(
+            factor=coarsen_factor, fields=fields.split(","), weighted=weighted
+        )
+
+    method = parameters.get(DatasetQueryParameters.reduce.value, None)
+    if method is not None:
+        validate_aggregation_method(method)
+        fields = parameters.get(DatasetQueryParameters.reduce_fields.value, "lon,lat")
+        options.reduction = ReductionSubsetOptions(
+            method=method, fields=fields.split(","), weighted=weighted
+        )
+
     return options
@@ -0,0 +1,245 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+import numpy
+import xarray
+from scipy.spatial import cKDTree
+
+# spatial lookups for curvilinear / unstructured grids (e.g. CMIP6 ocean and sea-ice `gn` output)
+# where latitude and longitude are 2-D auxiliary coordinates rather than 1-D dimensions, so
+# `.sel` slicing can't be used. points are indexed on the unit sphere so the index is
+# unaffected by longitude conventions (0..360 vs -180..180) and the poles.
+
+LONGITUDE_NAMES = ["longitude", "lon", "nav_lon", "glamt", "TLONG", "ULONG"]
+LATITUDE_NAMES = ["latitude", "lat", "nav_lat", "gphit", "TLAT", "ULAT"]
+
+# number of samples taken along each edge of a bounding box to size the search radius
+BOUNDARY_SAMPLES = 32
+
+# grid indexes kept in memory per process
+INDEX_MEMORY_CACHE_SIZE = 8
+
+GridWindow = Dict[str, slice]
+
+_index_cache: "OrderedDict[str, GridIndex]" = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+def to_cartesian(lon: numpy.ndarray, lat: numpy.ndarray) -> numpy.ndarray:
+    lon = numpy.deg2rad(numpy.asarray(lon, dtype=numpy.float64))
+    lat = numpy.deg2rad(numpy.asarray(lat, dtype=numpy.float64))
+    return numpy.stack(
+        [
+            numpy.cos(lat) * numpy.cos(lon),
+            numpy.cos(lat) * numpy.sin(lon),
+            numpy.sin(lat),
+        ],
+        axis=-1,
+    )
+
+
+def longitude_in_range(lon: numpy.ndarray, lon0: float, lon1: float) -> numpy.ndarray:
+    """
+    longitude range test that is independent of 0..360 / -180..180 conventions.
+    a range where lon0 > lon1 (after normalization) is treated as crossing the antimeridian.
+    """
+    if abs(lon1 - lon0) >= 360:
+        return numpy.ones(numpy.shape(lon), dtype=bool)
+    lon = numpy.mod(lon, 360)
+    lon0 = lon0 % 360
+    lon1 = lon1 % 360
+    if lon0 <= lon1:
+        return (lon >= lon0) & (lon <= lon1)
+    return (lon >= lon0) | (lon <= lon1)
+
+
+def drop_bounds(dataset: xarray.Dataset) -> xarray.Dataset:
+    """
+    cell bounds are invalidated by aggregation and regridding and often can't be reduced (cftime
+    objects), so drop them. this includes the cell vertices of CMIP curvilinear grids.
+    """
+    bounds = [
+        dataset[v].attrs["bounds"]
+        for v in dataset.variables
+        if "bounds" in dataset[v].attrs
+    ]
+    bounds += [
+        v
+        for v in dataset.variables
+        if str(v).endswith(("_bnds", "_bounds")) or str(v).startswith("vertices_")
+    ]
+    return dataset.drop_vars(set(bounds), errors="ignore")
+
+
+def find_curvilinear_coordinates(
+    ds: xarray.Dataset,
+) -> Tuple[str, str] | None:
+    """
+    returns the names of 2-D (or 1-D unstructured, non-dimension) longitude and latitude coordinates,
+    or None if the dataset is on a regular grid. checks `standard_name` first, then common names.
+    """
+
+    def find(standard_name: str, names: List[str]) -> str | None:
+        candidates = [
+            v
+            for v in ds.variables
+            if ds[v].attrs.get("standard_name", "") == standard_name
+        ] + [n for n in names if n in ds.variables]
+        for v in candidates:
+            if v not in ds.dims and ds[v].ndim in (1, 2):
+                return str(v)
+        return None
+
+    lon = find("longitude", LONGITUDE_NAMES)
+    lat = find("latitude", LATITUDE_NAMES)
+    if lon is None or lat is None or ds[lon].dims != ds[lat].dims:
+        return None
+    return (lon, lat)
+
+
+class GridIndex:
+    """
+    KD-tree over a grid's cell centers. built once per grid and reused across subsets.
+    """
+
+    def __init__(self, lon: numpy.ndarray, lat: numpy.ndarray, dims: Tuple[str, ...]):
+        self.lon = numpy.asarray(lon, dtype=numpy.float64)
+        self.lat = numpy.asarray(lat, dtype=numpy.float64)
+        self.dims = dims
+        self.shape = self.lon.shape
+        valid = numpy.isfinite(self.lon) & numpy.isfinite(self.lat)
+        # land points are frequently filled with NaN coordinates - keep the original flat index
+        self.valid_indices = numpy.flatnonzero(valid)
+        self.tree = cKDTree(
+            to_cartesian(
+                self.lon.ravel()[valid.ravel()], self.lat.ravel()[valid.ravel()]
+            )
+        )
+
+    def bbox(self, bounding_box: List[float]) -> Tuple[GridWindow, numpy.ndarray]:
+        """
+        returns the minimal index window covering the points inside `[lon0, lon1, lat0, lat1]`
+        and a boolean mask (shaped to the window) of the points that are actually inside it.
+        """
+        lon0, lon1, lat0, lat1 = bounding_box
+        lat0, lat1 = min(lat0, lat1), max(lat0, lat1)
+
+        # search a ball around the box center that encloses the whole boundary, then filter exactly
+        span = (lon1 - lon0) % 360 if lon0 != lon1 else 0
+        if abs(lon1 - lon0) >= 360:
+            span = 360
+        edge_lon = lon0 + numpy.linspace(0, span, BOUNDARY_SAMPLES)
+        edge_lat = numpy.linspace(lat0, lat1, BOUNDARY_SAMPLES)
+        boundary = numpy.concatenate(
+            [
+                to_cartesian(edge_lon, numpy.full(BOUNDARY_SAMPLES, lat0)),
+                to_cartesian(edge_lon, numpy.full(BOUNDARY_SAMPLES, lat1)),
+                to_cartesian(numpy.full(BOUNDARY_SAMPLES, lon0), edge_lat),
+                to_cartesian(numpy.full(BOUNDARY_SAMPLES, lon0 + span), edge_lat),
+            ]
+        )
+        center = to_cartesian(lon0 + span / 2, (lat0 + lat1) / 2)
+        radius = numpy.linalg.norm(boundary - center, axis=1).max()
+        # the great circle of the box edge can bulge past the sampled points - pad the radius
+        candidates = self.valid_indices[
+            self.tree.query_ball_point(center, min(radius * 1.05 + 1e-9, 2.0))
+        ]
+
+        lon = self.lon.ravel()[candidates]
+        lat = self.lat.ravel()[candidates]
+        inside = candidates[
+            longitude_in_range(lon, lon0, lon0 + span) & (lat >= lat0) & (lat <= lat1)
+        ]
+        if len(inside) == 0:
+            raise ValueError(f"no grid points found inside bounding box {bounding_box}")
+
+        positions = numpy.unravel_index(inside, self.shape)
+        window = {
+            dim: slice(int(p.min()), int(p.max()) + 1)
+            for dim, p in zip(self.dims, positions)
+        }
+        mask = numpy.zeros(
+            tuple(window[d].stop - window[d].start for d in self.dims), dtype=bool
+        )
+        mask[tuple(p - window[d].start for d, p in zip(self.dims, positions))] = True
+        return window, mask
+
+    def nearest(self, lon: float, lat: float) -> Dict[str, int]:
+        """
+        returns the index of the grid point closest to the given location.
+        """
+        _, i = self.tree.query(to_cartesian(lon, lat))
+        position = numpy.unravel_index(self.valid_indices[i], self.shape)
+        return {dim: int(p) for dim, p in zip(self.dims, position)}
+
+
+def grid_cache_key(
+    lon: numpy.ndarray, lat: numpy.ndarray, dims: Tuple[str, ...]
+) -> str:
+    """
+    hash of the coordinate values - a window of a grid has the same shape as other windows
+    of it, so neither the grid's name nor its shape identifies it.
+    """
+    digest = hashlib.sha1(str(dims).encode())
+    for a in (lon, lat):
+        a = numpy.ascontiguousarray(a, dtype=numpy.float64)
+        digest.update(str(a.shape).encode())
+        digest.update(a.tobytes())
+    return digest.hexdigest()
+
+
+def get_grid_index(ds: xarray.Dataset, fields: Tuple[str, str]) -> GridIndex:
+    """
+    returns the cached index for the dataset's grid, building it from the coordinate arrays if needed.
+    """
+    # only the coordinate arrays are pulled from remote, not the data variables
+    lon, lat = ds[fields[0]].values, ds[fields[1]].values
+    dims = ds[fields[0]].dims
+    key = grid_cache_key(lon, lat, dims)
+    with _index_cache_lock:
+        if key in _index_cache:
+            _index_cache.move_to_end(key)
+            return _index_cache[key]
+
+    name = f"{ds.attrs.get('source_id', '')}.{ds.attrs.get('grid_label', '')}"
+    print(f"building grid index for {name} {lon.shape}", flush=True)
+    index = GridIndex(lon, lat, dims)
+    with _index_cache_lock:
+        _index_cache[key] = index
+        while len(_index_cache) > INDEX_MEMORY_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def clear_grid_index_cache():
+    with _index_cache_lock:
+        _index_cache.clear()
+
+
+def curvilinear_bbox(
+    ds: xarray.Dataset, bounding_box: List[float], fields: Tuple[str, str]
+) -> xarray.Dataset:
+    """
+    subsets a curvilinear dataset to the index window around a bounding box. only the window is read
+    from remote; points inside the window but outside the box are masked out of the data variables.
+    """
+    index = get_grid_index(ds, fields)
+    window, mask = index.bbox(bounding_box)
+    ds = ds.isel(window)
+    mask_array = xarray.DataArray(mask, dims=index.dims)
+    for v in ds.data_vars:
+        if all(d in ds[v].dims for d in index.dims):
+            ds[v] = ds[v].where(mask_array)
+    return ds
+
+
+def curvilinear_point(
+    ds: xarray.Dataset, point: List[float], fields: Tuple[str, str]
+) -> xarray.Dataset:
+    """
+    selects the grid cell nearest to `[lon, lat]`, keeping the grid dimensions with length 1.
+    """
+    index = get_grid_index(ds, fields)
+    nearest = index.nearest(point[0], point[1])
+    return ds.isel({dim: slice(i, i + 1) for dim, i in nearest.items()})
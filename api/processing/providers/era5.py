@@ -3,6 +3,7 @@ import xarray
 from typing import Dict, List
 from api.dataset.terarium_hmi import construct_hmi_dataset_era5
 from api.dataset.remote import cleanup_potential_artifacts
+from api.dataset.progress import record, stage
 import os
 import cdsapi
 
@@ -115,7 +116,9 @@ def era5_subset_job(
     filename = f"era5-{job_id}.nc"
     print(f"running ERA5 subset job for: {job_id}", flush=True)
     try:
-        ds = download_era5_subset(filename, data, days, months, years, hours)
+        with stage("download"):
+            ds = download_era5_subset(filename, data, days, months, years, hours)
+            record(bytes_read=os.path.getsize(filename), files=1, mirror="cds")
     except IOError as e:
         return {
             "status": "failed",
@@ -123,13 +126,14 @@ def era5_subset_job(
         }
     print(f"bytes: {ds.nbytes}", flush=True)
     try:
-        hmi_id = construct_hmi_dataset_era5(
-            ds,
-            "",
-            parent_id,
-            job_id,
-            data,
-        )
+        with stage("describe"):
+            hmi_id = construct_hmi_dataset_era5(
+                ds,
+                "",
+                parent_id,
+                job_id,
+                data,
+            )
         return {"status": "ok", "dataset_id": hmi_id}
     except Exception as e:
         return {"status": "failed", "error": str(e), "dataset_id": ""}
@@ -1,20 +1,31 @@
-from api.dataset.models import DatasetType
+from api.dataset.models import DatasetQueryParameters, DatasetType
 from api.search.provider import AccessURLs
 from .. import filters
 import xarray
-from typing import Any, Dict
+from typing import Any, Dict, List
+from rq import get_current_job
+from rq.job import Job
 from api.dataset.terarium_hmi import construct_hmi_dataset, post_hmi_dataset
 from api.dataset.remote import cleanup_potential_artifacts, open_dataset
+from api.dataset.progress import record, stage
 import os
 
 
 def slice_esgf_dataset(
-    urls: AccessURLs, dataset_id: str, params: Dict[str, Any]
+    urls: AccessURLs,
+    dataset_id: str,
+    params: Dict[str, Any],
+    regrid_target_urls: AccessURLs | None = None,
 ) -> xarray.Dataset:
-    ds = open_dataset(urls)
-    options = filters.options_from_url_parameters(params)
-    print(f"original size: {ds.nbytes}\nslicing with options {options}", flush=True)
-    return filters.subset_with_options(ds, options)
+    with stage("open"):
+        ds = open_dataset(urls)
+        options = filters.options_from_url_parameters(params)
+        print(f"original size: {ds.nbytes}\nslicing with options {options}", flush=True)
+        regrid_target = None
+        if regrid_target_urls is not None:
+            # only the target's coordinates are read
+            regrid_target = open_dataset(regrid_target_urls)
+        return filters.subset_with_options(ds, options, regrid_target)
 
 
 def slice_and_store_dataset(
@@ -23,13 +34,14 @@ def slice_and_store_dataset(
     dataset_id: str,
     params: Dict[str, Any],
     variable_id: str,
+    regrid_target_urls: AccessURLs | None = None,
     **kwargs,
 ):
     job_id = kwargs["job_id"]
     filename = f"cmip6-{job_id}.nc"
     print(f"running job esgf subset job for: {job_id}", flush=True)
     try:
-        ds = slice_esgf_dataset(urls, dataset_id, params)
+        ds = slice_esgf_dataset(urls, dataset_id, params, regrid_target_urls)
     except IOError as e:
         return {
             "status": "failed",
@@ -38,9 +50,8 @@ def slice_and_store_dataset(
     print(f"bytes: {ds.nbytes}", flush=True)
     try:
         print("pulling sliced dataset from remote", flush=True)
-        ds.load()
+        load_and_write(ds, filename)
         print("done", flush=True)
-        ds.to_netcdf(filename)
     except Exception:
         return "Upstream OPENDAP server rejected the request for being too large."
     # minio s3 -> do terarium for now instead
@@ -48,18 +59,125 @@ def slice_and_store_dataset(
     # s3.upload_file(filename, default_settings.bucket_name, filename)
     # return {"url": f"s3://{default_settings.bucket_name}/{filename}"}
     try:
-        dataset = construct_hmi_dataset(
-            ds,
-            dataset_id,
-            parent_id,
-            job_id,
-            filters.options_from_url_parameters(params),
-            variable_id,
+        return store_subset(
+            ds, filename, parent_id, dataset_id, params, variable_id, job_id
         )
-        hmi_id = post_hmi_dataset(dataset, filename)
+    finally:
+        cleanup_potential_artifacts(job_id)
+        os.remove(filename)
+
+
+def load_and_write(ds: xarray.Dataset, filename: str):
+    with stage("load"):
+        ds.load()
+        record(bytes_read=ds.nbytes)
+    with stage("write"):
+        ds.to_netcdf(filename)
+        record(bytes_written=os.path.getsize(filename), files=1)
+
+
+def store_subset(
+    ds: xarray.Dataset,
+    filename: str,
+    parent_id: str,
+    dataset_id: str,
+    params: Dict[str, Any],
+    variable_id: str,
+    job_id: str,
+):
+    try:
+        with stage("describe"):
+            dataset = construct_hmi_dataset(
+                ds,
+                dataset_id,
+                parent_id,
+                job_id,
+                filters.options_from_url_parameters(params),
+                variable_id,
+            )
+        with stage("upload"):
+            hmi_id = post_hmi_dataset(dataset, filename)
+            record(bytes_uploaded=os.path.getsize(filename), files=1)
         return {"status": "ok", "dataset_id": hmi_id, "filename": filename}
     except Exception as e:
         return {"status": "failed", "error": str(e), "dataset_id": ""}
+
+
+def shard_filename(parent_job_id: str, shard_index: int) -> str:
+    return f"cmip6-{parent_job_id}-shard-{shard_index}.nc"
+
+
+def slice_esgf_shard(
+    urls: AccessURLs,
+    dataset_id: str,
+    params: Dict[str, Any],
+    timestamps: List[str],
+    regrid_target_urls: AccessURLs | None = None,
+    **kwargs,
+):
+    """
+    one time shard of a sharded subset - writes its slice to a shard file for the merge job.
+    failures raise rather than return so that rq retries the shard.
+    """
+    job_id = kwargs["job_id"]
+    filename = shard_filename(kwargs["parent_job_id"], kwargs["shard_index"])
+    print(f"running esgf subset shard {job_id}: {timestamps}", flush=True)
+    shard_params = params | {
+        DatasetQueryParameters.timestamps.value: ",".join(timestamps)
+    }
+    try:
+        ds = slice_esgf_dataset(urls, dataset_id, shard_params, regrid_target_urls)
+        print(f"bytes: {ds.nbytes}", flush=True)
+        load_and_write(ds, filename)
     finally:
         cleanup_potential_artifacts(job_id)
-        os.remove(filename)
+    return {"status": "ok", "filename": filename, "bytes": ds.nbytes}
+
+
+def merge_and_store_shards(
+    parent_id: str,
+    dataset_id: str,
+    params: Dict[str, Any],
+    variable_id: str,
+    **kwargs,
+):
+    """
+    concatenates the shard files of a sharded subset in time order and uploads the result once.
+    """
+    job_id = kwargs["job_id"]
+    shard_job_ids: List[str] = kwargs["shard_job_ids"]
+    filename = f"cmip6-{job_id}.nc"
+    shard_files = [shard_filename(job_id, i) for i in range(len(shard_job_ids))]
+    print(f"merging {len(shard_files)} shards for: {job_id}", flush=True)
+    try:
+        shards = Job.fetch_many(shard_job_ids, connection=get_current_job().connection)
+        failed = [
+            shard_id
+            for shard_id, shard in zip(shard_job_ids, shards)
+            if shard is None or shard.get_status() != "finished"
+        ]
+        if len(failed) > 0:
+            return {
+                "status": "failed",
+                "error": f"subset shards failed: {failed}",
+                "dataset_id": "",
+            }
+        with stage("merge"):
+            ds = xarray.open_mfdataset(
+                shard_files, concat_dim="time", combine="nested", use_cftime=True
+            )
+            ds.to_netcdf(filename)
+            ds.close()
+            record(
+                bytes_read=sum(os.path.getsize(f) for f in shard_files),
+                bytes_written=os.path.getsize(filename),
+                files=len(shard_files) + 1,
+            )
+        ds = xarray.open_dataset(filename, use_cftime=True)
+        return store_subset(
+            ds, filename, parent_id, dataset_id, params, variable_id, job_id
+        )
+    finally:
+        for f in shard_files + [filename]:
+            if os.path.exists(f):
+                os.remove(f)
@@ -0,0 +1,388 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Tuple
+import numpy
+import xarray
+from scipy import sparse
+from api.processing import grid_index
+from api.settings import default_settings
+
+# regridding as a sparse matrix product: every target cell is a weighted sum of source cells, so the
+# weights for a source / target grid pair are computed once, cached as a compressed sparse matrix and
+# then applied to every chunk (time step, level...) of every dataset on that grid with a single matmul.
+#
+# rectilinear grids have separable weights - the full matrix is kron(latitude weights, longitude weights).
+# curvilinear grids (ocean / sea-ice) interpolate from the nearest neighbours in the grid index.
+
+REGRID_METHODS = ["bilinear", "conservative"]
+
+# inverse distance neighbours for curvilinear sources
+CURVILINEAR_NEIGHBOURS = 4
+
+# in-process weights kept hot on top of the on-disk cache
+WEIGHTS_MEMORY_CACHE_SIZE = 16
+
+_weights_cache: "OrderedDict[str, sparse.csr_matrix]" = OrderedDict()
+_weights_cache_lock = threading.Lock()
+
+
+def is_periodic_longitude(lon: numpy.ndarray) -> bool:
+    """
+    global grids wrap around - interpolation has to connect the last and first longitudes.
+    """
+    if len(lon) < 2:
+        return False
+    s = numpy.sort(numpy.mod(lon, 360))
+    gaps = numpy.diff(numpy.append(s, s[0] + 360))
+    return bool(gaps.max() <= 2 * numpy.median(gaps[:-1]) + 1e-6)
+
+
+def cell_bounds(centers: numpy.ndarray, limits: Tuple[float, float] | None = None):
+    """
+    (n, 2) cell edges from cell centers, halfway between neighbours and extrapolated at the ends.
+    """
+    centers = numpy.asarray(centers, dtype=numpy.float64)
+    if len(centers) == 1:
+        edges = numpy.array([centers[0] - 0.5, centers[0] + 0.5])
+    else:
+        mid = (centers[1:] + centers[:-1]) / 2
+        edges = numpy.concatenate(
+            [
+                [centers[0] - (mid[0] - centers[0])],
+                mid,
+                [centers[-1] + (centers[-1] - mid[-1])],
+            ]
+        )
+    if limits is not None:
+        edges = numpy.clip(edges, *limits)
+    return numpy.stack([edges[:-1], edges[1:]], axis=1)
+
+
+def linear_weights_1d(
+    source: numpy.ndarray, target: numpy.ndarray, period: float | None = None
+) -> sparse.csr_matrix:
+    """
+    (target x source) 1-D linear interpolation weights. targets outside the source cells get no weights.
+    """
+    source = numpy.asarray(source, dtype=numpy.float64)
+    target = numpy.asarray(target, dtype=numpy.float64)
+    if period is not None:
+        source = numpy.mod(source, period)
+        target = numpy.mod(target, period)
+    order = numpy.argsort(source)
+    s = source[order]
+    if period is not None:
+        s = numpy.concatenate([[s[-1] - period], s, [s[0] + period]])
+        columns = numpy.concatenate([[order[-1]], order, [order[0]]])
+        valid = numpy.ones(len(target), dtype=bool)
+    else:
+        columns = order
+        edges = cell_bounds(s)
+        valid = (target >= edges[0, 0]) & (target <= edges[-1, 1])
+        target = numpy.clip(target, s[0], s[-1])
+
+    if len(s) == 1:
+        rows = numpy.flatnonzero(valid)
+        return sparse.csr_matrix(
+            (numpy.ones(len(rows)), (rows, numpy.zeros(len(rows), dtype=int))),
+            shape=(len(target), len(source)),
+        )
+
+    k = numpy.clip(numpy.searchsorted(s, target, side="right") - 1, 0, len(s) - 2)
+    x0 = s[k]
+    x1 = s[k + 1]
+    frac = numpy.clip((target - x0) / numpy.where(x1 > x0, x1 - x0, 1), 0, 1)
+
+    rows = numpy.flatnonzero(valid)
+    return sparse.csr_matrix(
+        (
+            numpy.concatenate([1 - frac[rows], frac[rows]]),
+            (
+                numpy.concatenate([rows, rows]),
+                numpy.concatenate([columns[k[rows]], columns[k[rows] + 1]]),
+            ),
+        ),
+        shape=(len(target), len(source)),
+    )
+
+
+def overlap_weights_1d(
+    source_bounds: numpy.ndarray,
+    target_bounds: numpy.ndarray,
+    period: float | None = None,
+) -> sparse.csr_matrix:
+    """
+    (target x source) fraction of each target cell covered by each source cell.
+    """
+    s_lo = source_bounds.min(axis=1)
+    s_hi = source_bounds.max(axis=1)
+    t_lo = target_bounds.min(axis=1)
+    t_hi = target_bounds.max(axis=1)
+    shifts = [0.0]
+    if period is not None:
+        s_hi = numpy.mod(s_lo, period) + (s_hi - s_lo)
+        s_lo = numpy.mod(s_lo, period)
+        t_hi = numpy.mod(t_lo, period) + (t_hi - t_lo)
+        t_lo = numpy.mod(t_lo, period)
+        shifts = [-period, 0.0, period]
+
+    overlap = numpy.zeros((len(t_lo), len(s_lo)))
+    for shift in shifts:
+        overlap += numpy.clip(
+            numpy.minimum(t_hi[:, None], s_hi[None, :] + shift)
+            - numpy.maximum(t_lo[:, None], s_lo[None, :] + shift),
+            0,
+            None,
+        )
+    width = numpy.where(t_hi > t_lo, t_hi - t_lo, 1)
+    return sparse.csr_matrix(overlap / width[:, None])
+
+
+def rectilinear_weights(
+    method: str,
+    source_lon: numpy.ndarray,
+    source_lat: numpy.ndarray,
+    target_lon: numpy.ndarray,
+    target_lat: numpy.ndarray,
+) -> sparse.csr_matrix:
+    """
+    weights from a (lat, lon) source to a (lat, lon) target, both flattened latitude-major.
+    """
+    period = 360.0 if is_periodic_longitude(source_lon) else None
+    if method == "bilinear":
+        lat_weights = linear_weights_1d(source_lat, target_lat)
+        lon_weights = linear_weights_1d(source_lon, target_lon, period)
+    else:
+        # area on the sphere is separable into longitude width * difference of sin(latitude)
+        def sin_bounds(lat):
+            return numpy.sin(numpy.deg2rad(cell_bounds(lat, (-90, 90))))
+
+        lat_weights = overlap_weights_1d(sin_bounds(source_lat), sin_bounds(target_lat))
+        # overlaps are well defined across the antimeridian even for regional grids
+        lon_weights = overlap_weights_1d(
+            cell_bounds(source_lon), cell_bounds(target_lon), 360.0
+        )
+    return sparse.kron(lat_weights, lon_weights, format="csr")
+
+
+def curvilinear_weights(
+    index: grid_index.GridIndex,
+    target_lon: numpy.ndarray,
+    target_lat: numpy.ndarray,
+) -> sparse.csr_matrix:
+    """
+    inverse distance weights from the nearest source cells. targets further than two typical
+    source cell spacings from any source cell (e.g. over land or outside a regional grid) get no weights.
+    """
+    lat, lon = numpy.meshgrid(target_lat, target_lon, indexing="ij")
+    points = grid_index.to_cartesian(lon.ravel(), lat.ravel())
+    sample = index.tree.data[:: max(1, index.tree.n // 10000)]
+    spacing = numpy.median(index.tree.query(sample, k=2)[0][:, 1])
+    k = min(CURVILINEAR_NEIGHBOURS, index.tree.n)
+    distance, neighbours = index.tree.query(points, k=k)
+    distance = distance.reshape(len(points), k)
+    neighbours = neighbours.reshape(len(points), k)
+
+    valid = distance[:, 0] <= 2 * spacing
+    inverse = 1 / numpy.maximum(distance, 1e-12)
+    weights = inverse / inverse.sum(axis=1, keepdims=True)
+    rows = numpy.repeat(numpy.flatnonzero(valid), k)
+    return sparse.csr_matrix(
+        (
+            weights[valid].ravel(),
+            (rows, index.valid_indices[neighbours[valid].ravel()]),
+        ),
+        shape=(len(points), int(numpy.prod(index.shape))),
+    )
+
+
+def weights_key(method: str, *arrays: numpy.ndarray) -> str:
+    digest = hashlib.sha1(method.encode())
+    for a in arrays:
+        a = numpy.ascontiguousarray(a, dtype=numpy.float64)
+        digest.update(str(a.shape).encode())
+        digest.update(a.tobytes())
+    return digest.hexdigest()
+
+
+def get_weights(key: str, build: Callable[[], sparse.csr_matrix]) -> sparse.csr_matrix:
+    """
+    returns weights from memory, then the local cache directory, building and storing them if needed.
+    """
+    with _weights_cache_lock:
+        if key in _weights_cache:
+            _weights_cache.move_to_end(key)
+            return _weights_cache[key]
+
+    path = os.path.join(default_settings.regrid_cache_dir, f"{key}.npz")
+    if os.path.exists(path):
+        weights = sparse.load_npz(path).tocsr()
+    else:
+        print(f"building regrid weights {key}", flush=True)
+        weights = build().astype(numpy.float32)
+        weights.eliminate_zeros()
+        os.makedirs(default_settings.regrid_cache_dir, exist_ok=True)
+        # write then rename so concurrent workers never read a partial file
+        temp = f"{path}.{os.getpid()}.tmp.npz"
+        sparse.save_npz(temp, weights, compressed=True)
+        os.replace(temp, path)
+
+    with _weights_cache_lock:
+        _weights_cache[key] = weights
+        while len(_weights_cache) > WEIGHTS_MEMORY_CACHE_SIZE:
+            _weights_cache.popitem(last=False)
+    return weights
+
+
+def apply_weights(
+    data: numpy.ndarray, weights: sparse.csr_matrix, shape: Tuple[int, int]
+) -> numpy.ndarray:
+    """
+    regrids the last two dimensions of `data`. missing values are excluded and the remaining
+    weights renormalized, so masked (e.g. land) cells don't bleed into the result.
+    the result keeps the precision of floating point data (see regridded_dtype).
+    """
+    leading = data.shape[:-2]
+    flat = data.reshape(-1, data.shape[-2] * data.shape[-1]).T
+    valid = numpy.isfinite(flat)
+    numerator = weights @ numpy.where(valid, flat, 0)
+    denominator = weights @ valid.astype(numpy.float32)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        out = numpy.where(denominator > 1e-6, numerator / denominator, numpy.nan)
+    return out.T.reshape(leading + shape).astype(
+        regridded_dtype(data.dtype), copy=False
+    )
+
+
+def regridded_dtype(dtype: numpy.dtype) -> numpy.dtype:
+    # integer data becomes floating point - cells without valid sources are NaN
+    return numpy.result_type(dtype, numpy.float32)
+
+
+def target_from_resolution(
+    resolution: List[float], envelope: List[float] | None = None
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    cell centers of a regular lon / lat grid with `[dlon, dlat]` spacing, global or limited to an envelope.
+    """
+    dlon, dlat = resolution
+    lon0, lon1, lat0, lat1 = envelope if envelope is not None else [0, 360, -90, 90]
+    lon0, lon1 = min(lon0, lon1), max(lon0, lon1)
+    lat0, lat1 = max(min(lat0, lat1), -90), min(max(lat0, lat1), 90)
+    lon = numpy.arange(lon0 + dlon / 2, lon1, dlon)
+    lat = numpy.arange(lat0 + dlat / 2, lat1, dlat)
+    if len(lon) == 0 or len(lat) == 0:
+        raise ValueError(
+            f"resolution {resolution} is larger than the region {envelope}"
+        )
+    return lon, lat
+
+
+def target_from_dataset(target: xarray.Dataset) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    lon = next((n for n in grid_index.LONGITUDE_NAMES if n in target.dims), None)
+    lat = next((n for n in grid_index.LATITUDE_NAMES if n in target.dims), None)
+    if lon is None or lat is None:
+        raise ValueError("target dataset must be on a rectilinear lon / lat grid")
+    return target[lon].values, target[lat].values
+
+
+def regrid(
+    dataset: xarray.Dataset,
+    method: str = "bilinear",
+    resolution: List[float] | None = None,
+    target: xarray.Dataset | None = None,
+    fields=["lon", "lat"],
+    envelope: List[float] | None = None,
+) -> xarray.Dataset:
+    """
+    regrids every variable on the dataset's horizontal grid to a regular lon / lat grid given either
+    by a resolution or by another dataset. variables without the horizontal dimensions are kept as-is.
+    """
+    if method not in REGRID_METHODS:
+        raise ValueError(f"invalid regrid method {method}. options: {REGRID_METHODS}")
+    if target is not None:
+        target_lon, target_lat = target_from_dataset(target)
+    elif resolution is not None:
+        target_lon, target_lat = target_from_resolution(resolution, envelope)
+    else:
+        raise ValueError("regridding needs either a resolution or a target dataset")
+    # bounds (e.g. CMIP vertices_latitude) share the grid dimensions but don't describe the new grid
+    dataset = grid_index.drop_bounds(dataset)
+
+    curvilinear = None
+    if not all(f in dataset.dims for f in fields):
+        curvilinear = grid_index.find_curvilinear_coordinates(dataset)
+        if curvilinear is None:
+            raise ValueError(f"fields {fields} are not dimensions of the dataset")
+
+    if curvilinear is not None:
+        if method != "bilinear":
+            raise ValueError(
+                "conservative regridding requires a rectilinear source grid"
+            )
+        lon_name, lat_name = curvilinear
+        core_dims = list(dataset[lon_name].dims)
+        index = grid_index.get_grid_index(dataset, curvilinear)
+        key = weights_key(method, index.lon, index.lat, target_lon, target_lat)
+        weights = get_weights(
+            key, lambda: curvilinear_weights(index, target_lon, target_lat)
+        )
+    else:
+        lon_name, lat_name = fields
+        core_dims = [lat_name, lon_name]
+        source_lon = dataset[lon_name].values
+        source_lat = dataset[lat_name].values
+        key = weights_key(method, source_lon, source_lat, target_lon, target_lat)
+        weights = get_weights(
+            key,
+            lambda: rectilinear_weights(
+                method, source_lon, source_lat, target_lon, target_lat
+            ),
+        )
+
+    shape = (len(target_lat), len(target_lon))
+    coords = {
+        "lat": (
+            "lat",
+            target_lat,
+            {"standard_name": "latitude", "units": "degrees_north", "axis": "Y"},
+        ),
+        "lon": (
+            "lon",
+            target_lon,
+            {"standard_name": "longitude", "units": "degrees_east", "axis": "X"},
+        ),
+    }
+    regridded = {}
+    for v in dataset.data_vars:
+        da = dataset[v]
+        if not all(d in da.dims for d in core_dims):
+            if not any(d in da.dims for d in core_dims):
+                regridded[v] = da
+            continue
+        da = da.drop_vars(
+            [c for c in da.coords if any(d in da[c].dims for d in core_dims)]
+        )
+        if da.chunks is not None:
+            da = da.chunk({d: -1 for d in core_dims})
+        out = xarray.apply_ufunc(
+            apply_weights,
+            da,
+            kwargs={"weights": weights, "shape": shape},
+            input_core_dims=[core_dims],
+            output_core_dims=[["lat", "lon"]],
+            exclude_dims=set(core_dims),
+            dask="parallelized",
+            output_dtypes=[regridded_dtype(da.dtype)],
+            dask_gufunc_kwargs={"output_sizes": {"lat": shape[0], "lon": shape[1]}},
+        )
+        out.attrs = da.attrs
+        regridded[v] = out
+    return xarray.Dataset(regridded, coords=coords, attrs=dataset.attrs)
+
+
+def clear_weights_cache():
+    with _weights_cache_lock:
+        _weights_cache.clear()
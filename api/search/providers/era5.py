@@ -3,6 +3,8 @@ import ast
 from openai import OpenAI
 from typing import List
 from pydantic import BaseModel, Field
+from api.metrics import OPENAI_SECONDS
+from api.tracing import CLIENT, span
 
 
 class ERA5SearchData(BaseModel):
@@ -80,13 +82,16 @@ return only the python code with no additional explanation.
 
     def natural_language_search(self, query: str) -> str:
         context = self.generate_natural_language_context(query)
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "user", "content": context},
-            ],
-            temperature=0.7,
-        )
+        with OPENAI_SECONDS.labels("era5", "chat").time(), span(
+            "openai.chat", kind=CLIENT
+        ):
+            response = self.client.chat.completions.create(
+                model="gpt-4",
+                messages=[
+                    {"role": "user", "content": context},
+                ],
+                temperature=0.7,
+            )
         return response.choices[0].message.content or ""
 
     def get_access_paths(self, dataset: Dataset) -> List[str]:
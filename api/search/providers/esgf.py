@@ -1,4 +1,5 @@
 import re
+import threading
 from api.settings import default_settings
 from api.search.provider import (
     AccessURLs,
@@ -7,7 +8,7 @@ from api.search.provider import (
     Dataset,
 )
 import requests
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse
 from typing import Any, List, Dict
 import itertools
 import dask
@@ -18,6 +19,15 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 import pickle
+from api.metrics import (
+    OPENAI_SECONDS,
+    UPSTREAM_SEARCH_SECONDS,
+    count_embedding_calls,
+    embedding_called,
+    in_context,
+)
+from api.sessions import get_http_session
+from api.tracing import CLIENT, span
 
 NATURAL_LANGUAGE_PROCESSING_CONTEXT = """
 You are a tool to extract keyword search terms by category from a given search request. 
@@ -114,32 +124,82 @@ SEARCH_FACETS = {
 }
 
 
+def solr_get(url: str, query: str) -> requests.Response:
+    """
+    GET against an ESGF search (Solr) node, timed per node.
+    """
+    node = urlparse(url).netloc
+    with UPSTREAM_SEARCH_SECONDS.labels("esgf", node, query).time(), span(
+        "esgf.search", kind=CLIENT, node=node, query=query
+    ):
+        return get_http_session().get(url)
+
+
 class ESGFProvider(BaseSearchProvider):
     def __init__(self, openai_client):
         print("initializing esgf search provider")
         self.client: OpenAI = openai_client
         self.embeddings = {}
+        # one load at a time - searches during a load wait for it instead of starting another
+        self.embeddings_lock = threading.Lock()
+        self.embeddings_thread: threading.Thread | None = None
+        self.embeddings_error: str | None = None
 
     def initialize_embeddings(self, force_refresh=False):
         """
         creates string embeddings if needed, otherwise reloads from cache.
         force_refresh is needed if the list of facets changes.
         """
-        cache = Path("./embedding_cache")
-        if cache.exists() and not force_refresh:
-            print("embedding cache exists", flush=True)
-            with cache.open("rb") as f:
-                self.embeddings = pickle.load(f)
-        else:
+        with self.embeddings_lock:
+            if len(self.embeddings.keys()) > 0 and not force_refresh:
+                return
+            cache = Path("./embedding_cache")
+            if cache.exists() and not force_refresh:
+                print("embedding cache exists", flush=True)
+                with cache.open("rb") as f:
+                    self.embeddings = pickle.load(f)
+                return
             print("no embedding cache, generating new", flush=True)
-            with cache.open(mode="wb") as f:
-                try:
-                    self.embeddings = self.extract_embedding_strings()
-                except Exception as e:
-                    raise IOError(
-                        f"failed to access OpenAI: is OPENAI_API_KEY set in env?: {e}"
-                    )
-                pickle.dump(self.embeddings, f)
+            try:
+                embeddings = self.extract_embedding_strings()
+            except Exception as e:
+                raise IOError(
+                    f"failed to access OpenAI: is OPENAI_API_KEY set in env?: {e}"
+                )
+            # written whole, so a failed or interrupted build leaves no broken cache behind
+            temp = cache.with_suffix(".tmp")
+            with temp.open(mode="wb") as f:
+                pickle.dump(embeddings, f)
+            temp.replace(cache)
+            self.embeddings = embeddings
+
+    def load_embeddings_in_background(self, force_refresh=False):
+        """
+        initialize_embeddings on a daemon thread, unless a load is already running. a failed
+        load is kept in embeddings_error until the next one starts. searches keep using the
+        current embeddings while a refresh runs.
+        """
+
+        def load():
+            try:
+                self.initialize_embeddings(force_refresh)
+                self.embeddings_error = None
+            except Exception as e:
+                self.embeddings_error = str(e)
+                print(f"failed to load embeddings: {e}", flush=True)
+
+        if self.embeddings_loading():
+            return
+        self.embeddings_thread = threading.Thread(
+            target=load, name="esgf-embeddings", daemon=True
+        )
+        self.embeddings_thread.start()
+
+    def embeddings_loading(self) -> bool:
+        return self.embeddings_thread is not None and self.embeddings_thread.is_alive()
+
+    def embeddings_ready(self) -> bool:
+        return len(self.embeddings.keys()) > 0
 
     def is_terarium_hmi_dataset(self, dataset_id: str) -> bool:
         """
@@ -158,7 +218,8 @@ class ESGFProvider(BaseSearchProvider):
         """
         if len(self.embeddings.keys()) == 0 or force_refresh_cache:
             self.initialize_embeddings(force_refresh_cache)
-        return self.natural_language_search(query, page)
+        with count_embedding_calls("esgf"):
+            return self.natural_language_search(query, page)
 
     def get_all_access_paths_by_id(self, dataset_id: str) -> AccessURLs:
         return [
@@ -188,7 +249,7 @@ class ESGFProvider(BaseSearchProvider):
             }
         )
         full_url = f"{default_settings.esgf_url}/search?{params}"
-        r = requests.get(full_url)
+        r = solr_get(full_url, "files")
         response = r.json()
         if r.status_code != 200:
             raise ConnectionError(
@@ -223,6 +284,18 @@ class ESGFProvider(BaseSearchProvider):
 
         return {"opendap": opendap_urls, "http": http_urls}
 
+    def get_file_metadata_by_id(self, dataset_id: str) -> List[Dict[str, Any]]:
+        """
+        returns filename and size in bytes of each file in a dataset, taken from the first mirror.
+        """
+        mirrors = self.get_mirrors_for_dataset(dataset_id)
+        if len(mirrors) == 0:
+            return []
+        return [
+            {"filename": f.get("title", ""), "size": int(f.get("size", 0))}
+            for f in self.get_datasets_from_id(mirrors[0])
+        ]
+
     def get_metadata_for_dataset(self, dataset_id: str) -> Dict[str, Any]:
         """
         returns a list of OPENDAP URLs for use in processing given a dataset.
@@ -272,17 +345,20 @@ class ESGFProvider(BaseSearchProvider):
         """
         runs query against LLM and returns the result string.
         """
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": NATURAL_LANGUAGE_PROCESSING_CONTEXT},
-                {
-                    "role": "user",
-                    "content": self.build_natural_language_prompt(search_query),
-                },
-            ],
-            temperature=0.7,
-        )
+        with OPENAI_SECONDS.labels("esgf", "chat").time(), span(
+            "openai.chat", kind=CLIENT
+        ):
+            response = self.client.chat.completions.create(
+                model="gpt-4",
+                messages=[
+                    {"role": "system", "content": NATURAL_LANGUAGE_PROCESSING_CONTEXT},
+                    {
+                        "role": "user",
+                        "content": self.build_natural_language_prompt(search_query),
+                    },
+                ],
+                temperature=0.7,
+            )
         query = response.choices[0].message.content or ""
         print(query)
         query = query[query.find("{") :]
@@ -310,7 +386,7 @@ class ESGFProvider(BaseSearchProvider):
         )
 
         full_url = f"{default_settings.esgf_url}/search?{encoded_string}"
-        r = requests.get(full_url)
+        r = solr_get(full_url, "datasets")
         if r.status_code != 200:
             error = str(r.content)
             raise ConnectionError(
@@ -330,20 +406,25 @@ class ESGFProvider(BaseSearchProvider):
 
     def get_embedding(self, text):
         """returns an embedding for a single string."""
-        return (
-            self.client.embeddings.create(input=[text], model="text-embedding-ada-002")
-            .data[0]
-            .embedding
-        )
+        embedding_called("esgf")
+        with OPENAI_SECONDS.labels("esgf", "embeddings").time(), span(
+            "openai.embeddings", kind=CLIENT, inputs=1
+        ):
+            response = self.client.embeddings.create(
+                input=[text], model="text-embedding-ada-002"
+            )
+        return response.data[0].embedding
 
     def get_embeddings(self, text):
         """returns a list of embeddings for a list of strings."""
-        return [
-            e.embedding
-            for e in self.client.embeddings.create(
+        embedding_called("esgf")
+        with OPENAI_SECONDS.labels("esgf", "embeddings").time(), span(
+            "openai.embeddings", kind=CLIENT, inputs=len(text)
+        ):
+            response = self.client.embeddings.create(
                 input=text, model="text-embedding-ada-002"
-            ).data
-        ]
+            )
+        return [e.embedding for e in response.data]
 
     def cosine_similarity(self, a, b):
         return dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
@@ -369,7 +450,7 @@ class ESGFProvider(BaseSearchProvider):
         )
 
         print("querying fields", flush=True)
-        r = requests.get(facet_possibilities)
+        r = solr_get(facet_possibilities, "facets")
         if r.status_code != 200:
             raise ConnectionError(
                 f"Failed to get facet potential values from ESGF node: {facet_possibilities} {r.status_code}"
@@ -391,6 +472,7 @@ class ESGFProvider(BaseSearchProvider):
 
     def get_single_best_match(self, text, similar_fields):
         @dask.delayed
+        @in_context
         def get_best_match_from_field(self, text, field):
             embedding = (
                 self.get_embedding(text)
@@ -472,6 +554,7 @@ class ESGFProvider(BaseSearchProvider):
         # append to matched" workflow. returns (matched, fallback) to be zipped over;
         # if matched, return (token, None), if fallback, return (None, (phrase, similarity))
         @dask.delayed
+        @in_context
         def inner_iterator(t):
             if len(t) == 9 and t[0] == "v" and t[1:].isdigit():
                 print(f"  date match: {t}")
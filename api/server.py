@@ -1,39 +1,188 @@
-from fastapi import FastAPI, Request, Depends
-from api.processing.providers.era5 import download_era5_subset, era5_subset_job
+import json
+from fastapi import FastAPI, Request, Depends, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from api.search.providers.era5 import ERA5Provider, ERA5SearchData
 from api.search.providers.esgf import ESGFProvider
-from api.processing.providers.esgf import (
-    slice_and_store_dataset,
+from api.dataset.job_queue import (
+    LARGE_SUBSET_QUEUE,
+    PREVIEW_QUEUE,
+    SUBSET_QUEUE,
+    JobNotCancellableError,
+    UserJobLimitError,
+    cancel_job,
+    create_job,
+    create_sharded_job,
+    fetch_job_status_async,
+    fetch_job_statuses_async,
+    find_cached_job,
+    find_coalesced_job,
+    get_async_redis,
+    get_redis,
+    job_event_stream,
+    request_cache_key,
 )
-from api.dataset.job_queue import create_job, fetch_job_status, get_redis
+from api.dataset.models import DatasetQueryParameters
+from api.processing.filters import options_from_url_parameters
+from api.processing.estimate import estimate_esgf_subset
+from api.settings import default_settings
 from openai import OpenAI
 from urllib.parse import parse_qs
 from typing import List, Dict
-from api.preview.render import render_preview_for_dataset
+from api.preview.cache import frame_key_from_name, get_preview_cache
+from api.dataset.remote import open_dataset
+from api.metrics import SEARCH_SECONDS, metrics_response
+from api.dataset.profiling import folded_stacks, profile_key
+from api.tracing import SERVER, span, tracing_enabled
+
+# jobs are enqueued by name - the API never runs them, so it doesn't import them or the
+# matplotlib, cartopy and cdsapi they load
+ESGF_SUBSET_JOB = "api.processing.providers.esgf.slice_and_store_dataset"
+ESGF_SHARD_JOB = "api.processing.providers.esgf.slice_esgf_shard"
+ESGF_MERGE_JOB = "api.processing.providers.esgf.merge_and_store_shards"
+ERA5_SUBSET_JOB = "api.processing.providers.era5.era5_subset_job"
+PREVIEW_JOB = "api.preview.render.render_preview_for_dataset"
 
 app = FastAPI(docs_url="/")
 client = OpenAI()
 
+# facet embeddings load in the background - the API serves everything but ESGF search while
+# they do, and /ready reports when they are loaded
 esgf = ESGFProvider(client)
-esgf.initialize_embeddings()
+esgf.load_embeddings_in_background()
 
 era5 = ERA5Provider(client)
 
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # the root span of every request - continues the caller's trace from a traceparent header
+    with span(
+        f"{request.method} {request.url.path}",
+        request.headers.get("traceparent", None),
+        SERVER,
+        **{"http.method": request.method, "http.target": str(request.url)},
+    ) as current:
+        response = await call_next(request)
+        current.set_attribute("http.status_code", response.status_code)
+    if tracing_enabled():
+        response.headers["traceparent"] = current.traceparent
+    return response
+
+
 def params_to_dict(request: Request) -> Dict[str, str | List[str]]:
     lists = parse_qs(request.url.query, keep_blank_values=True)
     return {k: v[0] if len(v) == 1 else v for k, v in lists.items()}
 
 
+def request_user(request: Request) -> str:
+    """
+    who a request counts against for job limits and cancellation. the API has no auth of its
+    own: a trusted proxy in front of it can name the user in user_identity_header, otherwise
+    requests are told apart by client address.
+    """
+    header = default_settings.user_identity_header
+    if header != "" and request.headers.get(header, "") != "":
+        return f"user:{request.headers[header]}"
+    return f"client:{request.client.host if request.client else 'unknown'}"
+
+
+def split_job_ids(job_ids: str) -> List[str]:
+    return [i.strip() for i in job_ids.split(",") if i.strip() != ""]
+
+
+@app.get(path="/status/batch")
+async def job_status_batch(job_ids: str, redis=Depends(get_async_redis)):
+    ids = split_job_ids(job_ids)
+    statuses = await fetch_job_statuses_async(ids, redis)
+    return {"jobs": dict(zip(ids, statuses))}
+
+
+@app.get(path="/status/events")
+async def job_status_events(job_ids: str, redis=Depends(get_async_redis)):
+    return StreamingResponse(
+        job_event_stream(split_job_ids(job_ids), redis),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get(path="/status/{job_id}")
-async def job_status(job_id: str, redis=Depends(get_redis)):
-    return fetch_job_status(job_id, redis=redis)
+async def job_status(job_id: str, redis=Depends(get_async_redis)):
+    return await fetch_job_status_async(job_id, redis)
 
 
+@app.post(path="/status/{job_id}/cancel")
+def job_cancel(request: Request, job_id: str, redis=Depends(get_redis)):
+    """
+    cancels a queued job, or stops a running one and frees its worker. sharded jobs are
+    canceled along with their shards. only the user who enqueued a job can cancel it.
+    """
+    try:
+        return cancel_job(job_id, redis, request_user(request))
+    except JobNotCancellableError as e:
+        return JSONResponse({"error": f"{e}"}, status_code=403)
+
+
+@app.get(path="/ready")
+async def ready(redis=Depends(get_async_redis)):
+    """
+    200 once the API can serve every endpoint - for orchestrators to gate traffic on.
+    503 with what is missing while it can't.
+    """
+    checks = {"embeddings": esgf.embeddings_ready()}
+    try:
+        checks["redis"] = bool(await redis.ping())
+    except Exception:
+        checks["redis"] = False
+    body = {"ready": all(checks.values()), "checks": checks}
+    if esgf.embeddings_error is not None:
+        body["error"] = esgf.embeddings_error
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
+@app.get(path="/metrics")
+def metrics():
+    # plain def - queue gauges are read from redis at scrape time
+    content, content_type = metrics_response()
+    return Response(content=content, media_type=content_type)
+
+
+@app.get(path="/status/{job_id}/profile")
+async def job_profile(
+    job_id: str, format: str = "folded", redis=Depends(get_async_redis)
+):
+    raw = await redis.get(profile_key(job_id))
+    if raw is None:
+        return JSONResponse({"error": f"no profile for job {job_id}"}, status_code=404)
+    if format == "json":
+        return Response(content=raw, media_type="application/json")
+    if format != "folded":
+        return JSONResponse(
+            {"error": f"unknown profile format {format}, expected folded or json"},
+            status_code=400,
+        )
+    return Response(content=folded_stacks(json.loads(raw)), media_type="text/plain")
+
+
+# plain def - searches call OpenAI and ESGF search nodes. embeddings are only ever loaded in the
+# background: while none are loaded, searches get a 503 and a failed load is retried
 @app.get("/search/esgf")
-async def esgf_search(query: str = "", page: int = 1, refresh_cache=False):
+def esgf_search(query: str = "", page: int = 1, refresh_cache: bool = False):
+    if refresh_cache:
+        esgf.load_embeddings_in_background(force_refresh=True)
+    if not esgf.embeddings_ready():
+        error = esgf.embeddings_error
+        esgf.load_embeddings_in_background()
+        return JSONResponse(
+            {
+                "error": "search is starting up: facet embeddings are loading"
+                + (f" (the last load failed: {error})" if error is not None else "")
+            },
+            status_code=503,
+        )
     try:
-        datasets = esgf.search(query, page, refresh_cache)
+        with SEARCH_SECONDS.labels("esgf").time():
+            datasets = esgf.search(query, page)
     except Exception as e:
         return {"error": f"failed to fetch datasets: {e}"}
     return {"results": datasets}
@@ -41,7 +190,8 @@ async def esgf_search(query: str = "", page: int = 1, refresh_cache=False):
 
 @app.get("/search/era5")
 async def era5_search(query: str = ""):
-    datasets = era5.search(query)
+    with SEARCH_SECONDS.labels("era5").time():
+        datasets = era5.search(query)
     return {"results": datasets}
 
 
@@ -52,27 +202,103 @@ async def esgf_fetch(dataset_id: str):
     return {"dataset": dataset_id, "urls": urls, "metadata": metadata}
 
 
+def regrid_target_access_paths(params: Dict[str, str | List[str]]):
+    regrid_target = params.get(DatasetQueryParameters.regrid_target.value, None)
+    if regrid_target is None:
+        return None
+    return esgf.get_all_access_paths_by_id(regrid_target)
+
+
+# plain def - opening the remote dataset for the estimate and the ESGF lookups block, so these
+# run in the threadpool instead of stalling status reads and event streams
+@app.get(path="/subset/esgf/estimate")
+def esgf_subset_estimate(request: Request, dataset_id: str):
+    params = params_to_dict(request)
+    try:
+        urls = esgf.get_all_access_paths_by_id(dataset_id)
+        files = esgf.get_file_metadata_by_id(dataset_id)
+        estimate = estimate_esgf_subset(
+            urls, files, params, regrid_target_access_paths(params)
+        )
+    except Exception as e:
+        return {"error": f"failed to estimate subset: {e}"}
+    return estimate
+
+
 @app.get(path="/subset/esgf")
-async def esgf_subset(
+def esgf_subset(
     request: Request,
     parent_id: str,
     dataset_id: str,
     variable_id: str = "",
+    profile: bool = False,
     redis=Depends(get_redis),
 ):
     params = params_to_dict(request)
+    params.pop("profile", None)
+    user = request_user(request)
+    try:
+        options = options_from_url_parameters(params)
+    except Exception as e:
+        return {"error": f"invalid subset options: {e}"}
+    # identical requests share one result - parent_id only affects provenance.
+    # profiled requests always run, so there is something to profile
+    cache_key = None
+    if not profile:
+        cache_key = request_cache_key(
+            "subset", dataset_id.split("|")[0], options.model_dump(), variable_id
+        )
+        cached = find_cached_job(cache_key, redis)
+        if cached is not None:
+            return cached
+
     urls = esgf.get_all_access_paths_by_id(dataset_id)
-    job = create_job(
-        func=slice_and_store_dataset,
-        args=[urls, parent_id, dataset_id, params, variable_id],
-        redis=redis,
-        queue="subset",
-    )
-    return job
+    regrid_target_urls = regrid_target_access_paths(params)
+    queue = SUBSET_QUEUE
+    shards = []
+    if default_settings.subset_estimate_on_enqueue:
+        try:
+            files = esgf.get_file_metadata_by_id(dataset_id)
+            estimate = estimate_esgf_subset(urls, files, params, regrid_target_urls)
+            if estimate.rejected:
+                return {"error": estimate.reason, "estimate": estimate}
+            queue = estimate.queue
+            shards = estimate.shards
+        except Exception as e:
+            # the job itself reports upstream problems - don't block on a failed estimate
+            print(f"failed to estimate subset, enqueueing anyway: {e}", flush=True)
+    try:
+        if len(shards) > 1:
+            return create_sharded_job(
+                shard_func=ESGF_SHARD_JOB,
+                shard_args=[
+                    [urls, dataset_id, params, timestamps, regrid_target_urls]
+                    for timestamps in shards
+                ],
+                merge_func=ESGF_MERGE_JOB,
+                merge_args=[parent_id, dataset_id, params, variable_id],
+                redis=redis,
+                queue=queue,
+                cache_key=cache_key,
+                profile=profile,
+                user=user,
+            )
+        return create_job(
+            func=ESGF_SUBSET_JOB,
+            args=[urls, parent_id, dataset_id, params, variable_id, regrid_target_urls],
+            redis=redis,
+            queue=queue,
+            cache_key=cache_key,
+            profile=profile,
+            user=user,
+        )
+    except UserJobLimitError as e:
+        return JSONResponse({"error": f"{e}"}, status_code=429)
 
 
 @app.get(path="/subset/era5")
-async def era5_subset(
+def era5_subset(
+    request: Request,
     parent_id: str,
     dataset_name: str,
     product_type: str,
@@ -81,38 +307,122 @@ async def era5_subset(
     months: str,
     years: str,
     hours: str,
+    profile: bool = False,
     redis=Depends(get_redis),
 ):
     sd = ERA5SearchData(
         dataset_name=dataset_name, product_type=product_type, variable=variable
     )
-    job = create_job(
-        func=era5_subset_job,
-        args=[sd, parent_id, days, months, years, hours],
-        redis=redis,
-        queue="subset",
-    )
-    return job
+    # CDS requests wait in the Copernicus queue for minutes to hours - batch work
+    try:
+        return create_job(
+            func=ERA5_SUBSET_JOB,
+            args=[sd, parent_id, days, months, years, hours],
+            redis=redis,
+            queue=LARGE_SUBSET_QUEUE,
+            profile=profile,
+            user=request_user(request),
+        )
+    except UserJobLimitError as e:
+        return JSONResponse({"error": f"{e}"}, status_code=429)
 
 
+# plain def, like the subset handlers - the ESGF lookup and enqueue block
 @app.get(path="/preview/esgf")
-async def esgf_preview(
+def esgf_preview(
+    request: Request,
     dataset_id: str,
     variable_id: str = "",
     time_index: str = "",
     timestamps: str = "",
     analyze: bool = False,
+    frame_period: str = "year",
+    profile: bool = False,
     redis=Depends(get_redis),
 ):
-    dataset = (
-        dataset_id
-        if esgf.is_terarium_hmi_dataset(dataset_id)
-        else esgf.get_all_access_paths_by_id(dataset_id)
+    is_hmi = esgf.is_terarium_hmi_dataset(dataset_id)
+    coalesce_key = request_cache_key(
+        "preview",
+        dataset_id.lower() if is_hmi else dataset_id.split("|")[0],
+        variable_id,
+        time_index,
+        ",".join(t.strip() for t in timestamps.split(",")),
+        analyze,
+        frame_period,
     )
-    job = create_job(
-        func=render_preview_for_dataset,
-        args=[dataset, variable_id, time_index, timestamps, analyze],
-        redis=redis,
-        queue="preview",
+    if profile or default_settings.preview_coalesce_ttl <= 0:
+        coalesce_key = None
+    else:
+        existing = find_coalesced_job(coalesce_key, redis)
+        if existing is not None:
+            return existing
+    dataset = dataset_id if is_hmi else esgf.get_all_access_paths_by_id(dataset_id)
+    try:
+        return create_job(
+            func=PREVIEW_JOB,
+            args=[
+                dataset,
+                variable_id,
+                time_index,
+                timestamps,
+                analyze,
+                dataset_id.split("|")[0],
+                frame_period,
+            ],
+            redis=redis,
+            queue=PREVIEW_QUEUE,
+            coalesce_key=coalesce_key,
+            coalesce_ttl=default_settings.preview_coalesce_ttl,
+            profile=profile,
+            user=request_user(request),
+        )
+    except UserJobLimitError as e:
+        return JSONResponse({"error": f"{e}"}, status_code=429)
+
+
+@app.get(path="/preview/image/{name}")
+def preview_image(name: str):
+    # frame keys hash the dataset version and render settings - their content never changes
+    key = frame_key_from_name(name)
+    chunks = get_preview_cache().stream(key) if key is not None else None
+    if chunks is None:
+        return JSONResponse({"error": f"no preview image {name}"}, status_code=404)
+    return StreamingResponse(
+        chunks,
+        media_type="image/png",
+        headers={
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "ETag": f'"{name.split(".")[0]}"',
+        },
+    )
+
+
+@app.get(path="/tiles/{dataset_id}/{variable_id}/{time}/{z}/{x}/{y}.png")
+def esgf_tile(dataset_id: str, variable_id: str, time: str, z: int, x: int, y: int):
+    # plain def - tiles are read and rendered in the threadpool, off the event loop.
+    # imported here, so only API processes that serve tiles load matplotlib
+    from api.preview.tiles import render_tile
+
+    key = dataset_id.split("|")[0]
+    try:
+        tile = render_tile(
+            key,
+            variable_id,
+            time,
+            z,
+            x,
+            y,
+            open=lambda: open_dataset(esgf.get_all_access_paths_by_id(dataset_id)),
+        )
+    except (KeyError, ValueError) as e:
+        return JSONResponse({"error": f"{e}"}, status_code=404)
+    except IOError as e:
+        return JSONResponse(
+            {"error": f"upstream hosting is likely having a problem. {e}"},
+            status_code=502,
+        )
+    return Response(
+        content=tile,
+        media_type="image/png",
+        headers={"Cache-Control": f"public, max-age={default_settings.tile_max_age}"},
     )
-    return job
@@ -0,0 +1,27 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+
+# one HTTP session per process for ESGF search and data nodes and Terarium, so connections
+# (and their TLS handshakes) are reused across requests - and across jobs in workers that
+# keep their process (see api.dataset.worker). sessions are never shared over a fork: a
+# forked process gets a new one.
+
+# connections kept open per host
+HTTP_POOL_CONNECTIONS = 16
+
+_session: requests.Session | None = None
+_session_pid: int | None = None
+
+
+def get_http_session() -> requests.Session:
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_CONNECTIONS
+        )
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+        _session_pid = os.getpid()
+    return _session
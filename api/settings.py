@@ -16,6 +16,23 @@ class Settings(BaseSettings):
 
     redis_host: str = Field(os.environ.get("REDIS_HOST", "redis-climate-data"))
     redis_port: int = Field(os.environ.get("REDIS_PORT", 6379))
+    # per process, shared by all requests - requests wait for a free connection past this
+    redis_max_connections: int = Field(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+
+    # identical subset requests reuse finished results for job_cache_result_ttl seconds (0 keeps them),
+    # and attach to a running job for up to job_cache_inflight_ttl seconds
+    job_cache_result_ttl: int = Field(
+        os.environ.get("JOB_CACHE_RESULT_TTL", 30 * 24 * 60 * 60)
+    )
+    job_cache_inflight_ttl: int = Field(
+        os.environ.get("JOB_CACHE_INFLIGHT_TTL", 24 * 60 * 60)
+    )
+    # added to every cache key, next to a hash of the processing code - deployments can set it
+    # to force a fresh cache
+    job_cache_version: str = Field(os.environ.get("JOB_CACHE_VERSION", ""))
+
+    # identical preview requests share one job for this many seconds (0 runs a job per request)
+    preview_coalesce_ttl: int = Field(os.environ.get("PREVIEW_COALESCE_TTL", 60 * 60))
 
     minio_url: str = Field(os.environ.get("MINIO_URL", "http://minio:9000"))
     minio_user: str = Field(os.environ.get("MINIO_USER", "miniouser"))
@@ -24,6 +41,92 @@ class Settings(BaseSettings):
         os.environ.get("MINIO_BUCKET_NAME", "climate-data-test-bucket")
     )
 
+    regrid_cache_dir: str = Field(os.environ.get("REGRID_CACHE_DIR", "./regrid_cache"))
+
+    # subsets are estimated before being enqueued - anything reading more than
+    # subset_large_job_bytes goes to the large job queue, more than subset_max_bytes is rejected.
+    subset_estimate_on_enqueue: bool = Field(
+        os.environ.get("SUBSET_ESTIMATE_ON_ENQUEUE", "true").lower() == "true"
+    )
+    subset_large_job_bytes: int = Field(
+        os.environ.get("SUBSET_LARGE_JOB_BYTES", 2 * 1024**3)
+    )
+    subset_max_bytes: int = Field(os.environ.get("SUBSET_MAX_BYTES", 50 * 1024**3))
+    # large subsets are split into time shards along source file boundaries. shards run on the
+    # subset-large queue, so at most as many run at once as there are batch workers
+    subset_max_shards: int = Field(os.environ.get("SUBSET_MAX_SHARDS", 16))
+
+    # job timeouts in seconds per queue (-1 for none) - past it the worker kills the job
+    preview_job_timeout: int = Field(os.environ.get("PREVIEW_JOB_TIMEOUT", 15 * 60))
+    subset_job_timeout: int = Field(os.environ.get("SUBSET_JOB_TIMEOUT", 60 * 60))
+    subset_large_job_timeout: int = Field(
+        os.environ.get("SUBSET_LARGE_JOB_TIMEOUT", -1)
+    )
+    # jobs one user may have queued or running per queue, 0 for no limit - further requests are
+    # refused until one finishes or is canceled. the API has no auth: users are told apart by
+    # user_identity_header when a trusted proxy in front of the API sets it (e.g. the user of an
+    # auth proxy), otherwise by client address - behind a proxy that doesn't set it, every
+    # request shares one user
+    user_identity_header: str = Field(os.environ.get("USER_IDENTITY_HEADER", ""))
+    preview_user_max_jobs: int = Field(os.environ.get("PREVIEW_USER_MAX_JOBS", 10))
+    subset_user_max_jobs: int = Field(os.environ.get("SUBSET_USER_MAX_JOBS", 10))
+    subset_large_user_max_jobs: int = Field(
+        os.environ.get("SUBSET_LARGE_USER_MAX_JOBS", 2)
+    )
+
+    # rendered preview frames - always cached on local disk up to preview_cache_max_bytes,
+    # and shared through the object store bucket when preview_cache_object_store is set
+    preview_cache_dir: str = Field(
+        os.environ.get("PREVIEW_CACHE_DIR", "./preview_cache")
+    )
+    preview_cache_max_bytes: int = Field(
+        os.environ.get("PREVIEW_CACHE_MAX_BYTES", 1024**3)
+    )
+    preview_cache_object_store: bool = Field(
+        os.environ.get("PREVIEW_CACHE_OBJECT_STORE", "false").lower() == "true"
+    )
+
+    # preview frames are rendered over a process pool, loading at most
+    # preview_render_memory_bytes of frame data at a time
+    preview_render_workers: int = Field(
+        os.environ.get("PREVIEW_RENDER_WORKERS", os.cpu_count() or 1)
+    )
+    preview_render_memory_bytes: int = Field(
+        os.environ.get("PREVIEW_RENDER_MEMORY_BYTES", 512 * 1024**2)
+    )
+
+    # preview jobs return base64 images instead of /preview/image URLs when set
+    preview_inline_images: bool = Field(
+        os.environ.get("PREVIEW_INLINE_IMAGES", "false").lower() == "true"
+    )
+
+    # map tiles - datasets kept open in the serving process, and the browser cache lifetime
+    tile_warm_datasets: int = Field(os.environ.get("TILE_WARM_DATASETS", 4))
+    tile_max_age: int = Field(os.environ.get("TILE_MAX_AGE", 24 * 60 * 60))
+
+    # jobs enqueued with profile=true - stack sampling interval in seconds, and how long
+    # profiles are kept (0 keeps them)
+    profile_interval: float = Field(os.environ.get("PROFILE_INTERVAL", 0.01))
+    profile_ttl: int = Field(os.environ.get("PROFILE_TTL", 24 * 60 * 60))
+
+    # spans are appended to trace_file (OTLP/JSON lines) - tracing is off when empty
+    trace_file: str = Field(os.environ.get("TRACE_FILE", ""))
+    trace_service_name: str = Field(
+        os.environ.get("TRACE_SERVICE_NAME", "climate-data")
+    )
+
+    # port of the worker metrics exporter (`python -m api.metrics`)
+    worker_metrics_port: int = Field(os.environ.get("WORKER_METRICS_PORT", 9100))
+
+    # workers load heavy modules and shared resources once at startup (see api.dataset.preload),
+    # and are replaced after worker_max_jobs jobs or once a persistent worker's resident memory
+    # passes worker_max_memory_bytes (0 for no limit)
+    worker_preload: bool = Field(
+        os.environ.get("WORKER_PRELOAD", "true").lower() == "true"
+    )
+    worker_max_jobs: int = Field(os.environ.get("WORKER_MAX_JOBS", 0))
+    worker_max_memory_bytes: int = Field(os.environ.get("WORKER_MAX_MEMORY_BYTES", 0))
+
     terarium_url: str = Field(
         os.environ.get("TERARIUM_URL", "https://server.staging.terarium.ai")
     )
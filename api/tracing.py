@@ -0,0 +1,205 @@
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator
+from api.settings import default_settings
+
+# request tracing from the API handler through the rq queue into the worker. the handler's
+# span context is passed to jobs as a W3C traceparent in the `trace_context` job kwarg, next
+# to `job_id`, and the worker continues the trace from it:
+#
+#   GET /subset/esgf
+#     esgf.search (access paths)    rq.enqueue
+#                                     rq.queued    job slice_and_store_dataset
+#                                                    open    load    write    upload
+#                                                                               terarium.create
+#
+# finished spans are appended to TRACE_FILE as OTLP/JSON export requests, one per line, which
+# the OpenTelemetry collector's file receivers and most trace viewers read. tracing is off
+# while TRACE_FILE is empty.
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# OTLP span kinds
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+PRODUCER = 4
+CONSUMER = 5
+
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "current_span", default=None
+)
+_export_lock = threading.Lock()
+
+
+def tracing_enabled() -> bool:
+    return default_settings.trace_file != ""
+
+
+def unix_nanos(moment: datetime) -> int:
+    # rq timestamps are naive UTC
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1e9)
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: str | None,
+        kind: int = INTERNAL,
+        attributes: Dict[str, Any] | None = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self.error: str | None = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        export(self)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": otlp_attributes(self.attributes),
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_attributes(attributes: Dict[str, Any]) -> list:
+    def value(v):
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": str(v)}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+
+    return [{"key": k, "value": value(v)} for k, v in attributes.items()]
+
+
+def export(span: Span):
+    if not tracing_enabled():
+        return
+    request = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": otlp_attributes(
+                        {
+                            "service.name": default_settings.trace_service_name,
+                            "process.pid": os.getpid(),
+                        }
+                    )
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "climate-data"}, "spans": [span.to_otlp()]}
+                ],
+            }
+        ]
+    }
+    try:
+        with _export_lock, open(default_settings.trace_file, "a") as f:
+            f.write(json.dumps(request) + "\n")
+    except OSError as e:
+        # tracing is best effort - it never fails a request or a job
+        print(f"failed to export span {span.name}: {e}", flush=True)
+
+
+def start_span(
+    name: str,
+    parent: str | None = None,
+    kind: int = INTERNAL,
+    attributes: Dict[str, Any] | None = None,
+) -> Span:
+    """
+    a span under `parent` (a traceparent) if given and valid, otherwise under the current span,
+    otherwise the root of a new trace. it is not made current - see `span`.
+    """
+    match = TRACEPARENT.match(parent or "")
+    current = _current_span.get()
+    if match is not None:
+        trace_id, parent_id = match.groups()
+    elif current is not None:
+        trace_id, parent_id = current.trace_id, current.span_id
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+    return Span(name, trace_id, parent_id, kind, attributes)
+
+
+@contextmanager
+def span(
+    name: str, parent: str | None = None, kind: int = INTERNAL, **attributes: Any
+) -> Iterator[Span]:
+    """
+    times the block as a span, current while the block runs. errors are recorded on the span.
+    """
+    current = start_span(name, parent, kind, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = str(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def current_traceparent() -> str | None:
+    """
+    context of the current span to pass on to jobs, None when tracing is off.
+    """
+    current = _current_span.get()
+    if current is None or not tracing_enabled():
+        return None
+    return current.traceparent
+
+
+@contextmanager
+def job_span(job) -> Iterator[Span]:
+    """
+    continues the trace a job was enqueued in: the time it waited in the queue, then the job.
+    """
+    parent = job.kwargs.get("trace_context", None)
+    if parent is not None and job.enqueued_at is not None:
+        queued = start_span("rq.queued", parent, attributes={"job.id": job.id})
+        queued.start_ns = unix_nanos(job.enqueued_at)
+        queued.end()
+    with span(
+        f"job {job.func_name.split('.')[-1]}",
+        parent,
+        CONSUMER,
+        **{"job.id": job.id, "job.function": job.func_name, "job.queue": job.origin},
+    ) as current:
+        yield current
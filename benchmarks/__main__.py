@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+from benchmarks.cases import CASES, Benchmark, Context
+from benchmarks.datasets import ensure_datasets
+
+# runs the benchmarks and compares them with a stored baseline:
+#
+#   python -m benchmarks                          # every case, against benchmarks/baseline.json
+#   python -m benchmarks -k render -r 5           # cases matching "render", 5 repetitions
+#   python -m benchmarks --save-baseline          # store this run as the new baseline
+#
+# a case regresses when its median latency is more than `--tolerance` over the baseline's -
+# the exit status is 1 if any case regressed. baselines are only comparable on the same
+# machine and settings (e.g. PREVIEW_RENDER_WORKERS).
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(benchmark: Benchmark, repeat: int, warmup: int) -> Dict[str, Any]:
+    run = benchmark.setup()
+    latencies = []
+    amount = 0.0
+    for i in range(warmup + repeat):
+        if benchmark.before is not None:
+            benchmark.before()
+        start = time.perf_counter()
+        amount = run()
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            latencies.append(elapsed)
+    median = statistics.median(latencies)
+    return {
+        "median": median,
+        "min": min(latencies),
+        "max": max(latencies),
+        "repeat": repeat,
+        "throughput": amount / median if median > 0 else 0,
+        "unit": benchmark.unit,
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any] | None, tolerance: float):
+    if baseline is None:
+        return ("new", None)
+    ratio = result["median"] / baseline["median"] if baseline["median"] > 0 else 1
+    if ratio > 1 + tolerance:
+        return ("REGRESSION", ratio)
+    if ratio < 1 - tolerance:
+        return ("faster", ratio)
+    return ("ok", ratio)
+
+
+def report(name: str, result: Dict[str, Any], verdict: str, ratio: float | None):
+    change = f"{ratio:6.2f}x" if ratio is not None else "      -"
+    print(
+        f"{name:<52} {result['median'] * 1000:>10.1f} ms {result['min'] * 1000:>10.1f} ms"
+        f" {result['throughput']:>10.2f} {result['unit'] + '/s':<10} {change} {verdict}",
+        flush=True,
+    )
+
+
+def machine() -> Dict[str, Any]:
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("-k", "--filter", default="", help="run cases containing this")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-w", "--warmup", type=int, default=1)
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(DIRECTORY, "data"),
+        help="where synthetic datasets are generated and kept",
+    )
+    parser.add_argument("--baseline", default=os.path.join(DIRECTORY, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative slowdown of the median that counts as a regression",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="seconds added to every stand-in request, to model remote services",
+    )
+    parser.add_argument("--output", help="write this run's results as JSON")
+    args = parser.parse_args(argv)
+
+    baseline: Dict[str, Any] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("machine") != machine():
+            print(f"baseline is from another machine: {baseline.get('machine')}")
+
+    paths = ensure_datasets(args.data_dir)
+    context = Context(paths, args.data_dir, args.latency)
+    results: Dict[str, Dict[str, Any]] = {}
+    regressions = []
+    print(
+        f"{'case':<52} {'median':>13} {'min':>13} {'throughput':>21} {'change':>7}",
+        flush=True,
+    )
+    try:
+        for cases in CASES:
+            for benchmark in cases(context):
+                if args.filter not in benchmark.name:
+                    continue
+                try:
+                    result = measure(benchmark, args.repeat, args.warmup)
+                except Exception as e:
+                    print(f"{benchmark.name:<52} failed: {e}", flush=True)
+                    continue
+                results[benchmark.name] = result
+                verdict, ratio = compare(
+                    result,
+                    baseline.get("results", {}).get(benchmark.name, None),
+                    args.tolerance,
+                )
+                report(benchmark.name, result, verdict, ratio)
+                if verdict == "REGRESSION":
+                    regressions.append(benchmark.name)
+    finally:
+        context.close()
+
+    run = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "machine": machine(),
+        "latency": args.latency,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+    if args.save_baseline:
+        # cases left out of this run keep their baseline
+        run["results"] = baseline.get("results", {}) | results
+        with open(args.baseline, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"saved baseline to {args.baseline}")
+    if len(regressions) > 0:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
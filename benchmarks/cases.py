@@ -0,0 +1,219 @@
+import os
+import shutil
+import tempfile
+import uuid
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+import xarray
+from api.dataset.remote import open_dataset
+from api.preview import cache
+from api.preview.render import render
+from api.processing.filters import options_from_url_parameters, subset_with_options
+from api.processing.providers.esgf import slice_and_store_dataset
+from api.search.providers.esgf import ESGFProvider
+from api.settings import default_settings
+from benchmarks.datasets import DATASETS
+from benchmarks.standins import FakeOpenAI, StandIns, facet_embeddings
+
+# the benchmark cases. `setup` runs untimed, once, and returns the function to time - which
+# returns the amount of work it did in `unit`s, so runs report throughput as well as latency.
+# `before` runs untimed before every repetition, e.g. to empty a cache for a cold run.
+
+
+@dataclass
+class Benchmark:
+    name: str
+    setup: Callable[[], Callable[[], float]]
+    unit: str
+    before: Callable[[], None] | None = None
+
+
+class Context:
+    """
+    stand-ins and settings shared by every case. settings are pointed at the stand-ins for
+    the lifetime of the context.
+    """
+
+    def __init__(self, paths: Dict[str, List[str]], directory: str, latency: float):
+        self.paths = paths
+        self.standins = StandIns(directory, latency)
+        self.openai = FakeOpenAI(latency)
+        self.workdir = tempfile.mkdtemp(prefix="climate-data-benchmarks-")
+        self.overrides = {
+            "esgf_url": self.standins.esgf_url,
+            "terarium_url": self.standins.terarium.url,
+            "preview_cache_dir": os.path.join(self.workdir, "preview_cache"),
+            "preview_cache_object_store": False,
+        }
+        self.saved = {k: getattr(default_settings, k) for k in self.overrides}
+        for k, v in self.overrides.items():
+            setattr(default_settings, k, v)
+        self.provider = ESGFProvider(self.openai)
+        self.provider.embeddings = facet_embeddings(self.standins.esgf_url)
+
+    def access_paths(self, key: str):
+        return self.provider.get_all_access_paths_by_id(DATASETS[key].dataset_id)
+
+    def open_local(self, key: str) -> xarray.Dataset:
+        return xarray.open_mfdataset(
+            self.paths[key], chunks={"time": 10}, use_cftime=True
+        )
+
+    def reset_preview_cache(self):
+        shutil.rmtree(default_settings.preview_cache_dir, ignore_errors=True)
+        cache._preview_cache = None
+
+    def close(self):
+        self.standins.stop()
+        for k, v in self.saved.items():
+            setattr(default_settings, k, v)
+        cache._preview_cache = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+SEARCH_QUERIES = {
+    "monthly-tas": "monthly near-surface air temperature BENCH-ESM historical",
+    "daily-variant": "daily tas r1i1p1f1 200 km",
+    "plev-before-date": "air temperature on pressure levels before 1855",
+}
+
+SUBSETS = {
+    "envelope-timestamps": (
+        "tas_Amon_2deg",
+        {"envelope": "200,300,10,60", "timestamps": "1860,1880"},
+    ),
+    "point": ("tas_day_2.5deg", {"point": "250.5,40.1"}),
+    "resample-yearly": ("tas_day_2.5deg", {"resample": "1YS"}),
+    "reduce-time-mean": ("tas_Amon_2deg", {"reduce": "mean", "reduce_fields": "time"}),
+    "coarsen-plev": ("ta_Amon_1deg", {"coarsen": "4", "coarsen_fields": "lat,lon"}),
+    "regrid": ("tas_Amon_2deg", {"regrid": "5", "timestamps": "1850,1854"}),
+}
+
+
+def search_cases(context: Context) -> List[Benchmark]:
+    def search(query: str):
+        def run():
+            context.provider.search(query, 1)
+            return 1
+
+        return lambda: run
+
+    return [
+        Benchmark(f"search/{name}", search(query), "queries")
+        for name, query in SEARCH_QUERIES.items()
+    ]
+
+
+def open_dataset_cases(context: Context) -> List[Benchmark]:
+    def open_(key: str):
+        def setup():
+            urls = context.access_paths(key)
+
+            def run():
+                open_dataset(urls).close()
+                return 1
+
+            return run
+
+        return setup
+
+    return [Benchmark(f"open_dataset/{key}", open_(key), "opens") for key in DATASETS]
+
+
+def subset_cases(context: Context) -> List[Benchmark]:
+    def subset(key: str, params: Dict[str, Any]):
+        def setup():
+            ds = context.open_local(key)
+            options = options_from_url_parameters(params)
+
+            def run():
+                subset_with_options(ds, options).load()
+                # throughput over the source dataset
+                return ds.nbytes / 1e6
+
+            return run
+
+        return setup
+
+    return [
+        Benchmark(f"subset_with_options/{name}", subset(key, params), "MB")
+        for name, (key, params) in SUBSETS.items()
+    ]
+
+
+def slice_and_store_cases(context: Context) -> List[Benchmark]:
+    def slice_and_store(key: str, params: Dict[str, Any]):
+        def setup():
+            urls = context.access_paths(key)
+            dataset_id = DATASETS[key].dataset_id
+
+            def run():
+                # subsets are written to the working directory
+                cwd = os.getcwd()
+                os.chdir(context.workdir)
+                try:
+                    result = slice_and_store_dataset(
+                        urls, "", dataset_id, params, "", job_id=str(uuid.uuid4())
+                    )
+                finally:
+                    os.chdir(cwd)
+                if not isinstance(result, dict) or result.get("status") != "ok":
+                    raise RuntimeError(f"subset failed: {result}")
+                return 1
+
+            return run
+
+        return setup
+
+    return [
+        Benchmark(
+            f"slice_and_store_dataset/{key}",
+            slice_and_store(key, params),
+            "subsets",
+        )
+        for key, params in [
+            ("tas_Amon_2deg", {"envelope": "200,300,10,60", "timestamps": "1860,1880"}),
+            ("tas_day_2.5deg", {"timestamps": "1851,1851"}),
+        ]
+    ]
+
+
+def render_cases(context: Context) -> List[Benchmark]:
+    def render_(key: str, timestamps: str, frame_period: str):
+        def setup():
+            ds = context.open_local(key)
+            dataset_id = DATASETS[key].dataset_id
+
+            def run():
+                return len(render(ds, "", "", timestamps, dataset_id, frame_period))
+
+            return run
+
+        return setup
+
+    cases = []
+    for key, timestamps, frame_period in [
+        ("tas_Amon_2deg", "1850,1899", "year"),
+        ("tas_day_2.5deg", "1850,1850", "month"),
+        ("ta_Amon_1deg", "", "year"),
+    ]:
+        setup = render_(key, timestamps, frame_period)
+        cases += [
+            Benchmark(
+                f"render/{key}-{frame_period}-cold",
+                setup,
+                "frames",
+                before=context.reset_preview_cache,
+            ),
+            Benchmark(f"render/{key}-{frame_period}-cached", setup, "frames"),
+        ]
+    return cases
+
+
+CASES: List[Callable[[Context], List[Benchmark]]] = [
+    search_cases,
+    open_dataset_cases,
+    subset_cases,
+    slice_and_store_cases,
+    render_cases,
+]
@@ -0,0 +1,216 @@
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List
+import numpy
+import xarray
+
+# synthetic CMIP6-like datasets for the benchmarks. each dataset is a set of NetCDF4 files
+# split along time like ESGF publishes them, with CF attributes, cftime calendars, zlib
+# compression and time chunking close to what modelling centers produce. files are generated
+# once into the data directory and reused - values are seeded, so they are identical across
+# runs and machines.
+
+INSTITUTION = "BENCH"
+SOURCE = "BENCH-ESM"
+EXPERIMENT = "historical"
+VARIANT = "r1i1p1f1"
+VERSION = "v20240101"
+
+
+@dataclass
+class SyntheticDataset:
+    variable: str
+    table: str
+    frequency: str
+    # grid spacing in degrees
+    resolution: float
+    start_year: int
+    years: int
+    years_per_file: int
+    levels: List[float] = field(default_factory=list)
+    units: str = "K"
+    standard_name: str = "air_temperature"
+    long_name: str = "Near-Surface Air Temperature"
+
+    @property
+    def dataset_id(self) -> str:
+        """
+        ESGF dataset id, with version and without mirror.
+        """
+        return ".".join(
+            [
+                "CMIP6",
+                "CMIP",
+                INSTITUTION,
+                SOURCE,
+                EXPERIMENT,
+                VARIANT,
+                self.table,
+                self.variable,
+                "gn",
+                VERSION,
+            ]
+        )
+
+    @property
+    def key(self) -> str:
+        return f"{self.variable}_{self.table}_{self.resolution:g}deg"
+
+    def file_spans(self) -> List[tuple[int, int]]:
+        return [
+            (year, min(year + self.years_per_file, self.start_year + self.years) - 1)
+            for year in range(
+                self.start_year, self.start_year + self.years, self.years_per_file
+            )
+        ]
+
+    def filename(self, first: int, last: int) -> str:
+        if self.frequency == "mon":
+            span = f"{first}01-{last}12"
+        else:
+            span = f"{first}0101-{last}1231"
+        return (
+            f"{self.variable}_{self.table}_{SOURCE}_{EXPERIMENT}_{VARIANT}_gn_{span}.nc"
+        )
+
+    def filenames(self) -> List[str]:
+        return [self.filename(first, last) for first, last in self.file_spans()]
+
+    def nbytes(self) -> int:
+        steps = self.years * (12 if self.frequency == "mon" else 365)
+        cells = int(180 / self.resolution) * int(360 / self.resolution)
+        return steps * cells * max(1, len(self.levels)) * 4
+
+
+# a monthly surface field, a daily surface field and a monthly field on pressure levels
+DATASETS: Dict[str, SyntheticDataset] = {
+    d.key: d
+    for d in [
+        SyntheticDataset("tas", "Amon", "mon", 2, 1850, 50, 25),
+        SyntheticDataset("tas", "day", "day", 2.5, 1850, 4, 1),
+        SyntheticDataset(
+            "ta",
+            "Amon",
+            "mon",
+            1,
+            1850,
+            5,
+            5,
+            levels=[100000, 85000, 50000, 25000],
+            long_name="Air Temperature",
+        ),
+    ]
+}
+
+
+def coordinates(dataset: SyntheticDataset) -> Dict[str, xarray.DataArray]:
+    lat = numpy.arange(-90 + dataset.resolution / 2, 90, dataset.resolution)
+    lon = numpy.arange(dataset.resolution / 2, 360, dataset.resolution)
+    coords = {
+        "lat": xarray.DataArray(
+            lat,
+            dims="lat",
+            attrs={"axis": "Y", "units": "degrees_north", "standard_name": "latitude"},
+        ),
+        "lon": xarray.DataArray(
+            lon,
+            dims="lon",
+            attrs={"axis": "X", "units": "degrees_east", "standard_name": "longitude"},
+        ),
+    }
+    if len(dataset.levels) > 0:
+        coords["plev"] = xarray.DataArray(
+            numpy.array(dataset.levels, dtype=numpy.float64),
+            dims="plev",
+            attrs={"axis": "Z", "units": "Pa", "positive": "down"},
+        )
+    return coords
+
+
+def generate_file(dataset: SyntheticDataset, first: int, last: int, path: str):
+    freq = "MS" if dataset.frequency == "mon" else "D"
+    time = xarray.date_range(
+        f"{first}-01-01",
+        f"{last}-12-31",
+        freq=freq,
+        calendar="noleap",
+        use_cftime=True,
+    )
+    if dataset.frequency == "mon":
+        # CMIP6 monthly values are stamped mid-month
+        time = time.shift(14, "D")
+    coords = coordinates(dataset)
+    rng = numpy.random.default_rng(first)
+    lat = coords["lat"].values
+    # a meridional temperature gradient with a seasonal cycle and noise
+    months = numpy.array([t.month for t in time])
+    seasonal = 10 * numpy.cos(2 * numpy.pi * (months - 1) / 12)
+    base = 288 - 30 * numpy.sin(numpy.deg2rad(lat)) ** 2
+    dims = ["time", "lat", "lon"]
+    shape = [len(time), len(lat), len(coords["lon"])]
+    field_ = (
+        base[None, :, None]
+        + seasonal[:, None, None] * numpy.sign(lat)[None, :, None]
+        + rng.normal(0, 2, shape)
+    )
+    if len(dataset.levels) > 0:
+        dims.insert(1, "plev")
+        lapse = numpy.log(numpy.array(dataset.levels) / 100000) * 30
+        field_ = field_[:, None, :, :] + lapse[None, :, None, None]
+    data = xarray.DataArray(
+        field_.astype(numpy.float32),
+        dims=dims,
+        attrs={
+            "units": dataset.units,
+            "standard_name": dataset.standard_name,
+            "long_name": dataset.long_name,
+        },
+    )
+    ds = xarray.Dataset(
+        {dataset.variable: data},
+        coords=coords | {"time": xarray.DataArray(time, dims="time")},
+        attrs={
+            "Conventions": "CF-1.7 CMIP-6.2",
+            "activity_id": "CMIP",
+            "experiment_id": EXPERIMENT,
+            "frequency": dataset.frequency,
+            "grid_label": "gn",
+            "institution_id": INSTITUTION,
+            "nominal_resolution": f"{int(dataset.resolution * 100)} km",
+            "source_id": SOURCE,
+            "table_id": dataset.table,
+            "variable_id": dataset.variable,
+            "variant_label": VARIANT,
+        },
+    )
+    ds.time.attrs["axis"] = "T"
+    chunks = list(shape)
+    chunks[0] = 1
+    if len(dataset.levels) > 0:
+        chunks.insert(1, 1)
+    ds.to_netcdf(
+        path,
+        encoding={
+            dataset.variable: {"zlib": True, "complevel": 1, "chunksizes": chunks},
+            "time": {"units": f"days since {dataset.start_year}-01-01"},
+        },
+    )
+
+
+def ensure_datasets(directory: str) -> Dict[str, List[str]]:
+    """
+    generates missing dataset files into `directory`. returns the file paths of each dataset.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for key, dataset in DATASETS.items():
+        paths[key] = []
+        for first, last in dataset.file_spans():
+            path = os.path.join(directory, dataset.filename(first, last))
+            if not os.path.exists(path):
+                print(f"generating {os.path.basename(path)}", flush=True)
+                temp = f"{path}.tmp"
+                generate_file(dataset, first, last, temp)
+                os.replace(temp, path)
+            paths[key].append(path)
+    return paths
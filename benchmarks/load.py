@@ -0,0 +1,460 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+import numpy
+import requests
+from api.dataset.job_queue import TERMINAL_STATUSES
+from benchmarks.cases import SEARCH_QUERIES
+from benchmarks.datasets import DATASETS
+
+# load generator for a running API and rq workers. every workload sends requests at its own
+# rate, with exponential gaps between them (open loop - a slow API doesn't slow the arrivals
+# down, as with real users), and polls the status of every job it starts until it ends:
+#
+#   python -m benchmarks.standins --public-host host.docker.internal     # in one shell
+#   python -m benchmarks.load --duration 120 --small-subset-rate 1        # in another
+#
+# reported: API latency percentiles per request kind, queue wait (started_at - enqueued_at)
+# and end-to-end time per job kind, job throughput, and the CPU and memory of the worker
+# processes - every process whose command line contains `--worker-pattern`, and their
+# children - sampled from /proc, so on the same (Linux) host as the workers.
+
+REQUEST_TIMEOUT = 60
+
+SEARCH_QUERIES_LIST = list(SEARCH_QUERIES.values())
+
+
+def percentiles(values: List[float]) -> Dict[str, float] | None:
+    if len(values) == 0:
+        return None
+    p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+    return {
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(max(values)),
+    }
+
+
+def parse_time(value: str | None) -> float | None:
+    if value is None:
+        return None
+    return datetime.fromisoformat(value).timestamp()
+
+
+class Recorder:
+    """
+    request latencies and job outcomes, from every load thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+
+    def request(self, kind: str, seconds: float, ok: bool):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            if not ok:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def job(self, kind: str, status: str, wait: float | None, total: float | None):
+        with self.lock:
+            job = self.jobs.setdefault(
+                kind, {"statuses": {}, "queue_wait": [], "end_to_end": []}
+            )
+            job["statuses"][status] = job["statuses"].get(status, 0) + 1
+            if wait is not None:
+                job["queue_wait"].append(wait)
+            if total is not None:
+                job["end_to_end"].append(total)
+
+
+class ProcessSampler(threading.Thread):
+    """
+    CPU (in cores) and resident memory of matching processes and their children, every
+    `interval` seconds.
+    """
+
+    def __init__(self, pattern: str, interval: float = 1):
+        super().__init__(daemon=True)
+        self.pattern = pattern
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples: List[Dict[str, float]] = []
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def processes(self) -> Dict[int, List[str]]:
+        stats = {}
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f"/proc/{pid}/cmdline", "rb") as f:
+                    cmdline = f.read().replace(b"\0", b" ").decode(errors="replace")
+                with open(f"/proc/{pid}/stat") as f:
+                    # the command name is in parentheses and may contain spaces
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            stats[int(pid)] = [cmdline] + fields
+        return stats
+
+    def sample(self) -> Dict[str, float]:
+        stats = self.processes()
+        matched = {
+            pid
+            for pid, s in stats.items()
+            if self.pattern in s[0] and pid != os.getpid()
+        }
+        # children of matched processes, e.g. the workers a pool forks
+        grown = True
+        while grown:
+            children = {pid for pid, s in stats.items() if int(s[2]) in matched}
+            grown = not children <= matched
+            matched |= children
+        # fields after the command name: utime and stime are the 12th and 13th, rss the 22nd
+        cpu = sum(int(stats[pid][12]) + int(stats[pid][13]) for pid in matched)
+        rss = sum(int(stats[pid][22]) for pid in matched)
+        return {
+            "time": time.monotonic(),
+            "cpu_seconds": cpu / self.ticks,
+            "rss_bytes": rss * self.page_size,
+            "processes": len(matched),
+        }
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.samples.append(self.sample())
+            self.stopped.wait(self.interval)
+
+    def summary(self) -> Dict[str, Any] | None:
+        if len(self.samples) < 2:
+            return None
+        cores = []
+        for previous, sample in zip(self.samples, self.samples[1:]):
+            # processes that exit between samples make the total drop - skip those intervals
+            used = sample["cpu_seconds"] - previous["cpu_seconds"]
+            if used >= 0:
+                cores.append(used / (sample["time"] - previous["time"]))
+        rss = [s["rss_bytes"] / 1e6 for s in self.samples]
+        return {
+            "processes": max(s["processes"] for s in self.samples),
+            "cpu_cores_mean": float(numpy.mean(cores)) if cores else 0,
+            "cpu_cores_max": max(cores, default=0),
+            "rss_mb_mean": float(numpy.mean(rss)),
+            "rss_mb_max": max(rss),
+        }
+
+
+@dataclass
+class Workload:
+    name: str
+    # requests per second
+    rate: float
+    # sends one request (and follows its job) with the random generator given
+    send: Callable[[random.Random], None]
+
+
+class LoadGenerator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.api = args.api.rstrip("/")
+        self.recorder = Recorder()
+        self.sessions = threading.local()
+        self.stopping = threading.Event()
+        self.pool = ThreadPoolExecutor(max_workers=args.concurrency)
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.sessions, "session"):
+            self.sessions.session = requests.Session()
+        return self.sessions.session
+
+    def get(self, kind: str, path: str, params: Dict[str, Any] | None = None):
+        start = time.perf_counter()
+        try:
+            response = self.session().get(
+                f"{self.api}{path}", params=params, timeout=REQUEST_TIMEOUT
+            )
+            ok = response.status_code == 200
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.request(kind, time.perf_counter() - start, ok)
+        return response if ok else None
+
+    def search(self, rng: random.Random):
+        self.get("search", "/search/esgf", {"query": rng.choice(SEARCH_QUERIES_LIST)})
+
+    def run_job(self, kind: str, path: str, params: Dict[str, Any]):
+        """
+        starts a job and polls its status until it ends or `--job-timeout` passes.
+        """
+        submitted = time.time()
+        response = self.get(f"{kind} submit", path, params)
+        if response is None:
+            return self.recorder.job(kind, "rejected", None, None)
+        job = response.json()
+        if "id" not in job:
+            # e.g. a subset over the size limit
+            return self.recorder.job(kind, "rejected", None, None)
+        while True:
+            result = job.get("result") or {}
+            if job.get("status") in TERMINAL_STATUSES:
+                enqueued = parse_time(result.get("enqueued_at"))
+                started = parse_time(result.get("started_at"))
+                wait = started - enqueued if started and enqueued else None
+                return self.recorder.job(
+                    kind, job["status"], wait, time.time() - submitted
+                )
+            if time.time() - submitted > self.args.job_timeout:
+                return self.recorder.job(kind, "timed out", None, None)
+            time.sleep(self.args.poll_interval)
+            response = self.get("status", f"/status/{job['id']}")
+            if response is not None:
+                job = response.json()
+
+    def preview(self, rng: random.Random):
+        key = rng.choice(list(DATASETS))
+        dataset = DATASETS[key]
+        first = rng.randrange(dataset.start_year, dataset.start_year + dataset.years)
+        params = {
+            "dataset_id": dataset.dataset_id,
+            "timestamps": f"{first},{first}",
+            "frame_period": "month",
+        }
+        self.run_job("preview", "/preview/esgf", params)
+
+    def subset(self, rng: random.Random, key: str, years: int | None, kind: str):
+        dataset = DATASETS[key]
+        # random envelopes, so identical requests rarely share a cached result
+        west = rng.randrange(0, 300)
+        south = rng.randrange(-80, 40)
+        params = {
+            "parent_id": "load-test",
+            "dataset_id": dataset.dataset_id,
+            "envelope": f"{west},{west + 60},{south},{south + 40}",
+        }
+        if years is not None:
+            first = rng.randrange(
+                dataset.start_year, dataset.start_year + dataset.years - years + 1
+            )
+            params["timestamps"] = f"{first},{first + years - 1}"
+        self.run_job(kind, "/subset/esgf", params)
+
+    def workloads(self) -> List[Workload]:
+        args = self.args
+        return [
+            Workload("search", args.search_rate, self.search),
+            Workload("preview", args.preview_rate, self.preview),
+            Workload(
+                "small subset",
+                args.small_subset_rate,
+                lambda rng: self.subset(rng, "tas_Amon_2deg", 5, "small subset"),
+            ),
+            Workload(
+                "large subset",
+                args.large_subset_rate,
+                lambda rng: self.subset(rng, "tas_day_2.5deg", None, "large subset"),
+            ),
+        ]
+
+    def track(self, send: Callable[[random.Random], None], rng: random.Random):
+        with self.in_flight_lock:
+            self.in_flight += 1
+        try:
+            send(rng)
+        except Exception as e:
+            print(f"load request failed: {e}", flush=True)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight -= 1
+
+    def arrivals(self, workload: Workload, seed: int):
+        rng = random.Random(seed)
+        deadline = time.monotonic() + self.args.duration
+        while True:
+            self.stopping.wait(rng.expovariate(workload.rate))
+            if self.stopping.is_set() or time.monotonic() > deadline:
+                return
+            self.pool.submit(self.track, workload.send, random.Random(rng.random()))
+
+    def run(self) -> Dict[str, Any]:
+        sampler = ProcessSampler(self.args.worker_pattern)
+        sampler.start()
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=self.arrivals, args=(w, self.args.seed + i))
+            for i, w in enumerate(self.workloads())
+            if w.rate > 0
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+            # let started jobs finish, so throughput counts them
+            print(f"draining {self.in_flight} requests in flight", flush=True)
+            self.pool.shutdown(wait=True)
+        except KeyboardInterrupt:
+            self.stopping.set()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        elapsed = time.monotonic() - started
+        sampler.stopped.set()
+        sampler.join()
+        return self.summary(elapsed, sampler.summary())
+
+    def summary(self, elapsed: float, workers: Dict[str, Any] | None) -> Dict[str, Any]:
+        recorder = self.recorder
+        requests_ = {
+            kind: {
+                "count": len(latencies),
+                "errors": recorder.errors.get(kind, 0),
+                "rate": len(latencies) / elapsed,
+                "latency": percentiles(latencies),
+            }
+            for kind, latencies in sorted(recorder.latencies.items())
+        }
+        jobs = {
+            kind: {
+                "statuses": job["statuses"],
+                "throughput": job["statuses"].get("finished", 0) / elapsed,
+                "queue_wait": percentiles(job["queue_wait"]),
+                "end_to_end": percentiles(job["end_to_end"]),
+            }
+            for kind, job in sorted(recorder.jobs.items())
+        }
+        return {
+            "api": self.api,
+            "duration": self.args.duration,
+            "elapsed": elapsed,
+            "rates": {w.name: w.rate for w in self.workloads()},
+            "requests": requests_,
+            "jobs": jobs,
+            "workers": workers,
+        }
+
+
+def milliseconds(stats: Dict[str, float] | None, key: str) -> str:
+    return f"{stats[key] * 1000:>9.0f}" if stats is not None else f"{'-':>9}"
+
+
+def report(summary: Dict[str, Any]):
+    print(f"\n{summary['elapsed']:.0f}s against {summary['api']}")
+    print(
+        f"\n{'request':<22} {'count':>7} {'errors':>7} {'per s':>7}"
+        f" {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    )
+    for kind, r in summary["requests"].items():
+        print(
+            f"{kind:<22} {r['count']:>7} {r['errors']:>7} {r['rate']:>7.2f}"
+            + "".join(
+                f" {milliseconds(r['latency'], p)}"
+                for p in ["p50", "p90", "p99", "max"]
+            )
+        )
+    print(
+        f"\n{'job':<22} {'done/s':>7} {'wait p50':>9} {'wait p90':>9} {'wait p99':>9}"
+        f" {'e2e p50':>9} {'e2e p99':>9}  statuses"
+    )
+    for kind, j in summary["jobs"].items():
+        print(
+            f"{kind:<22} {j['throughput']:>7.3f}"
+            + "".join(
+                f" {milliseconds(j['queue_wait'], p)}" for p in ["p50", "p90", "p99"]
+            )
+            + "".join(f" {milliseconds(j['end_to_end'], p)}" for p in ["p50", "p99"])
+            + f"  {json.dumps(j['statuses'])}"
+        )
+    workers = summary["workers"]
+    if workers is None or workers["processes"] == 0:
+        print("\nno worker processes found to sample")
+    else:
+        print(
+            f"\nworkers ({workers['processes']} processes):"
+            f" cpu {workers['cpu_cores_mean']:.2f} cores mean, {workers['cpu_cores_max']:.2f} max;"
+            f" rss {workers['rss_mb_mean']:.0f} MB mean, {workers['rss_mb_max']:.0f} MB max"
+        )
+
+
+def regressions(
+    summary: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """
+    p90 request latencies and queue waits more than `tolerance` over the baseline's.
+    """
+    found = []
+    pairs = [
+        (f"{kind} p90", r["latency"], baseline["requests"].get(kind, {}).get("latency"))
+        for kind, r in summary["requests"].items()
+    ] + [
+        (
+            f"{kind} queue wait p90",
+            j["queue_wait"],
+            baseline["jobs"].get(kind, {}).get("queue_wait"),
+        )
+        for kind, j in summary["jobs"].items()
+    ]
+    for name, current, previous in pairs:
+        if current is None or previous is None or previous["p90"] <= 0:
+            continue
+        ratio = current["p90"] / previous["p90"]
+        if ratio > 1 + tolerance:
+            found.append(f"{name} {ratio:.2f}x")
+    return found
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--api", default="http://localhost:8000")
+    parser.add_argument("-d", "--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--search-rate", type=float, default=1, help="per second")
+    parser.add_argument("--preview-rate", type=float, default=0.2)
+    parser.add_argument("--small-subset-rate", type=float, default=0.2)
+    parser.add_argument("--large-subset-rate", type=float, default=0.02)
+    parser.add_argument("--poll-interval", type=float, default=1, help="seconds")
+    parser.add_argument("--job-timeout", type=float, default=600, help="seconds")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=256,
+        help="most requests and polled jobs in flight at once",
+    )
+    parser.add_argument(
+        "--worker-pattern",
+        default="rq worker",
+        help="command line of the worker processes to sample",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    summary = LoadGenerator(args).run()
+    report(summary)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(summary, json.load(f), args.tolerance)
+        if len(found) > 0:
+            print(f"\n{len(found)} regressions: {', '.join(found)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
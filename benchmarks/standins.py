@@ -0,0 +1,497 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlparse
+import numpy
+import pandas
+import requests
+from api.search.providers.esgf import SEARCH_FACETS
+from benchmarks.datasets import DATASETS, SyntheticDataset, ensure_datasets
+
+# local stand-ins for the upstream services, so benchmarks measure this code and not ESGF:
+#   files      ESGF data node - plain HTTP downloads, and byte range reads that netCDF opens
+#              remotely like OPeNDAP URLs (`<url>#mode=bytes`)
+#   solr       ESGF search node - dataset, file and facet queries over the synthetic datasets
+#   terarium   Terarium dataset API - creates datasets and takes uploads
+#   openai     deterministic chat and embedding client, in process or over HTTP
+# every stand-in can add a fixed `latency` (seconds) per request to model a remote service.
+#
+# `python -m benchmarks.standins` serves them for a running API and workers - see the load
+# generator in benchmarks.load.
+
+EMBEDDING_DIMENSIONS = 256
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body: Any, status: int = 200):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_file(self, path: str):
+        """
+        a file, or the byte range of it in a Range header.
+        """
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        ranged = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if ranged is not None:
+            start = int(ranged.group(1))
+            end = min(int(ranged.group(2) or size - 1), size - 1)
+        self.send_response(206 if ranged is not None else 200)
+        self.send_header("Content-Type", "application/x-netcdf")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if ranged is not None:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def delay(self):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        handler,
+        port: int = 0,
+        latency: float = 0,
+        host: str = "127.0.0.1",
+        public_host: str | None = None,
+        **state,
+    ):
+        super().__init__((host, port), handler)
+        self.latency = latency
+        # the host other machines (or containers) reach the stand-in at
+        self.public_host = public_host or host
+        self.state = state
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.public_host}:{self.server_address[1]}"
+
+    def start(self) -> "StandInServer":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FileHandler(StandInHandler):
+    """
+    GET /files/<name> from the data directory.
+    """
+
+    def do_GET(self):
+        self.delay()
+        name = os.path.basename(urlparse(self.path).path)
+        path = os.path.join(self.server.state["directory"], name)
+        if not self.path.startswith("/files/") or not os.path.isfile(path):
+            return self.send_json({"error": "not found"}, 404)
+        self.send_file(path)
+
+    do_HEAD = do_GET
+
+
+def dataset_doc(dataset: SyntheticDataset, node: str) -> Dict[str, Any]:
+    first, last = dataset.start_year, dataset.start_year + dataset.years - 1
+    return {
+        "id": f"{dataset.dataset_id}|{node}",
+        "instance_id": dataset.dataset_id,
+        "master_id": dataset.dataset_id.rsplit(".", 1)[0],
+        "title": dataset.dataset_id,
+        "data_node": node,
+        "project": ["CMIP6"],
+        "activity_id": ["CMIP"],
+        "institution_id": ["BENCH"],
+        "source_id": ["BENCH-ESM"],
+        "experiment_id": ["historical"],
+        "experiment_title": ["all-forcing simulation of the recent past"],
+        "variant_label": ["r1i1p1f1"],
+        "table_id": [dataset.table],
+        "frequency": [dataset.frequency],
+        "variable_id": [dataset.variable],
+        "variable_long_name": [dataset.long_name],
+        "cf_standard_name": [dataset.standard_name],
+        "nominal_resolution": [f"{int(dataset.resolution * 100)} km"],
+        "grid_label": ["gn"],
+        "realm": ["atmos"],
+        "source_type": ["AOGCM"],
+        "datetime_start": f"{first}-01-01T00:00:00Z",
+        "datetime_stop": f"{last}-12-31T23:59:59Z",
+        "number_of_files": len(dataset.filenames()),
+        "size": dataset.nbytes(),
+        "version": dataset.dataset_id.rsplit(".v", 1)[-1],
+    }
+
+
+# facet values besides the synthetic datasets', so term matching has something to rank
+DISTRACTOR_FACETS = {
+    "variable_id": ["pr", "ua", "va", "hus", "psl", "tos", "sic", "clt"],
+    "table_id": ["Omon", "SImon", "CFday", "6hrLev", "Lmon"],
+    "source_id": ["CESM2", "UKESM1-0-LL", "IPSL-CM6A-LR", "MPI-ESM1-2-HR"],
+    "experiment_id": ["ssp585", "ssp245", "piControl", "amip"],
+    "frequency": ["3hr", "6hr", "yr", "fx"],
+    "nominal_resolution": ["50 km", "25 km", "500 km"],
+    "variable_long_name": ["Precipitation", "Eastward Wind", "Sea Surface Temperature"],
+    "cf_standard_name": [
+        "precipitation_flux",
+        "eastward_wind",
+        "sea_surface_temperature",
+    ],
+}
+
+
+class SolrHandler(StandInHandler):
+    """
+    GET /esg-search/search: datasets (`query`), files (`type=File&dataset_id=`) and facets.
+    """
+
+    def do_GET(self):
+        self.delay()
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path != "/esg-search/search":
+            return self.send_json({"error": "not found"}, 404)
+        node = urlparse(self.server.state["files_url"]).netloc
+        if "facets" in params:
+            return self.send_json(self.facets(params["facets"].split(","), node))
+        if params.get("type", "Dataset") == "File":
+            return self.send_json(self.files(params.get("dataset_id", "")))
+        docs = [dataset_doc(d, node) for d in DATASETS.values()]
+        query = params.get("query", "")
+        if query.startswith("id:"):
+            prefix = query[3:].rstrip("*")
+            docs = [d for d in docs if d["id"].startswith(prefix)]
+        offset, limit = int(params.get("offset", 0)), int(params.get("limit", 10))
+        self.send_json(
+            {"response": {"numFound": len(docs), "docs": docs[offset : offset + limit]}}
+        )
+
+    def files(self, dataset_id: str) -> Dict[str, Any]:
+        files_url = f"{self.server.state['files_url']}/files"
+        docs = [
+            {
+                "title": name,
+                "size": int(d.nbytes() / len(d.filenames())),
+                "url": [
+                    f"{files_url}/{name}|application/netcdf|HTTPServer",
+                    f"{files_url}/{name}#mode=bytes|application/opendap-html|OPENDAP",
+                ],
+            }
+            for d in DATASETS.values()
+            if d.dataset_id == dataset_id.split("|")[0]
+            for name in d.filenames()
+        ]
+        return {"response": {"numFound": len(docs), "docs": docs}}
+
+    def facets(self, facets: List[str], node: str) -> Dict[str, Any]:
+        docs = [dataset_doc(d, node) for d in DATASETS.values()]
+        fields = {}
+        for facet in facets:
+            values = [v for d in docs for v in d.get(facet, [])]
+            values += DISTRACTOR_FACETS.get(facet, [])
+            fields[facet] = [x for v in dict.fromkeys(values) for x in (v, 1)]
+        return {
+            "response": {"numFound": len(docs), "docs": []},
+            "facet_counts": {"facet_fields": fields},
+        }
+
+
+class TerariumHandler(StandInHandler):
+    """
+    POST /datasets, PUT /datasets/<id>/upload-file, GET /datasets/<id> and its download-file.
+    datasets of `hmi_datasets` ({uuid: synthetic dataset key}) exist from the start.
+    """
+
+    def do_POST(self):
+        self.delay()
+        self.read_body()
+        dataset_id = str(uuid.uuid4())
+        self.server.state.setdefault("created", []).append(dataset_id)
+        self.send_json({"id": dataset_id}, 201)
+
+    def do_PUT(self):
+        self.delay()
+        uploaded = len(self.read_body())
+        with self.server.lock:
+            self.server.state["uploaded_bytes"] = (
+                self.server.state.get("uploaded_bytes", 0) + uploaded
+            )
+        self.send_json({})
+
+    def do_GET(self):
+        self.delay()
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        key = self.server.state.get("hmi_datasets", {}).get(
+            parts[1] if len(parts) > 1 else ""
+        )
+        if key is None:
+            return self.send_json({"error": "not found"}, 404)
+        if len(parts) == 2:
+            return self.send_json({"fileNames": DATASETS[key].filenames()})
+        filename = os.path.basename(parse_qs(url.query).get("filename", [""])[0])
+        self.send_file(os.path.join(self.server.state["directory"], filename))
+
+
+class TerariumServer(StandInServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+
+def fake_embedding(text: str) -> List[float]:
+    """
+    a unit vector of hashed character trigrams - similar strings get similar embeddings.
+    """
+    vector = numpy.zeros(EMBEDDING_DIMENSIONS)
+    padded = f"  {text.lower()}  "
+    for i in range(len(padded) - 2):
+        digest = hashlib.md5(padded[i : i + 3].encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % EMBEDDING_DIMENSIONS] += 1
+    norm = numpy.linalg.norm(vector)
+    return list(vector / norm) if norm > 0 else list(vector)
+
+
+def fake_completion(messages: List[Dict[str, str]]) -> str:
+    """
+    the search terms JSON the ESGF provider asks for - the whole request as the description.
+    """
+    request = messages[-1]["content"]
+    request = request.removeprefix("Convert the following input text: ")
+    return json.dumps({"description": request})
+
+
+class FakeOpenAI:
+    """
+    the parts of the OpenAI client the search providers use.
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.requests = {"chat": 0, "embeddings": 0}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.complete))
+        self.embeddings = SimpleNamespace(create=self.embed)
+
+    def complete(self, messages, **_):
+        self.requests["chat"] += 1
+        time.sleep(self.latency)
+        message = SimpleNamespace(content=fake_completion(messages))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    def embed(self, input, **_):
+        self.requests["embeddings"] += 1
+        time.sleep(self.latency)
+        return SimpleNamespace(
+            data=[SimpleNamespace(embedding=fake_embedding(text)) for text in input]
+        )
+
+
+class OpenAIHandler(StandInHandler):
+    """
+    POST /v1/chat/completions and /v1/embeddings, for OpenAI clients with OPENAI_BASE_URL set.
+    """
+
+    def do_POST(self):
+        self.delay()
+        body = json.loads(self.read_body() or b"{}")
+        model = body.get("model", "")
+        if self.path.endswith("/chat/completions"):
+            message = {
+                "role": "assistant",
+                "content": fake_completion(body["messages"]),
+            }
+            return self.send_json(
+                {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "message": message, "finish_reason": "stop"}
+                    ],
+                    "usage": {
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "total_tokens": 0,
+                    },
+                }
+            )
+        if self.path.endswith("/embeddings"):
+            inputs = body.get("input", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            return self.send_json(
+                {
+                    "object": "list",
+                    "data": [
+                        {
+                            "object": "embedding",
+                            "index": i,
+                            "embedding": fake_embedding(t),
+                        }
+                        for i, t in enumerate(inputs)
+                    ],
+                    "model": model,
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                }
+            )
+        self.send_json({"error": {"message": "not found"}}, 404)
+
+
+def facet_embeddings(esgf_url: str) -> Dict[str, pandas.DataFrame]:
+    """
+    ESGF provider embeddings (see ESGFProvider.extract_embedding_strings) of the stand-in search
+    node's facet values, from the fake embeddings.
+    """
+    facets = [f for inner in SEARCH_FACETS.values() for f in inner]
+    response = requests.get(
+        f"{esgf_url}/search", params={"facets": ",".join(facets), "limit": 0}
+    ).json()
+    fields = response["facet_counts"]["facet_fields"]
+    embeddings = {}
+    for facet in facets:
+        strings = [s for s in fields[facet][::2] if s]
+        embeddings[facet] = pandas.DataFrame(
+            {"string": strings, "embed": [fake_embedding(s) for s in strings]}
+        )
+    return embeddings
+
+
+class StandIns:
+    """
+    every HTTP stand-in, serving the synthetic datasets in `directory`. with `port`, they listen
+    on consecutive ports from it: files, solr, terarium, openai.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        latency: float = 0,
+        port: int = 0,
+        host: str = "127.0.0.1",
+        public_host: str | None = None,
+    ):
+        ports = [port + i if port else 0 for i in range(4)]
+        common = {"latency": latency, "host": host, "public_host": public_host}
+        self.files = StandInServer(
+            FileHandler, ports[0], directory=directory, **common
+        ).start()
+        self.solr = StandInServer(
+            SolrHandler, ports[1], files_url=self.files.url, **common
+        ).start()
+        self.terarium = TerariumServer(
+            TerariumHandler,
+            ports[2],
+            directory=directory,
+            hmi_datasets={
+                str(uuid.uuid5(uuid.NAMESPACE_URL, key)): key for key in DATASETS
+            },
+            **common,
+        ).start()
+        self.openai = StandInServer(OpenAIHandler, ports[3], **common).start()
+
+    @property
+    def esgf_url(self) -> str:
+        return f"{self.solr.url}/esg-search"
+
+    @property
+    def openai_url(self) -> str:
+        return f"{self.openai.url}/v1"
+
+    def hmi_id(self, key: str) -> str:
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+    def environment(self) -> Dict[str, str]:
+        """
+        settings that point the API and workers at the stand-ins.
+        """
+        return {
+            "ESGF_URL": self.esgf_url,
+            "TERARIUM_URL": self.terarium.url,
+            "OPENAI_BASE_URL": self.openai_url,
+            "OPENAI_API_KEY": "stand-in",
+        }
+
+    def stop(self):
+        for server in [self.files, self.solr, self.terarium, self.openai]:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.standins")
+    parser.add_argument(
+        "--data-dir", default=os.path.join(os.path.dirname(__file__), "data")
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--public-host",
+        help="host the API and workers reach the stand-ins at, e.g. host.docker.internal",
+    )
+    parser.add_argument("--port", type=int, default=9300)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument(
+        "--embedding-cache",
+        default="embedding_cache",
+        help="where to write the ESGF provider's embedding cache for the stand-ins",
+    )
+    args = parser.parse_args()
+
+    ensure_datasets(args.data_dir)
+    standins = StandIns(
+        args.data_dir, args.latency, args.port, args.host, args.public_host
+    )
+    with open(args.embedding_cache, "wb") as f:
+        pickle.dump(facet_embeddings(standins.esgf_url), f)
+    print(f"wrote {args.embedding_cache} - copy it to the API's working directory")
+    print("serving stand-ins, run the API and workers with:")
+    for k, v in standins.environment().items():
+        print(f"{k}={v}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        standins.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import numpy
+import xarray
+from api.dataset.job_queue import LARGE_SUBSET_QUEUE, SUBSET_QUEUE
+from api.dataset.models import (
+    CoarsenSubsetOptions,
+    DatasetSubsetOptions,
+    ReductionSubsetOptions,
+    TemporalSubsetOptions,
+)
+from api.processing.estimate import (
+    estimate_subset,
+    is_time_shardable,
+    plan_time_shards,
+)
+from api.settings import default_settings
+
+FILES = [
+    {"filename": f"tas_day_MODEL_historical_r1i1p1f1_gn_{y}0101-{y + 9}1231.nc"}
+    for y in range(1950, 2010, 10)
+]
+
+
+def test_time_shards_follow_file_boundaries_and_keep_the_requested_range():
+    options = DatasetSubsetOptions(
+        temporal=TemporalSubsetOptions(timestamp_range=["1955-06-01", "2003-01-01"])
+    )
+    assert plan_time_shards(FILES, options, 3) == [
+        ["1955-06-01", "1969-12-31"],
+        ["1970-01-01", "1989-12-31"],
+        ["1990-01-01", "2003-01-01"],
+    ]
+
+
+def test_operations_across_time_steps_are_not_sharded():
+    assert is_time_shardable(DatasetSubsetOptions(), "time")
+    spatial = DatasetSubsetOptions(coarsen=CoarsenSubsetOptions(factor=2))
+    assert is_time_shardable(spatial, "time")
+    over_time = DatasetSubsetOptions(
+        coarsen=CoarsenSubsetOptions(factor=2, fields=["time"])
+    )
+    assert not is_time_shardable(over_time, "time")
+    reduced = DatasetSubsetOptions(
+        reduction=ReductionSubsetOptions(method="p90", fields=["time"])
+    )
+    assert not is_time_shardable(reduced, "time")
+
+
+def monthly_dataset() -> xarray.Dataset:
+    time = xarray.date_range("1950-01-01", "2009-12-01", freq="MS", use_cftime=True)
+    return xarray.Dataset(
+        {"tas": (("time", "lat", "lon"), numpy.zeros((len(time), 10, 20)))},
+        coords={
+            "time": time,
+            "lat": numpy.linspace(-45, 45, 10),
+            "lon": numpy.linspace(0, 342, 20),
+        },
+    ).chunk({"time": 120})
+
+
+MONTHLY_FILES = [
+    {
+        "filename": f"tas_Amon_MODEL_historical_r1i1p1f1_gn_{y}01-{y + 9}12.nc",
+        "size": 1000,
+    }
+    for y in range(1950, 2010, 10)
+]
+
+
+def test_estimates_count_the_files_and_bytes_of_a_selection():
+    options = DatasetSubsetOptions(
+        temporal=TemporalSubsetOptions(timestamp_range=["1971-01", "1989-12"])
+    )
+    ds = monthly_dataset()
+    estimate = estimate_subset(ds, options, MONTHLY_FILES)
+    assert estimate.shape == {"time": 228, "lat": 10, "lon": 20}
+    assert estimate.read_bytes == ds.sel(time=slice("1971-01", "1989-12")).nbytes
+    assert estimate.files == 2
+    assert estimate.total_files == 6
+    assert estimate.queue == SUBSET_QUEUE
+    assert not estimate.rejected
+
+
+def test_large_estimates_are_sharded_or_rejected(monkeypatch):
+    monkeypatch.setattr(default_settings, "subset_large_job_bytes", 1000)
+    monkeypatch.setattr(default_settings, "subset_max_shards", 3)
+    estimate = estimate_subset(monthly_dataset(), DatasetSubsetOptions(), MONTHLY_FILES)
+    assert estimate.queue == LARGE_SUBSET_QUEUE
+    assert estimate.shards == [
+        ["start", "1969-12"],
+        ["1970-01", "1989-12"],
+        ["1990-01", "end"],
+    ]
+
+    over_time = DatasetSubsetOptions(
+        coarsen=CoarsenSubsetOptions(factor=12, fields=["time"])
+    )
+    estimate = estimate_subset(monthly_dataset(), over_time, MONTHLY_FILES)
+    assert estimate.shape["time"] == 60
+    assert estimate.shards == []
+
+    monkeypatch.setattr(default_settings, "subset_max_bytes", 10000)
+    estimate = estimate_subset(monthly_dataset(), DatasetSubsetOptions(), MONTHLY_FILES)
+    assert estimate.rejected
+    assert estimate.shards == []
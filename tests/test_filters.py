@@ -0,0 +1,54 @@
+import numpy
+import pytest
+import xarray
+from api.processing import filters
+
+
+def gridded_dataset(values=None) -> xarray.Dataset:
+    lat = numpy.arange(-87.5, 90.0, 5.0)
+    lon = numpy.arange(0.0, 360.0, 10.0)
+    if values is None:
+        values = numpy.random.default_rng(0).random((3, lat.size, lon.size))
+    return xarray.Dataset(
+        {"tas": (("time", "lat", "lon"), values)},
+        coords={"time": numpy.arange(3), "lat": lat, "lon": lon},
+    )
+
+
+def test_weighted_mean_of_a_constant_field_is_the_constant():
+    ds = gridded_dataset(numpy.full((3, 36, 36), 280.0))
+    ds["tas"][:, :4, :] = numpy.nan
+    reduced = filters.reduction(ds, "mean")
+    numpy.testing.assert_allclose(reduced.tas.values, 280.0)
+
+
+def test_weighted_mean_favours_low_latitudes_and_sum_is_plain():
+    ds = gridded_dataset()
+    weights = numpy.cos(numpy.deg2rad(ds.lat))
+    expected = (ds.tas * weights).sum(["lat", "lon"]) / (weights.sum() * ds.lon.size)
+    numpy.testing.assert_allclose(
+        filters.reduction(ds, "mean").tas.values, expected.values
+    )
+    numpy.testing.assert_allclose(
+        filters.reduction(ds, "sum").tas.values, ds.tas.sum(["lat", "lon"]).values
+    )
+
+
+def test_coarsen_trims_partial_blocks_and_keeps_constants():
+    ds = gridded_dataset(numpy.full((3, 36, 36), 1.5))
+    coarse = filters.coarsen(ds, 5)
+    assert coarse.tas.shape == (3, 7, 7)
+    numpy.testing.assert_allclose(coarse.tas.values, 1.5)
+    assert filters.coarsen(ds, 2, fields=["time"]).tas.shape == (1, 36, 36)
+
+
+def test_percentile_methods():
+    assert filters.parse_percentile("p90") == pytest.approx(0.9)
+    assert filters.parse_percentile("p99.5") == pytest.approx(0.995)
+    assert filters.parse_percentile("mean") is None
+    filters.validate_aggregation_method("p90")
+    for method in ["p101", "average", "p"]:
+        with pytest.raises(Exception):
+            filters.validate_aggregation_method(method)
+    reduced = filters.reduction(gridded_dataset(), "p90", fields=["time"])
+    assert reduced.tas.dims == ("lat", "lon")
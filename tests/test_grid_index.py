@@ -0,0 +1,36 @@
+import numpy
+import xarray
+from api.processing import grid_index
+
+
+def curvilinear_dataset() -> xarray.Dataset:
+    lon, lat = numpy.meshgrid(
+        numpy.arange(0.0, 360.0, 2.0), numpy.arange(-60.0, 61.0, 2.0)
+    )
+    return xarray.Dataset(
+        {"tos": (("j", "i"), numpy.zeros(lon.shape))},
+        coords={"longitude": (("j", "i"), lon), "latitude": (("j", "i"), lat)},
+        attrs={"source_id": "TEST-MODEL", "grid_label": "gn"},
+    )
+
+
+def test_same_shape_windows_get_their_own_index():
+    grid_index.clear_grid_index_cache()
+    ds = curvilinear_dataset()
+    fields = ("longitude", "latitude")
+    west = ds.isel(i=slice(5, 20), j=slice(30, 40))
+    east = ds.isel(i=slice(55, 70), j=slice(30, 40))
+
+    west_point = grid_index.get_grid_index(west, fields).nearest(20.0, 4.0)
+    east_point = grid_index.get_grid_index(east, fields).nearest(120.0, 4.0)
+
+    assert float(west.longitude[west_point["j"], west_point["i"]]) == 20.0
+    assert float(east.longitude[east_point["j"], east_point["i"]]) == 120.0
+    assert float(east.latitude[east_point["j"], east_point["i"]]) == 4.0
+
+
+def test_identical_grids_share_an_index():
+    grid_index.clear_grid_index_cache()
+    fields = ("longitude", "latitude")
+    first = grid_index.get_grid_index(curvilinear_dataset(), fields)
+    assert grid_index.get_grid_index(curvilinear_dataset(), fields) is first
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import shutil
+import pytest
+from api.dataset import job_queue
+from api.dataset.worker import PersistentWorker
+from api.settings import default_settings
+
+fakeredis = pytest.importorskip("fakeredis")
+
+PREVIEW = "api.preview.render.render_preview_for_dataset"
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis(server):
+    return fakeredis.FakeRedis(server=server)
+
+
+def double(value, **kwargs):
+    return {"value": value * 2}
+
+
+def fail(**kwargs):
+    raise ValueError("upstream is down")
+
+
+def run_jobs(redis, queue="default"):
+    worker = PersistentWorker([queue], connection=redis)
+    worker.work(burst=True)
+
+
+def test_identical_requests_racing_share_one_job(redis, monkeypatch):
+    first = job_queue.create_job(
+        func=PREVIEW, args=[], redis=redis, coalesce_key="k", coalesce_ttl=60
+    )
+    # the second request checked before the first one set the key
+    find = job_queue.find_coalesced_job
+    calls = []
+
+    def find_after_first_check(key, r):
+        calls.append(key)
+        return None if len(calls) == 1 else find(key, r)
+
+    monkeypatch.setattr(job_queue, "find_coalesced_job", find_after_first_check)
+    second = job_queue.create_job(
+        func=PREVIEW, args=[], redis=redis, coalesce_key="k", coalesce_ttl=60
+    )
+    assert second.id == first.id
+    assert redis.get("k") == first.id.encode()
+    assert len(job_queue.Queue("default", connection=redis)) == 1
+
+
+def test_zero_coalesce_ttl_runs_a_job_per_request(redis):
+    first = job_queue.create_job(
+        func=PREVIEW, args=[], redis=redis, coalesce_key="k", coalesce_ttl=0
+    )
+    second = job_queue.create_job(
+        func=PREVIEW, args=[], redis=redis, coalesce_key="k", coalesce_ttl=0
+    )
+    assert first.id != second.id
+    assert redis.get("k") is None
+    job = job_queue.Job.fetch(first.id, connection=redis)
+    assert job.result_ttl is None
+
+
+def test_only_the_owner_cancels_a_job(redis):
+    job = job_queue.create_job(
+        func=PREVIEW, args=[], redis=redis, queue="preview", user="alice"
+    )
+    with pytest.raises(job_queue.JobNotCancellableError):
+        job_queue.cancel_job(job.id, redis, "bob")
+    with pytest.raises(job_queue.JobNotCancellableError):
+        job_queue.cancel_job(job.id, redis)
+    assert job_queue.cancel_job(job.id, redis, "alice").status.value == "canceled"
+
+
+def test_shared_jobs_without_an_owner_are_not_canceled(redis):
+    job = job_queue.create_job(
+        func=PREVIEW, args=[], redis=redis, coalesce_key="k", coalesce_ttl=60
+    )
+    with pytest.raises(job_queue.JobNotCancellableError):
+        job_queue.cancel_job(job.id, redis, "alice")
+    unshared = job_queue.create_job(func=PREVIEW, args=[], redis=redis)
+    assert job_queue.cancel_job(unshared.id, redis).status.value == "canceled"
+
+
+def test_event_streams_push_progress_until_jobs_finish(server, redis, monkeypatch):
+    monkeypatch.setattr(default_settings, "worker_preload", False)
+    monkeypatch.setattr(job_queue, "_job_event_hub", None)
+    monkeypatch.setattr(job_queue, "get_redis", lambda: redis)
+    job = job_queue.create_job(
+        func="tests.test_job_queue.double", args=[21], redis=redis
+    )
+
+    async def stream():
+        events = job_queue.job_event_stream(
+            [job.id, "missing"], fakeredis.FakeAsyncRedis(server=server)
+        )
+        received = [await anext(events), await anext(events)]
+        # the worker publishes while the stream is subscribed
+        run_jobs(redis)
+        received += [event async for event in events]
+        return received
+
+    events = asyncio.run(stream())
+    parsed = [
+        (e.split("\n")[0], json.loads(e.split("\n")[1][len("data: ") :]))
+        for e in events
+    ]
+    assert parsed[0][0] == "event: status"
+    assert parsed[0][1]["status"] == "queued"
+    assert parsed[1][1] == {"id": "missing", "status": "not_found"}
+    assert parsed[2][0] == "event: progress"
+    assert parsed[2][1]["status"] == "started"
+    assert parsed[-1][0] == "event: status"
+    assert parsed[-1][1]["status"] == "finished"
+    assert parsed[-1][1]["result"]["job_result"] == {"value": 42}
+
+
+def test_pipelined_status_reads_match_rq(redis, monkeypatch):
+    monkeypatch.setattr(default_settings, "worker_preload", False)
+    finished = job_queue.create_job(
+        func="tests.test_job_queue.double", args=[21], redis=redis
+    )
+    failed = job_queue.create_job(
+        func="tests.test_job_queue.fail", args=[], redis=redis
+    )
+    queued = job_queue.create_job(func=PREVIEW, args=[], redis=redis, queue="preview")
+    run_jobs(redis)
+
+    for job in [finished, failed, queued]:
+        with redis.pipeline(transaction=False) as pipeline:
+            job_queue.queue_status_reads(pipeline, job.id)
+            raw_job, raw_results = pipeline.execute()
+        restored = job_queue.restore_job(job.id, raw_job, redis)
+        fetched = job_queue.Job.fetch(job.id, connection=redis)
+        assert restored.get_status(refresh=False) == fetched.get_status()
+        assert restored.func_name == fetched.func_name
+        assert restored.meta == fetched.meta
+        latest = job_queue.restore_latest_result(restored, raw_results)
+        expected = fetched.latest_result()
+        if expected is None:
+            assert latest is None
+            continue
+        assert latest.id == expected.id
+        assert latest.type == expected.type
+        assert latest.return_value == expected.return_value
+        assert latest.exc_string == expected.exc_string
+
+    status = job_queue.fetch_job_status(finished.id, redis)
+    assert status.status.value == "finished"
+    assert status.result.job_result == {"value": 42}
+    status = job_queue.fetch_job_status(failed.id, redis)
+    assert status.status.value == "failed"
+    assert "upstream is down" in status.result.job_error
+    assert job_queue.fetch_job_status("missing", redis) == 404
+
+
+def test_cache_keys_follow_the_processing_code(tmp_path):
+    shutil.copytree(job_queue.PROCESSING_SOURCES, tmp_path / "processing")
+    root = str(tmp_path / "processing")
+    before = job_queue.source_hash(root)
+    assert before == job_queue.source_hash(job_queue.PROCESSING_SOURCES)
+    assert job_queue.source_hash(job_queue.PROCESSING_SOURCES)[:12] in (
+        job_queue.CODE_VERSION
+    )
+    with open(tmp_path / "processing" / "providers" / "esgf.py", "a") as f:
+        f.write("\n# changed\n")
+    assert job_queue.source_hash(root) != before
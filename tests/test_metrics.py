@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+from prometheus_client import multiprocess
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+from api.metrics import compact_metrics
+
+
+def exited_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def write_counter(path: str, pid: int, value: float):
+    key = mmap_key("jobs", "jobs_total", ["status"], ["finished"], "jobs")
+    values = MmapedDict(os.path.join(path, f"counter_{pid}.db"))
+    values.write_value(key, value, 0.0)
+    values.close()
+
+
+def collected(path: str) -> dict:
+    collector = multiprocess.MultiProcessCollector(None, path=str(path))
+    return {
+        (s.name, tuple(sorted(s.labels.items()))): s.value
+        for metric in collector.collect()
+        for s in metric.samples
+    }
+
+
+def test_exited_processes_are_merged_into_the_archive(tmp_path):
+    write_counter(tmp_path, exited_pid(), 2)
+    write_counter(tmp_path, exited_pid(), 3)
+    write_counter(tmp_path, os.getpid(), 5)
+    before = collected(tmp_path)
+
+    compact_metrics(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        ["counter_archive.db", f"counter_{os.getpid()}.db"]
+    )
+    assert collected(tmp_path) == before
+
+    write_counter(tmp_path, exited_pid(), 1)
+    compact_metrics(str(tmp_path))
+    assert collected(tmp_path) == {k: v + 1 for k, v in before.items()}
@@ -0,0 +1,145 @@
+import os
+import numpy
+import pytest
+import xarray
+from api.preview import cache as preview_cache
+from api.preview import render as preview_render
+from api.preview.cache import LocalPreviewStore, frame_key, get_preview_cache
+from api.settings import default_settings
+
+
+@pytest.fixture(autouse=True)
+def local_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(default_settings, "preview_cache_dir", str(tmp_path / "cache"))
+    monkeypatch.setattr(default_settings, "preview_cache_object_store", False)
+    monkeypatch.setattr(default_settings, "preview_render_workers", 1)
+    monkeypatch.setattr(preview_cache, "_preview_cache", None)
+
+
+def monthly_dataset(lon_cells: int = 36) -> xarray.Dataset:
+    time = xarray.date_range("2000-01-01", "2002-12-01", freq="MS", use_cftime=True)
+    lat = numpy.linspace(-87.5, 87.5, 36)
+    lon = numpy.linspace(0, 360, lon_cells, endpoint=False)
+    values = numpy.random.default_rng(0).random((len(time), len(lat), len(lon)))
+    return xarray.Dataset(
+        {
+            "tas": (
+                ("time", "lat", "lon"),
+                values + numpy.arange(len(time))[:, None, None],
+            )
+        },
+        coords={
+            "time": ("time", time, {"axis": "T"}),
+            "lat": ("lat", lat, {"axis": "Y"}),
+            "lon": ("lon", lon, {"axis": "X"}),
+        },
+    )
+
+
+def test_frame_keys_depend_on_dataset_version_and_settings():
+    settings = {"dpi": 100}
+    key = frame_key("CMIP6.tas.v20190101|node", "tas", "2000", settings)
+    assert key == frame_key("CMIP6.tas.v20190101|other-node", "tas", "2000", settings)
+    assert key != frame_key("CMIP6.tas.v20200101|node", "tas", "2000", settings)
+    assert key != frame_key("CMIP6.tas.v20190101|node", "tas", "2000", {"dpi": 50})
+
+
+def test_local_store_evicts_the_least_recently_used_frames(tmp_path):
+    store = LocalPreviewStore(str(tmp_path / "lru"), max_bytes=100)
+    store.put("previews/a.png", b"a" * 40)
+    store.put("previews/b.png", b"b" * 40)
+    os.utime(store.path("previews/a.png"), (1000, 1000))
+    os.utime(store.path("previews/b.png"), (2000, 2000))
+    assert store.get("previews/a.png") == b"a" * 40
+    store.put("previews/c.png", b"c" * 40)
+    assert store.get("previews/b.png") is None
+    assert store.exists("previews/a.png")
+    assert b"".join(store.stream("previews/c.png")) == b"c" * 40
+
+
+def test_season_frames_keep_december_with_the_following_winter():
+    times = monthly_dataset().time
+    frames = preview_render.plan_frames(times, "season")
+    starts = [f"{t.year}-{t.month:02}" for t in times.values[frames]]
+    assert starts[:3] == ["2000-01", "2000-03", "2000-06"]
+    assert "2000-12" in starts and "2001-01" not in starts
+    assert len(preview_render.plan_frames(times, "month")) == 36
+    assert list(preview_render.plan_frames(times, "year")) == [0, 12, 24]
+
+
+def test_frames_are_decimated_to_the_output_resolution():
+    data = monthly_dataset(lon_cells=3600).tas
+    decimated = preview_render.decimate(data, "lon", "lat")
+    assert decimated.sizes["lon"] == 3600 // (3600 // 640)
+    assert decimated.sizes["lat"] == 36
+
+
+def test_previews_are_stored_and_served_from_the_cache(monkeypatch):
+    ds = monthly_dataset()
+    renders = preview_render.render(
+        ds, "tas", timestamps="2000-01,2002-12", cache_id="dataset.v1", inline=False
+    )
+    assert [r["year"] for r in renders] == [2000, 2001, 2002]
+    cache = get_preview_cache()
+    for r in renders:
+        assert r["image"] == f"/preview/image/{r['key'].split('/')[-1]}"
+        assert cache.get(r["key"]).startswith(b"\x89PNG")
+
+    def render_frames(frames, *args):
+        assert len(frames) == 0
+        return []
+
+    monkeypatch.setattr(preview_render, "render_frames", render_frames)
+    again = preview_render.render(
+        ds, "tas", timestamps="2000-01,2002-12", cache_id="dataset.v1", inline=False
+    )
+    assert [r["key"] for r in again] == [r["key"] for r in renders]
+
+    inline = preview_render.render(
+        ds, "tas", timestamps="2000-01,2000-12", cache_id="dataset.v1"
+    )
+    assert inline[0]["image"].startswith("data:image/png;base64,")
+
+
+def test_reused_renderer_draws_the_same_frames_as_a_fresh_one(monkeypatch):
+    data = monthly_dataset().tas
+    style = {"vmin": 0.0, "vmax": 36.0, "label": "tas"}
+    frames = [preview_render.extract_frame(data[i], "lon", "lat") for i in [0, 20]]
+    reused = [preview_render.plot_frame(frame, style) for frame in frames]
+    fresh = []
+    for frame in frames:
+        renderer = preview_render.FrameRenderer(frame, style)
+        fresh.append(renderer.render(frame))
+        renderer.close()
+    assert reused == fresh
+    assert reused[0] != reused[1]
+
+    # the process pool returns frames in order
+    monkeypatch.setattr(default_settings, "preview_render_workers", 2)
+    pooled = preview_render.render_frames([data[0], data[20]], "lon", "lat", style)
+    assert pooled == reused
+
+
+def test_frames_are_not_reused_with_a_different_color_scale(monkeypatch):
+    ds = monthly_dataset()
+    first = preview_render.render(
+        ds, "tas", timestamps="2000-01,2000-12", cache_id="dataset.v1", inline=False
+    )
+    # the stored color scale is evicted, and the next preview spans a wider range
+    cache = get_preview_cache()
+    for f in os.listdir(cache.local.directory):
+        if f.endswith(".json"):
+            os.remove(os.path.join(cache.local.directory, f))
+    rendered = []
+    render_frames = preview_render.render_frames
+
+    def counting_render_frames(frames, *args):
+        rendered.extend(frames)
+        return render_frames(frames, *args)
+
+    monkeypatch.setattr(preview_render, "render_frames", counting_render_frames)
+    wider = preview_render.render(
+        ds, "tas", timestamps="2000-01,2002-12", cache_id="dataset.v1", inline=False
+    )
+    assert wider[0]["key"] != first[0]["key"]
+    assert len(rendered) == 3
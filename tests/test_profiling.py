@@ -0,0 +1,46 @@
+import json
+import numpy
+import xarray
+from api.dataset.profiling import folded_stacks, profile_key, profiled
+from api.preview.render import render_frames
+from api.settings import default_settings
+
+
+class Job:
+    id = "profiled-job"
+    func_name = "api.preview.render.render_preview_for_dataset"
+    meta = {"profile": True}
+
+
+class Redis:
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+def frames(count: int) -> list[xarray.DataArray]:
+    lon = numpy.arange(0.0, 360.0, 2.0)
+    lat = numpy.arange(-89.0, 90.0, 2.0)
+    return [
+        xarray.DataArray(
+            numpy.random.default_rng(i).random((len(lat), len(lon))),
+            coords={"lat": lat, "lon": lon},
+            dims=("lat", "lon"),
+        )
+        for i in range(count)
+    ]
+
+
+def test_profiled_render_samples_frame_drawing(monkeypatch):
+    monkeypatch.setattr(default_settings, "preview_render_workers", 2)
+    monkeypatch.setattr(default_settings, "profile_interval", 0.001)
+    redis = Redis()
+    with profiled(Job(), redis):
+        images = render_frames(
+            frames(4), "lon", "lat", {"vmin": 0, "vmax": 1, "label": ""}
+        )
+    assert len(images) == 4
+    stacks = folded_stacks(json.loads(redis.values[profile_key(Job.id)]))
+    assert "plot_frame (api/preview/render.py" in stacks
@@ -0,0 +1,66 @@
+import json
+import pytest
+from api.dataset import progress
+from api.dataset.progress import record, stage
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class Job:
+    id = "progress-job"
+    func_name = "api.dataset.job_queue.slice_and_store_dataset"
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.meta = {}
+        self.saved = []
+
+    def save_meta(self):
+        self.saved.append(json.loads(json.dumps(self.meta)))
+
+
+@pytest.fixture
+def job(monkeypatch):
+    job = Job(fakeredis.FakeRedis())
+    monkeypatch.setattr(progress, "get_current_job", lambda: job)
+    return job
+
+
+def test_stages_record_times_and_summed_counters(job):
+    events = job.connection.pubsub()
+    events.psubscribe("climate-data:job-events:*")
+    events.get_message()
+
+    with stage("load"):
+        record(bytes_read=100, mirror="esgf-node")
+        record(bytes_read=50, mirror="other-node")
+    with pytest.raises(ValueError):
+        with stage("write"):
+            raise ValueError("disk full")
+
+    load, write = job.meta["stages"]
+    assert job.meta["stage"] == "write"
+    assert load["bytes_read"] == 150
+    assert load["mirror"] == "other-node"
+    assert load["ended_at"] is not None and load["seconds"] >= 0
+    assert write["error"] == "disk full"
+    # saved when each stage starts and ends
+    assert [s["stages"][-1]["ended_at"] is None for s in job.saved] == [
+        True,
+        False,
+        True,
+        False,
+    ]
+    published = [events.get_message() for _ in range(4)]
+    assert [json.loads(m["data"])["progress"]["stage"]["stage"] for m in published] == [
+        "load",
+        "load",
+        "write",
+        "write",
+    ]
+
+
+def test_progress_is_a_no_op_outside_of_jobs(monkeypatch):
+    monkeypatch.setattr(progress, "get_current_job", lambda: None)
+    with stage("load"):
+        record(bytes_read=100)
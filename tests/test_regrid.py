@@ -0,0 +1,91 @@
+import numpy
+import pytest
+import xarray
+from scipy import sparse
+from api.processing.regrid import apply_weights, clear_weights_cache, regrid
+from api.settings import default_settings
+
+
+@pytest.fixture(autouse=True)
+def weights_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(default_settings, "regrid_cache_dir", str(tmp_path))
+    clear_weights_cache()
+
+
+def regular_dataset(dtype) -> xarray.Dataset:
+    lon = numpy.arange(0.5, 360.0, 1.0)
+    lat = numpy.arange(-89.5, 90.0, 1.0)
+    return xarray.Dataset(
+        {"tas": (("time", "lat", "lon"), numpy.ones((2, len(lat), len(lon)), dtype))},
+        coords={"time": [0, 1], "lat": lat, "lon": lon},
+    )
+
+
+def test_regridded_grid_has_cf_axes():
+    out = regrid(regular_dataset(numpy.float64), resolution=[2.0, 2.0])
+    axes = {out[c].attrs["axis"]: c for c in out.coords if "axis" in out[c].attrs}
+    assert axes == {"X": "lon", "Y": "lat"}
+
+
+def test_regridding_keeps_float_precision():
+    ds = regular_dataset(numpy.float32)
+    assert regrid(ds, resolution=[2.0, 2.0]).tas.dtype == numpy.float32
+    lazy = regrid(ds.chunk({"time": 1}), resolution=[2.0, 2.0]).tas
+    assert lazy.dtype == numpy.float32
+    assert lazy.compute().dtype == numpy.float32
+    assert regrid(regular_dataset(numpy.int16), resolution=[2.0, 2.0]).tas.dtype == (
+        numpy.float32
+    )
+
+
+def area_mean(da: xarray.DataArray) -> float:
+    weights = numpy.cos(numpy.deg2rad(da.lat))
+    return float(da.weighted(weights).mean(["lat", "lon"]))
+
+
+@pytest.mark.parametrize("method", ["bilinear", "conservative"])
+def test_constant_fields_stay_constant(method):
+    ds = regular_dataset(numpy.float64) * 3.0
+    out = regrid(ds, method, resolution=[2.5, 3.0])
+    numpy.testing.assert_allclose(out.tas.values, 3.0, rtol=1e-6)
+
+
+def test_conservative_regridding_preserves_the_area_mean():
+    ds = regular_dataset(numpy.float64)
+    lat, lon = numpy.meshgrid(ds.lat, ds.lon, indexing="ij")
+    ds["tas"] = ds.tas * (
+        280 + 30 * numpy.cos(numpy.deg2rad(lat)) + 5 * numpy.sin(numpy.deg2rad(lon))
+    )
+    out = regrid(ds, "conservative", resolution=[3.0, 2.0])
+    assert area_mean(out.tas.isel(time=0)) == pytest.approx(
+        area_mean(ds.tas.isel(time=0)), rel=1e-5
+    )
+
+
+def test_missing_source_cells_are_renormalized():
+    weights = sparse.csr_matrix(numpy.array([[0.25, 0.25, 0.25, 0.25]]))
+    data = numpy.array([[[1.0, numpy.nan], [3.0, 5.0]], [[numpy.nan] * 2] * 2])
+    out = apply_weights(data, weights, (1, 1))
+    assert out[0, 0, 0] == pytest.approx(3.0)
+    assert numpy.isnan(out[1, 0, 0])
+
+
+def test_curvilinear_cell_vertices_are_not_regridded():
+    lon, lat = numpy.meshgrid(
+        numpy.arange(0.5, 360.0, 2.0), numpy.arange(-59.5, 60.0, 2.0)
+    )
+    vertices = numpy.zeros(lon.shape + (4,))
+    ds = xarray.Dataset(
+        {
+            "tos": (("j", "i"), numpy.full(lon.shape, 290.0)),
+            "vertices_latitude": (("j", "i", "vertices"), vertices),
+            "vertices_longitude": (("j", "i", "vertices"), vertices),
+        },
+        coords={
+            "longitude": (("j", "i"), lon, {"bounds": "vertices_longitude"}),
+            "latitude": (("j", "i"), lat, {"bounds": "vertices_latitude"}),
+        },
+    )
+    out = regrid(ds, resolution=[4.0, 4.0], envelope=[0, 360, -50, 50])
+    assert list(out.data_vars) == ["tos"]
+    numpy.testing.assert_allclose(out.tos.values, 290.0, rtol=1e-6)
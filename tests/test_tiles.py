@@ -0,0 +1,94 @@
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import pytest
+import xarray
+from matplotlib import pyplot as plt
+from api.preview import cache as preview_cache
+from api.preview import tiles
+from api.settings import default_settings
+
+
+@pytest.fixture(autouse=True)
+def local_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(default_settings, "preview_cache_dir", str(tmp_path))
+    monkeypatch.setattr(default_settings, "preview_cache_object_store", False)
+    monkeypatch.setattr(preview_cache, "_preview_cache", None)
+    monkeypatch.setattr(tiles, "_warm_datasets", None)
+
+
+def global_dataset() -> xarray.Dataset:
+    lat = numpy.arange(-89.5, 90.0, 1.0)
+    lon = numpy.arange(0.5, 360.0, 1.0)
+    # increases eastward from the antimeridian, so tile colors follow longitude
+    values = numpy.broadcast_to((lon + 180) % 360, (2, len(lat), len(lon)))
+    return xarray.Dataset(
+        {"tas": (("time", "lat", "lon"), values.copy())},
+        coords={
+            "time": xarray.date_range("2000-01-01", periods=2, freq="MS"),
+            "lat": lat,
+            "lon": lon,
+        },
+    )
+
+
+def decode(tile: bytes) -> numpy.ndarray:
+    return plt.imread(io.BytesIO(tile))
+
+
+def test_tile_bounds():
+    assert tiles.tile_bounds(0, 0, 0) == pytest.approx((-180, -85.0511, 180, 85.0511))
+    assert tiles.tile_bounds(1, 1, 0) == pytest.approx((0, 0, 180, 85.0511))
+
+
+def test_tiles_are_rendered_once_and_share_a_color_scale():
+    opened = []
+
+    def open():
+        opened.append(True)
+        return global_dataset()
+
+    west = decode(tiles.render_tile("ds.v1", "tas", "2000-01", 1, 0, 0, open))
+    east = decode(tiles.render_tile("ds.v1", "tas", "2000-01", 1, 1, 0, open))
+    assert west.shape == (tiles.TILE_SIZE, tiles.TILE_SIZE, 4)
+    assert len(opened) == 1
+    # one color scale: colors match across the seam and differ across the globe
+    numpy.testing.assert_allclose(west[128, -1], east[128, 0], atol=0.02)
+    assert numpy.abs(west[128, 0] - east[128, -1]).max() > 0.5
+    assert (west[..., 3] > 0).all()
+
+    tiles.get_warm_datasets().datasets.clear()
+    again = tiles.render_tile("ds.v1", "tas", "2000-01", 1, 0, 0, open)
+    assert numpy.array_equal(decode(again), west)
+    assert len(opened) == 1
+
+
+def test_tiles_outside_the_grid_are_rejected():
+    with pytest.raises(ValueError):
+        tiles.render_tile("ds.v1", "tas", "2000-01", 1, 2, 0, global_dataset)
+    with pytest.raises(KeyError):
+        tiles.render_tile("ds.v1", "pr", "2000-01", 0, 0, 0, global_dataset)
+
+
+def test_concurrent_tiles_compute_the_color_scale_once(monkeypatch):
+    computed = []
+    color_limits = tiles.color_limits
+
+    def slow_color_limits(frames):
+        computed.append(True)
+        time.sleep(0.2)
+        return color_limits(frames)
+
+    monkeypatch.setattr(tiles, "color_limits", slow_color_limits)
+    warm = tiles.get_warm_datasets()
+    data = global_dataset().tas
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        limits = list(
+            executor.map(
+                lambda _: tiles.shared_limits(warm, "ds.v1", "tas", data, "lon", "lat"),
+                range(4),
+            )
+        )
+    assert len(computed) == 1
+    assert len(set(limits)) == 1
@@ -0,0 +1,59 @@
+import json
+from datetime import datetime, timedelta, timezone
+from api import tracing
+from api.settings import default_settings
+
+
+class Job:
+    id = "traced-job"
+    func_name = "api.dataset.job_queue.slice_and_store_dataset"
+    origin = "subset"
+
+    def __init__(self, trace_context):
+        self.kwargs = {"job_id": self.id, "trace_context": trace_context}
+        self.enqueued_at = (datetime.now(timezone.utc) - timedelta(seconds=2)).replace(
+            tzinfo=None
+        )
+
+
+def exported_spans(path) -> dict:
+    spans = {}
+    with open(path) as f:
+        for line in f:
+            for resource in json.loads(line)["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    for span in scope["spans"]:
+                        spans[span["name"]] = span
+    return spans
+
+
+def test_jobs_continue_the_trace_of_the_request(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(default_settings, "trace_file", str(path))
+    with tracing.span("GET /subset/esgf", kind=tracing.SERVER):
+        traceparent = tracing.current_traceparent()
+
+    # in the worker, with no current span
+    with tracing.job_span(Job(traceparent)):
+        with tracing.span("load"):
+            pass
+
+    spans = exported_spans(path)
+    request = spans["GET /subset/esgf"]
+    job = spans["job slice_and_store_dataset"]
+    assert {s["traceId"] for s in spans.values()} == {request["traceId"]}
+    assert "parentSpanId" not in request
+    assert job["parentSpanId"] == request["spanId"]
+    assert spans["rq.queued"]["parentSpanId"] == request["spanId"]
+    assert spans["load"]["parentSpanId"] == job["spanId"]
+    queued = int(spans["rq.queued"]["endTimeUnixNano"]) - int(
+        spans["rq.queued"]["startTimeUnixNano"]
+    )
+    assert queued >= 2e9
+
+
+def test_tracing_is_off_without_a_trace_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(default_settings, "trace_file", "")
+    with tracing.span("GET /status"):
+        assert tracing.current_traceparent() is None
+    assert list(tmp_path.iterdir()) == []